@@ -0,0 +1,230 @@
+import json
+import re
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
+
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from typing_extensions import Annotated
+
+# Mirrors AIAction in mail-ai-app/src/types/ai.ts; keep the two in step.
+
+class BaseAction(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    def default_message(self) -> str:
+        return f"Performing action: {self.type}"
+
+class ComposeAction(BaseAction):
+    type: Literal["compose"]
+    to: str = ""
+    subject: str = ""
+    body: str = ""
+
+    def default_message(self) -> str:
+        return f"Composing an email to {self.to or 'the recipient'}. Please review and confirm to send."
+
+class NavigateAction(BaseAction):
+    type: Literal["navigate"]
+    view: Literal["inbox", "sent", "compose", "drafts", "trash"]
+
+    def default_message(self) -> str:
+        return f"Navigating to {self.view}."
+
+class Filters(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    isUnread: Optional[bool] = None
+    after: Optional[str] = None  # YYYY/MM/DD
+    before: Optional[str] = None
+
+class SearchAction(BaseAction):
+    type: Literal["search"]
+    query: str
+
+class FilterAction(BaseAction):
+    type: Literal["filter"]
+    filters: Filters
+
+class OpenEmailAction(BaseAction):
+    type: Literal["open_email"]
+    emailId: str
+
+    def default_message(self) -> str:
+        return "Opening that email for you."
+
+class SummarizeAction(BaseAction):
+    type: Literal["summarize"]
+    emailIds: List[str] = []
+    summary: str = ""
+
+    def default_message(self) -> str:
+        return self.summary or "Here's a summary of your emails."
+
+class ReplyAction(BaseAction):
+    type: Literal["reply"]
+    emailId: str
+    body: str
+
+class SendAction(BaseAction):
+    type: Literal["send"]
+
+    def default_message(self) -> str:
+        return "Sending the email now..."
+
+class SaveDraftAction(BaseAction):
+    type: Literal["save_draft"]
+
+class ClearFiltersAction(BaseAction):
+    type: Literal["clear_filters"]
+
+class GmailSearchAction(BaseAction):
+    type: Literal["gmail_search"]
+    query: str
+
+class LogoutAction(BaseAction):
+    type: Literal["logout"]
+
+class DiscardComposeAction(BaseAction):
+    type: Literal["discard_compose"]
+    saveDraft: Optional[bool] = None
+    needsConfirmation: Optional[bool] = None
+
+Action = Annotated[
+    Union[
+        ComposeAction, NavigateAction, SearchAction, FilterAction, OpenEmailAction, SummarizeAction,
+        ReplyAction, SendAction, SaveDraftAction, ClearFiltersAction, GmailSearchAction, LogoutAction,
+        DiscardComposeAction,
+    ],
+    Field(discriminator="type"),
+]
+ACTION_ADAPTER = TypeAdapter(Action)
+
+class AssistantReply(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    action: Optional[Action] = None
+    message: str = ""
+    needsConfirmation: bool = False
+
+    def to_response(self) -> Dict[str, Any]:
+        """The {action, message, needsConfirmation} dict the frontend expects."""
+        return {
+            "action": self.action.model_dump(exclude_none=True) if self.action else None,
+            "message": self.message or (self.action.default_message() if self.action else ""),
+            "needsConfirmation": self.needsConfirmation,
+        }
+
+def _strict(node: Any) -> Any:
+    # Providers' strict JSON-schema modes only accept a subset: closed
+    # objects, every property listed as required, anyOf instead of oneOf.
+    if isinstance(node, list):
+        return [_strict(item) for item in node]
+    if not isinstance(node, dict):
+        return node
+    node = {key: _strict(value) for key, value in node.items()
+            if key not in ("title", "default", "discriminator")}
+    if "oneOf" in node:
+        node["anyOf"] = node.pop("oneOf")
+    if "const" in node:
+        node["enum"] = [node.pop("const")]
+    if node.get("type") == "object" and "properties" in node:
+        node["additionalProperties"] = False
+        node["required"] = list(node["properties"])
+    return node
+
+REPLY_SCHEMA = _strict(AssistantReply.model_json_schema())
+
+def action_summary() -> str:
+    """One line per action type with its fields, for the repair prompt."""
+    lines = []
+    for model in ACTION_ADAPTER.json_schema()["$defs"].values():
+        props = model.get("properties", {})
+        if "type" not in props:
+            continue
+        fields = ", ".join(name for name in props if name != "type")
+        lines.append(f"- {props['type']['const']}: {fields or '(no fields)'}")
+    return "\n".join(lines)
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_DECODER = json.JSONDecoder()
+
+def _close_brackets(text: str) -> str:
+    """Append whatever closing quotes/brackets a truncated JSON value is missing."""
+    stack, in_string, escape = [], False, False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    return text + ('"' if in_string else "") + "".join(reversed(stack))
+
+def _loads_tolerant(text: str) -> Tuple[Any, bool]:
+    """json.loads after cheap fixes; returns (value, fixed)."""
+    fixed = text.replace("“", '"').replace("”", '"')
+    fixed = _TRAILING_COMMA.sub(r"\1", _close_brackets(fixed))
+    return json.loads(fixed), True
+
+def parse_reply(content: str) -> Tuple[Optional[AssistantReply], str]:
+    """Parse and validate a completion; returns (reply, outcome or error).
+
+    The outcome is "valid", "tolerated" (needed a cheap fix such as a code
+    fence, trailing comma or missing closing brace) or "plain" (no JSON at
+    all, taken as a message). On failure the reply is None and the second
+    value describes the problem, for the repair request.
+    """
+    text = content.strip()
+    fence = _FENCE.search(text)
+    tolerated = False
+    if fence:
+        text, tolerated = fence.group(1).strip(), True
+    start = text.find("{")
+    if start == -1:
+        if not text or text[0] in '["':
+            return None, "expected a JSON object"
+        return AssistantReply(message=text), "plain"
+    try:
+        # raw_decode stops at the end of the object, ignoring trailing prose.
+        data, end = _DECODER.raw_decode(text, start)
+        fixed = start > 0 or end < len(text)
+    except json.JSONDecodeError:
+        try:
+            data, fixed = _loads_tolerant(text[start:])
+        except json.JSONDecodeError as e:
+            return None, f"invalid JSON: {e}"
+    if not isinstance(data, dict):
+        return None, "expected a JSON object"
+    try:
+        reply = AssistantReply.model_validate(data)
+    except ValidationError as e:
+        return None, "schema mismatch: " + "; ".join(
+            f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()[:5]
+        )
+    if reply.action is None and not reply.message:
+        return None, "reply has neither an action nor a message"
+    return reply, "tolerated" if tolerated or fixed else "valid"
+
+# Outcome counters for completions: how many needed a repair request and
+# how many were unusable even after it.
+_stats = {"responses": 0, "valid": 0, "tolerated": 0, "plain": 0, "repaired": 0, "malformed": 0}
+
+def record(outcome: str) -> None:
+    _stats["responses"] += 1
+    _stats[outcome] += 1
+
+def output_stats() -> Dict[str, Any]:
+    total = _stats["responses"]
+    needed_repair = _stats["repaired"] + _stats["malformed"]
+    return {
+        **_stats,
+        "repairRate": round(needed_repair / total, 4) if total else 0.0,
+        "malformedRate": round(_stats["malformed"] / total, 4) if total else 0.0,
+    }
@@ -1,13 +1,32 @@
-from fastapi import APIRouter, HTTPException, Request
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
 from typing import List, Optional, Any, Dict
 import os
+import hashlib
 import json
-import requests
+import re
+import time
 from dotenv import load_dotenv
 
+from actions import ACTION_ADAPTER, REPLY_SCHEMA, action_summary, output_stats, parse_reply, record
+from cache import DiskCache, SingleFlight, TTLCache
+from gmail_service import token_key
+from log import get_logger
+from mail import get_gmail_service, get_messages, search_messages
+from openrouter import DEFAULT_MODEL, chat_completion, stream_chat_completion, OpenRouterError
+from prompt import (
+    EMAIL_BODY_MAX_TOKENS, PROMPT_TOKEN_BUDGET, MESSAGE_OVERHEAD_TOKENS, Budget, estimate_messages,
+    estimate_tokens, pack_body, pack_history, pack_lines,
+)
+from sessions import (
+    SESSION_RECENT_MESSAGES, Session, drop_session, get_session, record_turn, session_stats, valid_session_id,
+)
+
 load_dotenv(dotenv_path="../.env.local")
 
+logger = get_logger("ai")
+
 router = APIRouter(prefix="/api", tags=["ai"])
 
 class ChatMessage(BaseModel):
@@ -28,48 +47,23 @@ class AIContext(BaseModel):
     emails: Optional[List[EmailSummary]] = None
     userName: Optional[str] = None
     userEmail: Optional[str] = None
+    isComposerOpen: Optional[bool] = None
 
 class AssistantRequest(BaseModel):
     message: str
     context: Optional[AIContext] = None
     history: Optional[List[ChatMessage]] = None
-
-def build_system_prompt(context: AIContext) -> str:
-    user_name = context.userName or "User"
-    user_email = context.userEmail or ""
-    
-    # Build email list context
-    email_context = ""
-    if context.emails:
-        email_items = []
-        for i, e in enumerate(context.emails[:20]):  # Limited to 20 for better search coverage
-            read_status = "read" if e.isRead else "UNREAD"
-            email_items.append(f"  {i+1}. ID:{e.id} | From: {e.sender} | Subject: {e.subject} | Date: {e.date} | Status: {read_status}\n     Preview: {e.snippet}")
-        email_context = "\n".join(email_items)
-    
-    current_email_context = ""
-    if context.currentEmail:
-        ce = context.currentEmail
-        body_text = ce.get('bodyText', ce.get('snippet', ''))
-        current_email_context = f"""
-Currently Viewed Email:
-- ID: {ce.get('id', '')}
-- From: {ce.get('from', '')}
-- Subject: {ce.get('subject', '')}
-- Preview: {ce.get('snippet', '')}
-- Full Content: {body_text}
-"""
-
-    return f"""You are an AI assistant for {user_name}'s email application.
-The user's name is {user_name} and their email is {user_email}.
-When composing emails, always sign off with "{user_name}" (never "[Your Name]").
-
-Current View: {context.currentView}
-
-{f"Recent emails in {context.currentView} ({len(context.emails) if context.emails else 0} loaded):" if email_context else "No emails loaded in current view."}
-{email_context}
-
-{current_email_context}
+    # With a session id (and an Authorization header, which scopes it to the
+    # user) the server keeps the conversation and `history` is only used to
+    # re-seed a session it no longer has.
+    sessionId: Optional[str] = None
+
+# Everything that does not depend on the request. It is sent byte-identical
+# every time, ahead of the per-request context, so providers that cache
+# prompt prefixes can reuse it.
+SYSTEM_PROMPT = """You are an AI assistant for the user's email application.
+The user's name, the current view and the emails they can see are given in
+USER CONTEXT at the end of this prompt.
 
 You help users manage their email by executing structured actions.
 
@@ -86,44 +80,44 @@ Available Actions:
 8. send - Send the currently composed email. Fields: type
 9. save_draft - Save the currently composed email as a draft. Fields: type
 10. clear_filters - Clear filters. Fields: type
-11. gmail_search - FALLBACK: search the user's entire Gmail mailbox (subject + body). Fields: type, query. Use this ONLY when the email is NOT found in the loaded list above. The query should be a Gmail search query (e.g. "from:john salary slip", "subject:interview", "meeting notes").
+11. gmail_search - FALLBACK: search the user's entire Gmail mailbox (subject + body). Fields: type, query. Use this ONLY when the email is NOT found in the loaded list. The query should be a Gmail search query (e.g. "from:john salary slip", "subject:interview", "meeting notes").
 12. logout - Log the user out of the application. Fields: type
 13. discard_compose - Discard the current email draft. Fields: type, saveDraft (boolean), needsConfirmation (boolean)
 
 Response Format (ALWAYS return JSON):
-{{
-  "action": {{
+{
+  "action": {
     "type": "action_type",
     "...fields": "based on action type"
-  }},
+  },
   "message": "Friendly explanation of what you're doing",
   "needsConfirmation": false
-}}
+}
 
 If no action is needed (e.g. answering a question, saying something wasn't found), you can omit the action field or set it to null:
-{{
+{
   "action": null,
   "message": "Your answer or explanation here"
-}}
+}
 
 IMPORTANT RULES:
 
 EMAIL LOOKUP & SEARCH (2-STEP PROCESS):
-- Step 1: When the user asks "is there an email about X" or "do I have an email from Y" or "find email about Z", FIRST search through the email list above.
+- Step 1: When the user asks "is there an email about X" or "do I have an email from Y" or "find email about Z", FIRST search through the email list in USER CONTEXT.
 - Step 2: If you find a matching email in the list: use the "open_email" action with its ID AND include a summary of the email in your "message" field.
-- Step 3 (FALLBACK): If NO matching email exists in the loaded list above, use the "gmail_search" action to search the user's entire Gmail mailbox. Write a helpful Gmail search query. Tell the user you're searching their mailbox.
+- Step 3 (FALLBACK): If NO matching email exists in the loaded list, use the "gmail_search" action to search the user's entire Gmail mailbox. Write a helpful Gmail search query. Tell the user you're searching their mailbox.
 - Construct good search queries: combine "from:", "subject:", and keywords. Example: for "email from abhijeet about interview" → query: "from:abhijeet interview"
-- NEVER make up or hallucinate emails that don't exist in the list above.
+- NEVER make up or hallucinate emails that don't exist in the list.
 
 SUMMARIZATION:
-- When the user asks to summarize emails, use the actual email data provided above to generate a real summary. Return it in the "message" field AND as a summarize action.
+- When the user asks to summarize emails, use the actual email data provided in USER CONTEXT to generate a real summary. Return it in the "message" field AND as a summarize action.
 - When the user asks "what was the last email about", find the most recent email in the list and summarize it.
 - When opening/finding an email for the user, always include a brief summary in your message.
 
 COMPOSING, SENDING & DISCARDING:
 - When the user asks you to "send an email" or "compose an email", use the "compose" action to pre-fill the compose form with to, subject, and body. Tell the user to review it.
 - When the user says "send it", "yes send", "go ahead", "looks good send it" or similar AFTER a compose or reply action was just performed, use the "send" action to send the email that is currently in the compose form.
-- When composing emails, use "{user_name}" as the sign-off name, never "[Your Name]".
+- When composing emails, sign off with the user's name from USER CONTEXT, never "[Your Name]".
 - When the user asks to "discard" the current email/draft:
     - If they say "save and discard" or "save to draft", use "discard_compose" with "saveDraft": true.
     - If they say "just discard" or "delete it", use "discard_compose" with "saveDraft": false.
@@ -131,7 +125,7 @@ COMPOSING, SENDING & DISCARDING:
 - When the user asks to "log out" or "sign out", use the "logout" action.
 
 REPLYING:
-- When the user asks to "reply to" an email, use the "reply" action with the emailId and body. Write the reply body on behalf of the user, sign off with "{user_name}". The to/subject will be auto-filled from the original email.
+- When the user asks to "reply to" an email, use the "reply" action with the emailId and body. Write the reply body on behalf of the user, sign off with the user's name. The to/subject will be auto-filled from the original email.
 
 DRAFTS:
 - When the user asks to "save as draft" or "save to drafts", use the "save_draft" action.
@@ -141,7 +135,7 @@ DATE-BASED QUERIES & FILTERING:
 - For a single day (e.g. Jan 5 2026), use: "after": "2026/01/04", "before": "2026/01/06" (day before and day after).
 - You may ALSO include a summary in the "message" field, but the filter action is REQUIRED so the user can see the filtered results in their inbox.
 - Example response for "show me emails from Jan 5":
-  {{"action": {{"type": "filter", "filters": {{"after": "2026/01/04", "before": "2026/01/06"}}}}, "message": "Filtering your inbox to show emails from January 5, 2026."}}
+  {"action": {"type": "filter", "filters": {"after": "2026/01/04", "before": "2026/01/06"}}, "message": "Filtering your inbox to show emails from January 5, 2026."}
 
 OPENING EMAILS FROM SEARCH/SUMMARY RESULTS:
 - When the user asks to "show me", "open", or "read" a specific email that was mentioned in a PREVIOUS message in the conversation, look through the conversation history for the email's ID.
@@ -155,94 +149,706 @@ HONESTY & LIMITATIONS:
 - If the user's request is ambiguous, ask for clarification instead of guessing.
 - Keep messages concise and friendly.
 """
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
 
-@router.post("/assistant")
-async def chat_assistant(req: AssistantRequest):
-    api_key = os.getenv("OPENROUTER_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="OpenRouter API Key missing")
+# OpenRouter passes cache_control through to providers that need explicit
+# cache breakpoints (Anthropic, Gemini); others cache prefixes automatically.
+PROMPT_CACHE_CONTROL = os.getenv("AI_PROMPT_CACHE_CONTROL", "0") == "1"
+
+def build_context(context: AIContext, budget: Budget) -> str:
+    """The per-request part of the system prompt, packed into `budget`.
 
+    The viewed email's body is condensed and trimmed first, then as many
+    list entries as still fit are included.
+    """
+    user_name = context.userName or "User"
+    user_email = context.userEmail or ""
+    header = f"""USER CONTEXT
+The user's name is {user_name} and their email is {user_email}.
+When composing emails, always sign off with "{user_name}" (never "[Your Name]").
+
+Current View: {context.currentView}
+"""
+    budget.spend(header)
+
+    current_email_context = ""
+    if context.currentEmail:
+        ce = context.currentEmail
+        meta = f"""
+Currently Viewed Email:
+- ID: {ce.get('id', '')}
+- From: {ce.get('from', '')}
+- Subject: {ce.get('subject', '')}
+- Preview: {ce.get('snippet', '')}
+"""
+        budget.spend(meta)
+        body_text = pack_body(ce.get('bodyText') or ce.get('snippet', ''), budget)
+        current_email_context = f"{meta}- Full Content: {body_text}\n"
+
+    email_context = "No emails loaded in current view."
+    if context.emails:
+        email_items = []
+        for i, e in enumerate(context.emails[:20]):  # Limited to 20 for better search coverage
+            read_status = "read" if e.isRead else "UNREAD"
+            email_items.append(f"  {i+1}. ID:{e.id} | From: {e.sender} | Subject: {e.subject} | Date: {e.date} | Status: {read_status}\n     Preview: {e.snippet}")
+        email_items, dropped = pack_lines(email_items, budget)
+        shown = f", {len(email_items)} shown" if dropped else ""
+        email_context = f"Recent emails in {context.currentView} ({len(context.emails)} loaded{shown}):\n" + "\n".join(email_items)
+
+    return f"{header}\n{email_context}\n{current_email_context}"
+
+def system_message(context_text: str) -> Dict[str, Any]:
+    if PROMPT_CACHE_CONTROL:
+        return {"role": "system", "content": [
+            {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": context_text},
+        ]}
+    return {"role": "system", "content": f"{SYSTEM_PROMPT}\n{context_text}"}
+
+def build_messages(req: AssistantRequest, session: Optional[Session] = None) -> List[Dict[str, Any]]:
+    """System prompt, recent history and the user's message, within PROMPT_TOKEN_BUDGET.
+
+    The static prompt and the user's message are always sent. The viewed
+    email, the email list, the session's summary and email table, and then
+    conversation history (newest first) share whatever is left.
+    """
     context = req.context or AIContext(currentView="inbox")
-    system_prompt = build_system_prompt(context)
+    budget = Budget(
+        PROMPT_TOKEN_BUDGET - SYSTEM_PROMPT_TOKENS - estimate_tokens(req.message) - 2 * MESSAGE_OVERHEAD_TOKENS
+    )
+    context_text = build_context(context, budget)
+    if session is not None:
+        context_text += session.memory(budget)
+    messages = [system_message(context_text)]
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-    ]
-    
     # Add recent conversation history so the AI remembers prior actions
-    if req.history:
-        for msg in req.history[-10:]:  # Last 10 messages for context
-            messages.append({"role": msg.role, "content": msg.content})
-    
+    if session is not None:
+        messages += pack_history(session.turns, budget, limit=len(session.turns))
+    elif req.history:
+        messages += pack_history([(msg.role, msg.content) for msg in req.history], budget)
+
     # Add the current user message
     messages.append({"role": "user", "content": req.message})
-
+    return messages
+
+def prompt_usage(messages: List[Dict[str, Any]], usage: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Prompt token counts for a response: our estimate plus what the provider billed."""
+    usage = usage or {}
+    report = {
+        "estimatedPromptTokens": estimate_messages(messages),
+        "promptTokens": usage.get("prompt_tokens"),
+        "cachedPromptTokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+        "completionTokens": usage.get("completion_tokens"),
+    }
+    logger.info("ai_usage", **report)
+    return report
+
+# Repeated questions against an unchanged view get the same answer, so
+# completions are cached briefly. AI_CACHE_BACKEND is memory, disk or off.
+AI_CACHE_BACKEND = os.getenv("AI_CACHE_BACKEND", "memory")
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", 300))
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", 512))
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", os.path.join(os.path.dirname(__file__), "ai_cache.sqlite3"))
+
+if AI_CACHE_BACKEND == "disk":
+    _responses = DiskCache(AI_CACHE_PATH, maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL)
+elif AI_CACHE_BACKEND == "memory":
+    _responses = TTLCache(maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL)
+else:
+    _responses = None
+_inflight = SingleFlight()
+
+# Part of every cache key, so a deploy that changes the prompt or model
+# never serves answers produced under the old one.
+_PROMPT_VERSION = hashlib.sha256(f"{DEFAULT_MODEL}\n{SYSTEM_PROMPT}".encode()).hexdigest()[:12]
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def cache_key(req: AssistantRequest, mailbox: Optional[str] = None, session: Optional[Session] = None) -> str:
+    """Hash of what the answer depends on.
+
+    Emails are identified by id and read state only: Gmail messages do not
+    change otherwise, so ids stand in for their subjects and bodies.
+    """
+    context = req.context or AIContext(currentView="inbox")
+    current = context.currentEmail or {}
+    if session is not None:
+        history = session.turns
+        memory = [session.summary, list(session.emails)]
+    else:
+        history = [(m.role, m.content) for m in (req.history or [])[-10:]]
+        memory = None
+    key = {
+        "v": _PROMPT_VERSION,
+        "message": _normalize(req.message),
+        "view": context.currentView,
+        "user": [context.userName, context.userEmail],
+        "emails": [[e.id, e.isRead] for e in context.emails or []],
+        "current": current.get("id") or json.dumps(current, sort_keys=True, default=str),
+        "history": [[role, _normalize(content)] for role, content in history],
+        "memory": memory,
+        # Set when tools run, since answers then depend on the mailbox itself.
+        "mailbox": mailbox,
+    }
+    return hashlib.sha256(json.dumps(key, separators=(",", ":")).encode()).hexdigest()
+
+def cached_response(key: str) -> Optional[Dict[str, Any]]:
+    result = _responses.get(key) if _responses is not None else None
+    if result is not None:
+        logger.debug("ai_cache_hit")
+        return {**result, "cached": True}
+    return None
+
+def cache_response(key: str, result: Dict[str, Any]) -> None:
+    if _responses is not None:
+        _responses.set(key, result)
+
+# Deterministic fast path for commands that map one-to-one onto an action.
+# Each pattern must match the whole command once filler words are removed;
+# a partial match only counts if it covers ROUTER_THRESHOLD of the text.
+ROUTER_ENABLED = os.getenv("AI_ROUTER_ENABLED", "1") == "1"
+ROUTER_THRESHOLD = float(os.getenv("AI_ROUTER_THRESHOLD", 0.85))
+
+_FILLER = re.compile(
+    r"\b(?:please|pls|plz|kindly|(?:can|could|would|will) you|for me|right now|now|thanks|thank you"
+    r"|hey|hi|just|yes|yeah|yep|ok|okay|sure|alright|looks good|go ahead and)\b"
+)
+_VIEWS = {
+    "inbox": "inbox", "sent": "sent", "sent mail": "sent", "sent items": "sent",
+    "draft": "drafts", "drafts": "drafts", "trash": "trash", "bin": "trash", "compose": "compose",
+}
+_INTENTS = [
+    ("navigate", re.compile(
+        r"(?:go|switch|navigate|take me|bring me|jump|head|get me)(?: back)? to (?:my |the )?"
+        r"(?P<view>inbox|sent mail|sent items|sent|drafts?|trash|bin|compose)"
+        r"(?: (?:folder|view|page|tab|box|mail|emails))?"
+        r"|(?:open|show me|show|view) (?:my |the )?(?P<view2>inbox|sent mail|sent items|sent|drafts?|trash|bin)"
+        r"(?: (?:folder|view|page|tab|box|mail|emails))?"
+    ), False),
+    ("logout", re.compile(r"(?:log|sign) (?:me )?out(?: of (?:my account|the app|the application|here))?|logout|signout"), False),
+    ("clear_filters", re.compile(
+        r"(?:clear|remove|reset|drop|turn off) (?:all )?(?:the |my |these |those )?(?:active )?filters?"
+        r"|unfilter|show (?:me )?all (?:my )?(?:emails|mail|messages)"
+    ), False),
+    ("send", re.compile(r"send(?: it| this| that| the (?:email|mail|reply|message|draft))?"), True),
+    ("save_draft", re.compile(
+        r"save(?: it| this| that| the (?:email|mail|reply|message))?"
+        r" (?:as (?:a )?draft|to (?:my )?drafts?|in (?:my )?drafts?|for later)|save (?:a |as )?draft"
+    ), True),
+]
+_ROUTED_MESSAGES = {
+    "logout": "Logging you out.",
+    "clear_filters": "Cleared all filters.",
+    "send": "Sending the email now...",
+    "save_draft": "Saving your email as a draft.",
+}
+
+_router_stats = {"requests": 0, "routed": 0, "byAction": {}}
+
+def _normalize_command(text: str) -> str:
+    text = re.sub(r"[^\w\s']", " ", text.lower()).replace("'", "")
+    return " ".join(_FILLER.sub(" ", text).split())
+
+def route_intent(req: AssistantRequest) -> Optional[Dict[str, Any]]:
+    """The {action, message} response for a trivial command, or None for the LLM.
+
+    `send` and `save_draft` are only routed while the composer is open;
+    otherwise the model gets to explain why there is nothing to send.
+    """
+    if not ROUTER_ENABLED:
+        return None
+    _router_stats["requests"] += 1
+    text = _normalize_command(req.message)
+    if not text:
+        return None
+    composer_open = bool(req.context and req.context.isComposerOpen)
+    for action_type, pattern, needs_composer in _INTENTS:
+        match = pattern.fullmatch(text)
+        confidence = 1.0 if match else 0.0
+        if match is None:
+            match = pattern.search(text)
+            if match is None:
+                continue
+            confidence = (match.end() - match.start()) / len(text)
+        if confidence < ROUTER_THRESHOLD:
+            continue
+        if needs_composer and not composer_open:
+            return None
+        action = {"type": action_type}
+        if action_type == "navigate":
+            action["view"] = _VIEWS[match.group("view") or match.group("view2")]
+            message = f"Navigating to {action['view']}."
+        else:
+            message = _ROUTED_MESSAGES[action_type]
+        _router_stats["routed"] += 1
+        _router_stats["byAction"][action_type] = _router_stats["byAction"].get(action_type, 0) + 1
+        logger.info("ai_routed", action=action_type, confidence=round(confidence, 2))
+        return {"action": action, "message": message, "needsConfirmation": False, "routed": True}
+    return None
+
+def router_stats() -> Dict[str, Any]:
+    requests, routed = _router_stats["requests"], _router_stats["routed"]
+    return {
+        "enabled": ROUTER_ENABLED,
+        "threshold": ROUTER_THRESHOLD,
+        "requests": requests,
+        "routed": routed,
+        "hitRate": round(routed / requests, 4) if requests else 0.0,
+        "byAction": dict(_router_stats["byAction"]),
+    }
+
+# Ask the provider for output constrained to the reply schema (json_schema),
+# for any JSON object (json_object), or neither (off). A model that rejects
+# response_format gets plain requests from then on.
+RESPONSE_FORMAT = os.getenv("AI_RESPONSE_FORMAT", "json_schema")
+REPAIR_MAX_TOKENS = int(os.getenv("AI_REPAIR_MAX_TOKENS", 800))
+_response_format_supported = True
+
+REPAIR_PROMPT = """Rewrite the email assistant reply below as a single JSON object:
+{"action": <action object or null>, "message": "<text for the user>", "needsConfirmation": false}
+
+Action objects have a "type" and these fields:
+""" + action_summary() + """
+
+Keep the reply's meaning and wording. Return only the JSON object."""
+
+def response_format_params() -> Dict[str, Any]:
+    if not _response_format_supported or RESPONSE_FORMAT == "off":
+        return {}
+    if RESPONSE_FORMAT == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    return {"response_format": {"type": "json_schema", "json_schema": {
+        "name": "assistant_reply", "strict": True, "schema": REPLY_SCHEMA,
+    }}}
+
+def _format_unsupported(e: OpenRouterError) -> None:
+    global _response_format_supported
+    logger.warning("response_format_rejected", detail=e.detail[:200])
+    _response_format_supported = False
+
+async def structured_completion(messages: List[Dict[str, Any]], **params: Any) -> Dict[str, Any]:
+    response_format = response_format_params()
+    try:
+        return await chat_completion(messages, **response_format, **params)
+    except OpenRouterError as e:
+        if e.status_code != 400 or not response_format:
+            raise
+        # Only blame response_format if the same request works without it.
+        data = await chat_completion(messages, **params)
+        _format_unsupported(e)
+        return data
+
+async def structured_stream(messages: List[Dict[str, Any]], **params: Any):
+    response_format = response_format_params()
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": os.getenv("NEXT_PUBLIC_APP_URL", "http://localhost:3000"),
-                "X-Title": "Mail AI App"
-            },
-            json={
-                "model": "nvidia/nemotron-3-nano-30b-a3b:free",
-                "messages": messages,
-                "temperature": 0.5,
-                "max_tokens": 1500
-            }
+        async for delta in stream_chat_completion(messages, **response_format, **params):
+            yield delta
+        return
+    except OpenRouterError as e:
+        if e.status_code != 400 or not response_format:
+            raise
+        error = e
+    async for delta in stream_chat_completion(messages, **params):
+        if error is not None:
+            _format_unsupported(error)
+            error = None
+        yield delta
+
+async def finalize_reply(content: str, usage: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Turn the model's raw completion into the {action, message} response.
+
+    Output that cannot be parsed or fails validation gets one cheap repair
+    request: the raw reply and the problem, without the system prompt or
+    mailbox context.
+    """
+    reply, outcome = parse_reply(content)
+    if reply is None:
+        logger.info("ai_output_malformed", outcome=outcome)
+        try:
+            data = await structured_completion(
+                [
+                    {"role": "system", "content": REPAIR_PROMPT},
+                    {"role": "user", "content": f"Reply:\n{content}\n\nProblem: {outcome}"},
+                ],
+                hedge=False, temperature=0, max_tokens=REPAIR_MAX_TOKENS,
+            )
+            if usage is not None:
+                _add_usage(usage, data.get("usage") or {})
+            reply, _ = parse_reply(data['choices'][0]['message']['content'])
+        except OpenRouterError as e:
+            logger.error("ai_repair_error", status=e.status_code, detail=e.detail)
+        outcome = "repaired" if reply is not None else "malformed"
+    record(outcome)
+
+    if reply is None:
+        logger.warning("ai_output_unparsed", content=content[:500])
+        return {"message": content, "action": None}
+    result = reply.to_response()
+    logger.debug("ai_parsed", message=result['message'][:100],
+                 action=result['action']['type'] if result['action'] else None)
+    return result
+
+# With the user's Gmail token, gmail_search and open_email are run here and
+# their results fed back to the model, instead of the frontend making the
+# calls and posting a follow-up request.
+TOOL_LOOP_ENABLED = os.getenv("AI_TOOL_LOOP", "1") == "1"
+TOOL_MAX_ITERATIONS = int(os.getenv("AI_TOOL_MAX_ITERATIONS", 2))
+TOOL_SEARCH_RESULTS = 5
+
+async def run_tool(service, action: Dict[str, Any], known_ids: set, result: Dict[str, Any]) -> Optional[str]:
+    """Run a tool action and describe its outcome for the model.
+
+    Returns None when the action needs no server-side work. Search results
+    are added to `result` so the frontend can show them.
+    """
+    if action.get("type") == "gmail_search" and action.get("query"):
+        query = action["query"]
+        found, _ = await search_messages(service, query, TOOL_SEARCH_RESULTS, include_body=False)
+        result["searchQuery"] = query
+        result["searchResults"] = [m.to_dict() for m in found]
+        known_ids.update(m.id for m in found)
+        if not found:
+            return (f'I searched the user\'s Gmail for "{query}" and found no matching emails. '
+                    "Tell the user; do not search again with the same query.")
+        lines = "\n".join(
+            f"{i + 1}. ID:{m.id} | From: {m.sender} | Subject: {m.subject} | Date: {m.date}\n   Preview: {m.snippet}"
+            for i, m in enumerate(found)
         )
+        return (f'I searched the user\'s Gmail and found these results for "{query}":\n\n{lines}\n\n'
+                "Summarize what was found for the user and mention the email IDs so they can open one. "
+                "If one email clearly matches what they asked for, open it with open_email.")
+
+    email_id = action.get("emailId")
+    if action.get("type") == "open_email" and email_id and email_id not in known_ids:
+        # An id the client never showed us: make sure it exists and let the
+        # model summarize the real content rather than guess.
+        known_ids.add(email_id)
+        found = await get_messages(service, [email_id], True)
+        if not found:
+            return f"There is no email with ID {email_id}. Tell the user you could not find it."
+        m = found[0]
+        body = pack_body(m.bodyText or m.snippet, Budget(EMAIL_BODY_MAX_TOKENS))
+        return (f"Email ID:{m.id}\nFrom: {m.sender}\nSubject: {m.subject}\nDate: {m.date}\n{body}\n\n"
+                "Open this email with open_email and include a brief summary of it in your message.")
+    return None
+
+def _add_usage(total: Dict[str, Any], usage: Dict[str, Any]) -> None:
+    """Sum token counts across the completions of one tool loop."""
+    for name, value in usage.items():
+        if isinstance(value, dict):
+            _add_usage(total.setdefault(name, {}), value)
+        elif isinstance(value, (int, float)):
+            total[name] = total.get(name, 0) + value
+
+async def complete(key: str, messages: List[Dict[str, Any]], service=None,
+                   known_ids: Optional[set] = None) -> Dict[str, Any]:
+    usage: Dict[str, Any] = {}
+    result: Dict[str, Any] = {}
+    tool_calls = 0
+    while True:
+        data = await structured_completion(messages, temperature=0.5, max_tokens=1500)
+        content = data['choices'][0]['message']['content']
+        _add_usage(usage, data.get("usage") or {})
 
-        if response.status_code != 200:
-            print(f"OpenRouter Error: {response.status_code} - {response.text}")
-            raise HTTPException(status_code=response.status_code, detail=f"AI Provider Error: {response.text}")
+        logger.debug("ai_raw_response", content=content[:500])
 
-        data = response.json()
-        content = data['choices'][0]['message']['content']
-        
-        print(f"[AI Raw Response]: {content[:500]}")
-        
-        # Try to parse JSON from content
+        extra = {name: value for name, value in result.items() if name.startswith("search")}
+        result = {**(await finalize_reply(content, usage)), **extra}
+        if service is None or tool_calls >= TOOL_MAX_ITERATIONS:
+            break
         try:
-             # Basic JSON cleanup if model includes markdown
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                content = content.split("```")[1].split("```")[0].strip()
-            
-            parsed_content = json.loads(content)
-            
-            # Ensure message field always exists
-            if not parsed_content.get("message"):
-                # Try to construct a message from action or summary
-                action = parsed_content.get("action")
-                if action:
-                    action_type = action.get("type", "unknown")
-                    if action_type == "summarize":
-                        parsed_content["message"] = action.get("summary", "Here's a summary of your emails.")
-                    elif action_type == "compose":
-                        parsed_content["message"] = f"Composing an email to {action.get('to', 'the recipient')}. Please review and confirm to send."
-                    elif action_type == "open_email":
-                        parsed_content["message"] = "Opening that email for you."
-                    elif action_type == "navigate":
-                        parsed_content["message"] = f"Navigating to {action.get('view', 'the requested view')}."
-                    elif action_type == "send":
-                        parsed_content["message"] = "Sending the email now..."
-                    else:
-                        parsed_content["message"] = f"Performing action: {action_type}"
-                else:
-                    parsed_content["message"] = content  # Fallback to raw content
-            
-            print(f"[AI Parsed]: message={parsed_content.get('message', 'NONE')[:100]}, action={parsed_content.get('action', {}).get('type', 'NONE') if parsed_content.get('action') else 'NONE'}")
-            return parsed_content
-        except json.JSONDecodeError:
-            print(f"Failed to parse JSON: {content}")
-            return {
-                "message": content,
-                "action": None
-            }
+            observation = await run_tool(service, result.get("action") or {}, known_ids, result)
+        except Exception as e:
+            # Leave the action to the frontend, as without the tool loop.
+            logger.error("ai_tool_error", error=str(e))
+            break
+        if observation is None:
+            break
+        tool_calls += 1
+        logger.info("ai_tool", action=result['action']['type'], call=tool_calls)
+        messages = messages + [
+            {"role": "assistant", "content": content},
+            {"role": "user", "content": observation},
+        ]
+
+    result["usage"] = prompt_usage(messages, usage)
+    result["toolCalls"] = tool_calls
+    cache_response(key, result)
+    return result
+
+def session_owner(authorization: Optional[str]) -> Optional[str]:
+    """Key for the user a session belongs to: the bearer token, hashed."""
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    return token_key(authorization[7:])
+
+def open_session(req: AssistantRequest, authorization: Optional[str]) -> Optional[Session]:
+    """The request's session; None without a session id or without a user
+    to scope it to, in which case `history` is used as before."""
+    owner = session_owner(authorization)
+    if not req.sessionId or owner is None:
+        return None
+    if not valid_session_id(req.sessionId):
+        raise HTTPException(status_code=400, detail="Invalid sessionId")
+    session = get_session(owner, req.sessionId)
+    if not session.turns and not session.summary and req.history:
+        # The server lost this session (restart or expiry); the client's
+        # copy of the conversation is better than nothing.
+        session.turns = [(m.role, m.content) for m in req.history[-SESSION_RECENT_MESSAGES:]]
+    return session
+
+def remember(session: Optional[Session], req: AssistantRequest, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Record the exchange in the session, if any, and tag the result with its id."""
+    if session is None:
+        return result
+    current = (req.context.currentEmail if req.context else None) or {}
+    if current.get("id"):
+        session.note_email(current["id"], f"From: {current.get('from', '')} | Subject: {current.get('subject', '')}")
+    record_turn(session, req.message, result)
+    return {**result, "sessionId": session.id}
+
+@router.get("/assistant/cache/stats")
+async def assistant_cache_stats():
+    """Hit/miss counters for the response cache and coalesced duplicate requests."""
+    stats = _responses.stats() if _responses is not None else {"enabled": False}
+    return {**stats, "coalesced": _inflight.shared, "inflight": len(_inflight)}
+
+@router.get("/assistant/output/stats")
+async def assistant_output_stats():
+    """How often completions were malformed, repaired, or unusable."""
+    return output_stats()
+
+@router.get("/assistant/router/stats")
+async def assistant_router_stats():
+    """How many requests the rule-based router answered without the LLM."""
+    return router_stats()
+
+@router.get("/assistant/session/stats")
+async def assistant_session_stats():
+    """How many conversations the server is holding and how they are compacted."""
+    return session_stats()
+
+@router.delete("/assistant/session/{session_id}")
+async def assistant_session_delete(session_id: str, authorization: str = Header(...)):
+    """Forget a conversation, e.g. when the user clears the chat."""
+    owner = session_owner(authorization)
+    if owner is None:
+        raise HTTPException(status_code=401, detail="Invalid authorization header")
+    return {"deleted": drop_session(owner, session_id)}
+
+async def tool_service(authorization: str):
+    """The Gmail service for the tool loop, or None when the credentials are
+    invalid or expired: the assistant then answers without tools instead of
+    failing the whole request."""
+    try:
+        return await get_gmail_service(authorization)
+    except HTTPException as e:
+        if e.status_code != 401:
+            raise
+        logger.warning("ai_tools_unavailable", detail=e.detail)
+        return None
+
+@router.post("/assistant")
+async def chat_assistant(req: AssistantRequest, authorization: Optional[str] = Header(None)):
+    session = open_session(req, authorization)
+    routed = route_intent(req)
+    if routed is not None:
+        return remember(session, req, routed)
+
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise HTTPException(status_code=500, detail="OpenRouter API Key missing")
+
+    service, known_ids = None, set()
+    if authorization and TOOL_LOOP_ENABLED:
+        service = await tool_service(authorization)
+    if service is not None:
+        context = req.context or AIContext()
+        known_ids = {e.id for e in context.emails or []} | {(context.currentEmail or {}).get("id")}
 
+    key = cache_key(req, service.key if service else None, session)
+    cached = cached_response(key)
+    if cached is not None:
+        return remember(session, req, cached)
+
+    messages = build_messages(req, session)
+
+    try:
+        # Identical requests in flight at the same time share one call.
+        result = await _inflight.do(key, lambda: complete(key, messages, service, known_ids))
+        return remember(session, req, result)
+    except OpenRouterError as e:
+        logger.error("openrouter_error", status=e.status_code, detail=e.detail)
+        raise HTTPException(status_code=e.status_code, detail=f"AI Provider Error: {e.detail}")
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"AI Error: {e}")
+        logger.exception("ai_error", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
+
+class EnvelopeStreamParser:
+    """Incrementally scans the streamed `{"action": ..., "message": ...}` envelope.
+
+    `feed()` returns the events that became available with the new text:
+    ("action", value) as soon as the action value is syntactically complete,
+    and ("message", delta) for newly decoded characters of the message string.
+    Anything before the first "{" (e.g. a markdown fence) is skipped.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.finished = False
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.expect_key = False
+        self.key: Optional[str] = None
+        self.value_start: Optional[int] = None
+        self.message_start: Optional[int] = None
+        self.message_sent = 0
+        self.action_done = False
+
+    def feed(self, text: str) -> List[tuple]:
+        events = []
+        self.buffer += text
+        buf = self.buffer
+        while self.pos < len(buf) and not self.finished:
+            ch = buf[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.expect_key:
+                        self.key = buf[self.string_start + 1:self.pos]
+                    elif self.message_start is not None:
+                        events += self._message_delta(buf[self.message_start:self.pos], final=True)
+                        self.message_start = None
+            elif self.depth == 0:
+                if ch == "{":
+                    self.depth = 1
+                    self.expect_key = True
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = self.pos
+                if self.depth == 1 and not self.expect_key and self.key == "message":
+                    self.message_start = self.pos + 1
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    events += self._value_end(self.pos)
+                    self.finished = True
+                elif self.depth == 1:
+                    events += self._value_end(self.pos + 1)
+            elif self.depth == 1 and ch == ":":
+                self.expect_key = False
+                self.value_start = self.pos + 1
+            elif self.depth == 1 and ch == ",":
+                events += self._value_end(self.pos)
+                self.expect_key = True
+                self.key = None
+            self.pos += 1
+        if self.message_start is not None:
+            events += self._message_delta(buf[self.message_start:self.pos])
+        return events
+
+    def _value_end(self, end: int) -> List[tuple]:
+        if self.key != "action" or self.action_done or self.value_start is None:
+            return []
+        try:
+            action = json.loads(self.buffer[self.value_start:end])
+        except json.JSONDecodeError:
+            return []
+        self.action_done = True
+        return [("action", action)]
+
+    def _message_delta(self, raw: str, final: bool = False) -> List[tuple]:
+        if not final:
+            # Never decode a half-received escape sequence.
+            backslash = raw.rfind("\\")
+            if backslash != -1 and len(raw) - backslash <= 6:
+                raw = raw[:backslash]
+        try:
+            decoded = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return []
+        delta = decoded[self.message_sent:]
+        self.message_sent = len(decoded)
+        return [("message", delta)] if delta else []
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/assistant/stream")
+async def chat_assistant_stream(req: AssistantRequest, authorization: Optional[str] = Header(None)):
+    """Server-Sent Events variant of /assistant.
+
+    Emits `token` events with raw model output, `message` events with decoded
+    message text, a single `action` event as soon as the action object is
+    complete, and a final `done` event carrying the same payload /assistant
+    would have returned. Routed and cached answers are replayed without
+    `token` events.
+    """
+    session = open_session(req, authorization)
+    ready = route_intent(req)
+    if ready is None:
+        if not os.getenv("OPENROUTER_API_KEY"):
+            raise HTTPException(status_code=500, detail="OpenRouter API Key missing")
+        key = cache_key(req, session=session)
+        ready = cached_response(key)
+        messages = build_messages(req, session)
+    if ready is not None:
+        ready = remember(session, req, ready)
+
+    async def replay():
+        if ready.get("action"):
+            yield _sse("action", {"action": ready["action"], "elapsedMs": 0})
+        yield _sse("message", {"delta": ready.get("message", "")})
+        yield _sse("done", ready)
+
+    async def events():
+        started = time.monotonic()
+        parser = EnvelopeStreamParser()
+        content = ""
+        usage = {}
+        try:
+            async for delta in structured_stream(messages, temperature=0.5, max_tokens=1500, usage=usage):
+                content += delta
+                yield _sse("token", {"text": delta})
+                for kind, value in parser.feed(delta):
+                    if kind == "action":
+                        if value is not None:
+                            try:
+                                value = ACTION_ADAPTER.validate_python(value).model_dump(exclude_none=True)
+                            except ValidationError:
+                                # Left to the repaired reply in the done event.
+                                continue
+                        elapsed_ms = int((time.monotonic() - started) * 1000)
+                        logger.info("ai_stream_action_ready", elapsed_ms=elapsed_ms)
+                        yield _sse("action", {"action": value, "elapsedMs": elapsed_ms})
+                    else:
+                        yield _sse("message", {"delta": value})
+            logger.debug("ai_raw_response", content=content[:500])
+            result = await finalize_reply(content, usage)
+            result["usage"] = prompt_usage(messages, usage)
+            cache_response(key, result)
+            yield _sse("done", remember(session, req, result))
+        except OpenRouterError as e:
+            logger.error("openrouter_error", status=e.status_code, detail=e.detail)
+            yield _sse("error", {"status": e.status_code, "detail": f"AI Provider Error: {e.detail}"})
+        except Exception as e:
+            logger.exception("ai_error", error=str(e))
+            yield _sse("error", {"status": 500, "detail": str(e)})
+
+    return StreamingResponse(
+        replay() if ready is not None else events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
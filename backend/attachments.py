@@ -0,0 +1,366 @@
+import asyncio
+import base64
+import os
+import re
+import tempfile
+import time
+from typing import AsyncIterator, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+from gmail_service import operation_name, scheduler_for
+from metrics import GMAIL_LATENCY
+from quota import GMAIL_MAX_RETRIES, RETRY_STATUSES, backoff, is_rate_limited_status, request_units
+
+# Attachments are streamed in chunks of this many bytes and never held
+# whole: the base64 "data" field of messages.attachments.get is decoded as
+# it arrives.
+ATTACHMENT_CHUNK_SIZE = int(os.getenv("MAIL_ATTACHMENT_CHUNK_SIZE", 64 * 1024))
+ATTACHMENT_TIMEOUT = float(os.getenv("MAIL_ATTACHMENT_TIMEOUT", 60))
+
+# Downloaded attachments are kept on disk up to this many bytes in total,
+# least recently used first out; 0 turns the cache off.
+ATTACHMENT_CACHE_DIR = os.getenv(
+    "MAIL_ATTACHMENT_CACHE_DIR", os.path.join(os.path.dirname(__file__), "attachment_cache")
+)
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("MAIL_ATTACHMENT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# Content types served as given; anything else (HTML, SVG, XML, scripts)
+# goes out as application/octet-stream so it can never render on our origin.
+SAFE_MEDIA_TYPES = {
+    "application/pdf", "application/zip", "application/gzip", "application/json", "application/msword",
+    "application/vnd.ms-excel", "application/vnd.ms-powerpoint", "text/plain", "text/csv", "text/calendar",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/bmp", "image/heic",
+}
+_SAFE_PREFIXES = ("audio/", "video/")
+
+_SIZE = re.compile(rb'"size"\s*:\s*(\d+)')
+_DATA = re.compile(rb'"data"\s*:\s*"')
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+_client: Optional[httpx.AsyncClient] = None
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=httpx.Timeout(ATTACHMENT_TIMEOUT, connect=10))
+    return _client
+
+async def aclose() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+class Base64Decoder:
+    """Incremental base64url decoder; holds back at most 3 characters between feeds."""
+
+    def __init__(self):
+        self._rest = b""
+
+    def feed(self, data: bytes) -> bytes:
+        data = self._rest + data
+        cut = len(data) - len(data) % 4
+        self._rest = data[cut:]
+        return base64.urlsafe_b64decode(data[:cut])
+
+    def flush(self) -> bytes:
+        rest, self._rest = self._rest, b""
+        return base64.urlsafe_b64decode(rest + b"=" * (-len(rest) % 4)) if rest else b""
+
+class AttachmentCache:
+    """Attachments as files in one directory, evicted least recently used
+    first (by mtime, bumped on every hit) once over `max_bytes`. Blocking;
+    call through asyncio.to_thread."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if max_bytes:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key: str) -> Optional[Tuple[str, int]]:
+        """Path and size of a cached attachment."""
+        if not self.max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path, size
+
+    def writer(self):
+        """A temp file in the cache directory, to be passed to commit() or discard()."""
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix=".partial-")
+        return os.fdopen(fd, "wb"), path
+
+    def commit(self, temp_path: str, key: str) -> None:
+        os.replace(temp_path, self._path(key))
+        self._evict()
+
+    def discard(self, temp_path: str) -> None:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith(".partial-"):
+                stat = entry.stat()
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        files = list(self._entries()) if self.max_bytes else []
+        return {
+            "files": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+attachment_cache = AttachmentCache(ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MAX_BYTES)
+
+class AttachmentTruncated(Exception):
+    """Gmail's response ended before the attachment did. By then the
+    response headers are out, so the download can only be aborted."""
+
+class AttachmentDownload:
+    """An open messages.attachments.get response. Iterate it for the decoded
+    bytes; `size` is known up front when Gmail sends it ahead of the data
+    (it does)."""
+
+    def __init__(self, response: httpx.Response, chunks: AsyncIterator[bytes], first: bytes, size: Optional[int]):
+        self.size = size
+        self._response = response
+        self._chunks = chunks
+        self._first = first
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        decoder = Base64Decoder()
+        try:
+            pending = self._first
+            while True:
+                end = pending.find(b'"')
+                if end >= 0:
+                    out = decoder.feed(pending[:end]) + decoder.flush()
+                    if out:
+                        yield out
+                    return
+                out = decoder.feed(pending)
+                if out:
+                    yield out
+                try:
+                    pending = await self._chunks.__anext__()
+                except StopAsyncIteration:
+                    raise AttachmentTruncated("Attachment response ended early")
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        # Shielded so a cancelled download (client gone) still closes.
+        await asyncio.shield(self._response.aclose())
+
+async def open_attachment(service, message_id: str, attachment_id: str) -> AttachmentDownload:
+    """Start a messages.attachments.get download, reading up to the data.
+
+    Rate-limited and transient failures are retried, and a response without
+    data is a 502, all before anything is returned: once the caller starts
+    streaming, the status can no longer change.
+    """
+    request = service.users().messages().attachments().get(userId='me', messageId=message_id, id=attachment_id)
+    scheduler = scheduler_for(service.key)
+    client = get_client()
+    for attempt in range(GMAIL_MAX_RETRIES + 1):
+        await scheduler.acquire(request_units(request))
+        started = time.perf_counter()
+        try:
+            response = await client.send(
+                client.build_request("GET", request.uri,
+                                     headers={"Authorization": f"Bearer {service.credentials.token}"}),
+                stream=True,
+            )
+        except httpx.HTTPError:
+            GMAIL_LATENCY.observe(time.perf_counter() - started, operation_name(request), "error")
+            raise
+        # Time to the response headers; the body is streamed to the client.
+        GMAIL_LATENCY.observe(time.perf_counter() - started, operation_name(request),
+                              "ok" if response.status_code == 200 else str(response.status_code))
+        if response.status_code == 200:
+            break
+        content = await response.aread()
+        await response.aclose()
+        rate_limited = is_rate_limited_status(response.status_code, content)
+        if not (rate_limited or response.status_code in RETRY_STATUSES) or attempt == GMAIL_MAX_RETRIES:
+            raise HTTPException(status_code=response.status_code, detail=content.decode(errors="replace"))
+        if rate_limited:
+            scheduler.observe(1, 1)
+        scheduler.retried += 1
+        await asyncio.sleep(backoff(attempt))
+
+    chunks = response.aiter_bytes(ATTACHMENT_CHUNK_SIZE)
+    head = b""
+    try:
+        while (match := _DATA.search(head)) is None:
+            head += await chunks.__anext__()
+    except StopAsyncIteration:
+        await response.aclose()
+        raise HTTPException(status_code=502, detail="Attachment response has no data")
+    except BaseException:
+        await response.aclose()
+        raise
+    size = _SIZE.search(head[:match.start()])
+    return AttachmentDownload(response, chunks, head[match.end():], int(size.group(1)) if size else None)
+
+def safe_media_type(media_type: Optional[str]) -> str:
+    """`media_type` if it is one we are willing to serve, else application/octet-stream."""
+    media_type = (media_type or "").split(";")[0].strip().lower()
+    if media_type in SAFE_MEDIA_TYPES or media_type.startswith(_SAFE_PREFIXES):
+        return media_type
+    return "application/octet-stream"
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) of a single-range `Range` header, None to serve
+    everything (no header, or one we do not support); 416 if unsatisfiable."""
+    match = _RANGE.match((header or "").strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def _slice(chunks, start: int, end: int) -> AsyncIterator[bytes]:
+    """Bytes start..end (inclusive) of a chunk stream."""
+    offset = 0
+    try:
+        async for chunk in chunks:
+            lo, hi = max(start - offset, 0), min(end + 1 - offset, len(chunk))
+            offset += len(chunk)
+            if lo < hi:
+                yield chunk[lo:hi]
+            if offset > end:
+                break
+    finally:
+        # Stops the upstream download instead of reading it to the end.
+        await chunks.aclose()
+
+async def _read_file(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, ATTACHMENT_CHUNK_SIZE):
+            yield chunk
+
+async def _tee(chunks, key: str, size: int) -> AsyncIterator[bytes]:
+    """Pass chunks through while writing them to the cache; only complete
+    downloads are committed."""
+    f, temp_path = await asyncio.to_thread(attachment_cache.writer)
+    written, complete = 0, False
+    try:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+            written += len(chunk)
+            yield chunk
+        complete = written == size
+    finally:
+        f.close()
+        if not complete:
+            # Inline rather than in a thread: this also runs on cancellation,
+            # when awaiting may be cut short.
+            attachment_cache.discard(temp_path)
+        await chunks.aclose()
+    if complete:
+        await asyncio.to_thread(attachment_cache.commit, temp_path, key)
+
+class AttachmentStream(StreamingResponse):
+    """A StreamingResponse that closes its body iterator however it ends,
+    so a client that goes away releases the Gmail download and any partial
+    cache file at once rather than at garbage collection."""
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+async def attachment_response(service, key: str, message_id: str, attachment_id: str,
+                              range_header: Optional[str], filename: Optional[str],
+                              media_type: Optional[str]) -> Response:
+    """Stream an attachment from the disk cache or Gmail, honouring Range.
+
+    `key` names the cache entry and must be unique per mailbox, message and
+    attachment.
+    """
+    # Always a download, never rendered inline, whatever the client asked for.
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=86400",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename or 'attachment')}",
+        "X-Content-Type-Options": "nosniff",
+    }
+    media_type = safe_media_type(media_type)
+
+    cached = await asyncio.to_thread(attachment_cache.lookup, key)
+    if cached is not None:
+        path, size = cached
+        chunks = _read_file(path)
+    else:
+        chunks = await open_attachment(service, message_id, attachment_id)
+        size = chunks.size
+
+    try:
+        byte_range = parse_range(range_header, size) if size is not None else None
+    except HTTPException:
+        await chunks.aclose()
+        raise
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return AttachmentStream(_slice(chunks, start, end), status_code=206, media_type=media_type,
+                                headers=headers)
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    if cached is None and 0 < (size or 0) <= attachment_cache.max_bytes:
+        chunks = _tee(chunks, key, size)
+    return AttachmentStream(chunks, media_type=media_type, headers=headers)
+
+def attachment_stats() -> dict:
+    return attachment_cache.stats()
@@ -1,9 +1,14 @@
-from fastapi import APIRouter, Request, HTTPException
+from fastapi import APIRouter, Request, HTTPException, Header
 from fastapi.responses import RedirectResponse, JSONResponse
 from google_auth_oauthlib.flow import Flow
+from typing import Optional
 import os
 import json
 
+from credential_store import credential_store, is_session
+from gmail_service import get_service
+from sync import get_profile
+
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 # HTTP for local dev
@@ -68,13 +73,33 @@ async def callback(code: str):
         else:
             expires_in = 3600
         
+        # Keep the refresh token here so the backend can refresh the access
+        # token ahead of expiry; the frontend gets an opaque session handle.
+        profile = await get_profile(get_service(credentials.token))
+        session = await credential_store.login(
+            profile['emailAddress'], credentials.token, credentials.refresh_token, expires_in
+        )
+
         content = {
             "access_token": credentials.token,
-            "refresh_token": credentials.refresh_token,
             "expires_in": expires_in,
+            "session": session,
         }
         
         return JSONResponse(content)
         
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
+
+@router.post("/logout")
+async def logout(authorization: Optional[str] = Header(None)):
+    """Forget the session handle in the Authorization header, if any."""
+    token = (authorization or "").removeprefix("Bearer ")
+    if is_session(token):
+        await credential_store.logout(token)
+    return {"success": True}
+
+@router.get("/credentials/stats")
+async def credential_stats():
+    """Background token refreshes so far, and requests that had to wait for one."""
+    return credential_store.stats()
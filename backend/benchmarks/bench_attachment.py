@@ -0,0 +1,81 @@
+"""Memory benchmark: streamed attachment download against messages.attachments.get.execute().
+
+Downloads attachments of growing size from the fake Gmail server in
+fake_gmail.py, once the googleapiclient way (parse the JSON, decode the
+base64 string) and once through attachments.open_attachment(), and
+reports the peak Python memory of each. The streamed peak should not grow
+with the attachment. Run from the backend directory:
+
+    python benchmarks/bench_attachment.py [--sizes-mb 1 8 32]
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import attachments  # noqa: E402
+import fake_gmail  # noqa: E402
+import gmail_service  # noqa: E402
+
+def expected_digest(size: int) -> str:
+    digest = hashlib.sha256()
+    for chunk in fake_gmail.attachment_bytes(size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+async def download_whole(service, attachment_id: str) -> str:
+    response = await service.execute(
+        service.users().messages().attachments().get(userId="me", messageId="m1", id=attachment_id)
+    )
+    return hashlib.sha256(base64.urlsafe_b64decode(response["data"])).hexdigest()
+
+async def download_streamed(service, attachment_id: str) -> str:
+    digest = hashlib.sha256()
+    async for chunk in await attachments.open_attachment(service, "m1", attachment_id):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+async def measure(fn, service, size: int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    digest = await fn(service, f"bytes-{size}")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert digest == expected_digest(size), f"{fn.__name__} returned the wrong bytes"
+    return peak, elapsed
+
+async def run(sizes):
+    service = gmail_service.get_service("bench-token")
+    # Warm up both paths so one-time setup (TLS context, discovery) is not measured.
+    await download_whole(service, "bytes-1")
+    await download_streamed(service, "bytes-1")
+    print(f"{'size':>8} {'execute() peak':>16} {'streamed peak':>15} {'execute() time':>15} {'streamed time':>14}")
+    for size_mb in sizes:
+        size = int(size_mb * 1024 * 1024)
+        whole_peak, whole_time = await measure(download_whole, service, size)
+        stream_peak, stream_time = await measure(download_streamed, service, size)
+        print(f"{size_mb:>6}MB {whole_peak / 2**20:>14.1f}MB {stream_peak / 2**20:>13.2f}MB "
+              f"{whole_time:>14.2f}s {stream_time:>13.2f}s")
+    await attachments.aclose()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+
+    mailbox = fake_gmail.FakeMailbox(1, quota_rate=1000, error_rate=0)
+    server = fake_gmail.start(mailbox)
+    gmail_service.GMAIL_DISCOVERY_DOC["rootUrl"] = f"http://127.0.0.1:{server.server_address[1]}/"
+    asyncio.run(run(args.sizes_mb))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
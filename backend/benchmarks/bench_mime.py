@@ -0,0 +1,170 @@
+"""Micro-benchmark: mime.extract_body against the old recursive extractor.
+
+Builds Gmail API payloads for MIME layouts seen in real mailboxes and times
+both extractors on each. Run from the backend directory:
+
+    python benchmarks/bench_mime.py [--max-bytes N] [--repeat N]
+"""
+import argparse
+import base64
+import os
+import sys
+import timeit
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mime import extract_body  # noqa: E402
+
+def legacy_extract_body(payload):
+    """The extractor mail.py used before mime.py, kept for comparison."""
+    body_html = ""
+    body_text = ""
+    mime_type = payload.get('mimeType', '')
+    if 'body' in payload and payload['body'].get('data'):
+        decoded = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='replace')
+        if 'html' in mime_type:
+            body_html = decoded
+        else:
+            body_text = decoded
+    if 'parts' in payload:
+        for part in payload['parts']:
+            part_mime = part.get('mimeType', '')
+            if part_mime == 'text/html':
+                if part.get('body', {}).get('data'):
+                    body_html = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
+            elif part_mime == 'text/plain':
+                if part.get('body', {}).get('data'):
+                    body_text = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
+            elif 'multipart' in part_mime:
+                sub_html, sub_text = _legacy_recursive(part)
+                if sub_html:
+                    body_html = sub_html
+                if sub_text and not body_text:
+                    body_text = sub_text
+    return body_html, body_text
+
+def _legacy_recursive(payload):
+    html = ""
+    text = ""
+    for part in payload.get('parts', []):
+        part_mime = part.get('mimeType', '')
+        if part_mime == 'text/html' and part.get('body', {}).get('data'):
+            html = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
+        elif part_mime == 'text/plain' and part.get('body', {}).get('data'):
+            text = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
+        elif 'multipart' in part_mime:
+            sub_html, sub_text = _legacy_recursive(part)
+            if sub_html:
+                html = sub_html
+            if sub_text and not text:
+                text = sub_text
+    return html, text
+
+def to_gmail_payload(msg, part_id=""):
+    """Convert an email.message tree into the users.messages.get payload shape."""
+    payload = {
+        "partId": part_id,
+        "mimeType": msg.get_content_type(),
+        "filename": msg.get_filename() or "",
+        "headers": [{"name": k, "value": str(v)} for k, v in msg.items()],
+    }
+    if msg.is_multipart():
+        payload["body"] = {"size": 0}
+        payload["parts"] = [
+            to_gmail_payload(sub, f"{part_id}.{i}" if part_id else str(i))
+            for i, sub in enumerate(msg.iter_parts())
+        ]
+        return payload
+    raw = msg.get_payload(decode=True) or b""
+    if payload["filename"]:
+        # Gmail never inlines attachment data in messages.get.
+        payload["body"] = {"size": len(raw), "attachmentId": f"ATT-{part_id}"}
+    else:
+        payload["body"] = {"size": len(raw), "data": base64.urlsafe_b64encode(raw).decode()}
+    return payload
+
+def _html(kb):
+    row = "<tr><td style='padding:8px'>Deal of the day &mdash; save 40% on everything</td></tr>"
+    return "<html><body><table>" + row * (kb * 1024 // len(row)) + "</table></body></html>"
+
+def build_corpus():
+    corpus = {}
+
+    m = EmailMessage()
+    m["Subject"] = "plain"
+    m.set_content("Hi,\n\nSee you at 10.\n\n-- \nAlex\n" * 20)
+    corpus["text/plain only"] = m
+
+    m = EmailMessage()
+    m["Subject"] = "alternative"
+    m.set_content("Short plain version of the newsletter.")
+    m.add_alternative(_html(40), subtype="html")
+    corpus["alternative, 40 KB html"] = m
+
+    m = EmailMessage()
+    m["Subject"] = "newsletter"
+    m.set_content("Plain fallback.")
+    m.add_alternative(_html(3 * 1024), subtype="html")
+    corpus["alternative, 3 MB html"] = m
+
+    m = EmailMessage()
+    m["Subject"] = "related"
+    m.set_content("Receipt attached.")
+    m.add_alternative(_html(20), subtype="html")
+    html_part = m.get_payload()[1]
+    for i in range(4):
+        html_part.add_related(os.urandom(30 * 1024), "image", "png", cid=f"<img{i}>", filename=f"logo{i}.png")
+    corpus["related, 4 inline images"] = m
+
+    m = EmailMessage()
+    m["Subject"] = "mixed"
+    m.set_content("Please find the report attached.")
+    m.add_alternative("<p>Please find the report attached.</p>", subtype="html")
+    m.add_attachment(os.urandom(2 * 1024 * 1024), maintype="application", subtype="pdf", filename="report.pdf")
+    m.add_attachment(b"a,b,c\n" * 10000, maintype="text", subtype="csv", filename="data.csv")
+    corpus["mixed, 2 MB pdf + csv"] = m
+
+    inner = EmailMessage()
+    inner["Subject"] = "original"
+    inner.set_content("Original message text " * 200)
+    inner.add_alternative(_html(60), subtype="html")
+    m = EmailMessage()
+    m["Subject"] = "Fwd: original"
+    m.set_content("FYI, see below.")
+    m.add_alternative("<p>FYI, see below.</p>", subtype="html")
+    m.make_mixed()
+    m.attach(inner)
+    corpus["forwarded, nested alternative"] = m
+
+    m = EmailMessage()
+    m["Subject"] = "latin-1"
+    m.set_content("Café crème brûlée. " * 200, charset="iso-8859-1")
+    corpus["text/plain latin-1"] = m
+
+    m = EmailMessage()
+    m["Subject"] = "invite"
+    m.set_content("You have been invited.")
+    m.add_alternative("<p>You have been invited.</p>", subtype="html")
+    m.add_attachment("BEGIN:VCALENDAR\nEND:VCALENDAR\n" * 50, subtype="calendar", filename="invite.ics")
+    corpus["calendar invite"] = m
+
+    return {name: to_gmail_payload(msg) for name, msg in corpus.items()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-bytes", type=int, default=None, help="truncation limit for mime.extract_body")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = build_corpus()
+    print(f"{'structure':34} {'legacy (ms)':>12} {'mime (ms)':>10} {'speedup':>8} {'attachments':>12}")
+    for name, payload in corpus.items():
+        number = 20
+        legacy = min(timeit.repeat(lambda: legacy_extract_body(payload), number=number, repeat=args.repeat)) / number
+        new = min(timeit.repeat(lambda: extract_body(payload, args.max_bytes), number=number, repeat=args.repeat)) / number
+        found = len(extract_body(payload, args.max_bytes).attachments)
+        print(f"{name:34} {legacy * 1000:12.3f} {new * 1000:10.3f} {legacy / new:7.1f}x {found:12d}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Memory benchmark: sending a large message as a media upload against a base64 `raw` body.
+
+Sends a message with one attachment to the fake Gmail server in
+fake_gmail.py, once the way mail.py used to (EmailMessage.as_bytes(),
+urlsafe_b64encode into a JSON `raw` field) and once through
+outgoing.build_message() and a resumable media upload, and reports the
+peak Python memory of each. The attachment is read from a file, as an
+upload spooled by the /compose endpoint would be. Run from the backend
+directory:
+
+    python benchmarks/bench_send.py [--size-mb 20]
+"""
+import argparse
+import asyncio
+import base64
+import email
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from email import policy
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import fake_gmail  # noqa: E402
+import gmail_service  # noqa: E402
+from outgoing import build_message, upload_request  # noqa: E402
+
+async def send_raw(service, path: str):
+    message = EmailMessage()
+    message.set_content("See attached.")
+    message['To'] = "someone@example.com"
+    message['Subject'] = "Large attachment"
+    with open(path, "rb") as f:
+        message.add_attachment(f.read(), maintype="application", subtype="octet-stream", filename="data.bin")
+    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+    await service.execute(service.users().messages().send(userId="me", body={"raw": raw}))
+
+async def send_upload(service, path: str):
+    with open(path, "rb") as f:
+        message, size = await asyncio.to_thread(
+            build_message, "someone@example.com", "Large attachment", "See attached.",
+            [("data.bin", "application/octet-stream", f)],
+        )
+    with message:
+        await service.execute(upload_request(service, message, size))
+
+def received_attachment_digest(mailbox) -> str:
+    message = email.message_from_bytes(mailbox.sent_message(), policy=policy.default)
+    return hashlib.sha256(next(message.iter_attachments()).get_content()).hexdigest()
+
+async def run(mailbox, size: int):
+    service = gmail_service.get_service("bench-token")
+    with tempfile.NamedTemporaryFile() as attachment:
+        digest = hashlib.sha256()
+        for _ in range(size // (1024 * 1024)):
+            chunk = os.urandom(1024 * 1024)
+            digest.update(chunk)
+            attachment.write(chunk)
+        attachment.flush()
+
+        # Warm up both paths so one-time setup is not measured.
+        await send_raw(service, os.devnull)
+        await send_upload(service, os.devnull)
+
+        print(f"{size / 2**20:.0f} MB attachment")
+        for name, send in (("base64 raw", send_raw), ("media upload", send_upload)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            await send(service, attachment.name)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            kind, path = mailbox.sent[-1]
+            assert received_attachment_digest(mailbox) == digest.hexdigest(), f"{name}: attachment corrupted"
+            print(f"{name:>13}: peak {peak / 2**20:6.1f} MB, {elapsed:.2f}s, "
+                  f"{os.path.getsize(path) / 2**20:.1f} MB sent as {kind}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=20)
+    args = parser.parse_args()
+
+    mailbox = fake_gmail.FakeMailbox(1, quota_rate=1000, error_rate=0)
+    server = fake_gmail.start(mailbox)
+    gmail_service.GMAIL_DISCOVERY_DOC["rootUrl"] = f"http://127.0.0.1:{server.server_address[1]}/"
+    try:
+        asyncio.run(run(mailbox, args.size_mb * 1024 * 1024))
+    finally:
+        for _, path in mailbox.sent:
+            os.remove(path)
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
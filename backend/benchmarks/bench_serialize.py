@@ -0,0 +1,105 @@
+"""Micro-benchmark: building and serializing a message listing.
+
+Compares the old path (a dict per message built with one header scan per
+field, rendered through FastAPI's jsonable_encoder and json.dumps) with
+ParsedMessage rendered by FastJSONResponse. Run from the backend directory:
+
+    python benchmarks/bench_serialize.py [--messages N] [--with-body] [--repeat N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+from message import FastJSONResponse, ParsedMessage  # noqa: E402
+
+def legacy_parse(msg, body=None):
+    """The dict mail.parse_message built before message.py, kept for comparison."""
+    headers = msg['payload']['headers']
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '(no subject)')
+    msg_from = next((h['value'] for h in headers if h['name'] == 'From'), '(unknown)')
+    msg_to = next((h['value'] for h in headers if h['name'] == 'To'), '')
+    date = next((h['value'] for h in headers if h['name'] == 'Date'), '')
+    email = {
+        "id": msg['id'],
+        "threadId": msg['threadId'],
+        "labelIds": msg.get('labelIds', []),
+        "snippet": msg.get('snippet', ''),
+        "subject": subject,
+        "from": msg_from,
+        "to": msg_to,
+        "date": date,
+        "internalDate": int(msg.get('internalDate', 0)),
+        "isRead": 'UNREAD' not in msg.get('labelIds', []),
+    }
+    if body is not None:
+        email.update(body)
+    return email
+
+def legacy_render(content):
+    # What JSONResponse does for a route returning plain Python objects.
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+def build_listing(count):
+    messages = []
+    for i in range(count):
+        # Full-format messages carry every header, so the ones we want are
+        # scattered among Received/DKIM/List-* noise.
+        headers = [{"name": "Received", "value": f"from mx{j}.example.com by relay"} for j in range(6)]
+        headers += [
+            {"name": "DKIM-Signature", "value": "v=1; a=rsa-sha256; d=example.com; " + "x" * 300},
+            {"name": "Date", "value": "Tue, 14 Oct 2025 09:12:44 +0000"},
+            {"name": "From", "value": f"Sender {i} <sender{i}@example.com>"},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Message-ID", "value": f"<{i}@example.com>"},
+            {"name": "List-Unsubscribe", "value": "<mailto:unsub@example.com>"},
+            {"name": "Subject", "value": f"Weekly digest #{i}: what's new in your projects"},
+        ]
+        messages.append({
+            "id": f"18c{i:013x}",
+            "threadId": f"18c{i // 3:013x}",
+            "labelIds": ["INBOX", "CATEGORY_UPDATES"] + (["UNREAD"] if i % 3 else []),
+            "snippet": "Here is what happened this week across the repositories you follow " * 2,
+            "internalDate": str(1760000000000 + i * 60000),
+            "payload": {"mimeType": "multipart/alternative", "headers": headers},
+        })
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--with-body", action="store_true", help="include a 20 KB html/text body per message")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    raw = build_listing(args.messages)
+    body = None
+    if args.with_body:
+        body = {"bodyHtml": "<p>digest</p>" * 1500, "bodyText": "digest " * 1500, "attachments": []}
+
+    def legacy():
+        return legacy_render([legacy_parse(m, body) for m in raw])
+
+    def fast():
+        return FastJSONResponse([ParsedMessage.from_gmail(m, body) for m in raw]).body
+
+    assert json.loads(legacy()) == json.loads(fast()), "outputs differ"
+
+    number = 10
+    print(f"{'path':30} {'parse+render (ms)':>18} {'bytes':>10}")
+    results = {}
+    for name, fn in (("dict + jsonable_encoder", legacy), ("ParsedMessage + orjson", fast)):
+        results[name] = min(timeit.repeat(fn, number=number, repeat=args.repeat)) / number
+        print(f"{name:30} {results[name] * 1000:18.2f} {len(fn()):10d}")
+    old, new = results.values()
+    print(f"speedup: {old / new:.1f}x for {args.messages} messages")
+
+if __name__ == "__main__":
+    main()
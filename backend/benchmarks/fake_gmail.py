@@ -0,0 +1,379 @@
+"""Fake Gmail API server that rate limits like the real one, and a fetch benchmark.
+
+Serves just enough of the Gmail API for message listings: users.getProfile,
+messages.list, messages.get, messages.trash and batch requests, plus
+messages.attachments.get for attachment ids of the form "bytes-<n>": n bytes
+of attachment_bytes(), streamed without ever being held in memory.
+messages.send and drafts.create accept JSON `raw` bodies and simple,
+multipart and resumable media uploads; request bodies are spooled to temp
+files (see FakeMailbox.sent_message()).
+
+Every request is charged its quota units against a per-user bucket of
+--quota units per second; a request the bucket cannot cover gets a 429
+rateLimitExceeded, as does a random --error-rate fraction of the rest.
+Batched sub-requests are charged and rejected one by one, so a batch can
+partly succeed.
+
+Point a GmailService at it by changing the discovery document's rootUrl
+before the service is built (see main()). Run from the backend directory
+to fetch a mailbox with the quota scheduler and with plain fixed-size
+batches:
+
+    python benchmarks/fake_gmail.py [--messages N] [--quota UNITS] [--error-rate P]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gmail_service  # noqa: E402
+import quota  # noqa: E402
+
+RATE_LIMITED = {"error": {"code": 429, "message": "User-rate limit exceeded",
+                          "errors": [{"reason": "rateLimitExceeded", "domain": "usageLimits"}]}}
+
+# Attachments repeat this block; its length is a multiple of 3, so its
+# base64 can be precomputed and repeated too.
+ATTACHMENT_BLOCK = bytes(i % 251 for i in range(3 * 2 ** 16))
+_ATTACHMENT_BLOCK_B64 = base64.urlsafe_b64encode(ATTACHMENT_BLOCK)
+
+def attachment_bytes(size: int):
+    """The content of attachment "bytes-<size>", as an iterator of chunks."""
+    for offset in range(0, size, len(ATTACHMENT_BLOCK)):
+        yield ATTACHMENT_BLOCK[:size - offset]
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+class FakeMailbox:
+    """Messages, the quota bucket and counters shared by all requests."""
+
+    def __init__(self, messages: int, quota_rate: float, error_rate: float):
+        self.messages = {}
+        for i in range(messages):
+            msg_id = f"m{i:05d}"
+            self.messages[msg_id] = {
+                "id": msg_id, "threadId": f"t{i // 3}", "labelIds": ["INBOX"], "snippet": f"Message {i}",
+                "internalDate": str(1700000000000 + i * 1000), "historyId": "1000",
+                "payload": {"mimeType": "text/plain", "headers": [
+                    {"name": "Subject", "value": f"Subject {i}"},
+                    {"name": "From", "value": f"sender{i}@example.com"},
+                    {"name": "To", "value": "me@example.com"},
+                    {"name": "Date", "value": "Mon, 1 Jan 2024 10:00:00 +0000"},
+                ], "body": {"data": _b64(f"Body of message {i}")}},
+            }
+        self.ids = sorted(self.messages, reverse=True)
+        self.quota_rate = quota_rate
+        self.error_rate = error_rate
+        self.tokens = quota_rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.rejected = 0
+        self.injected = 0
+        # Received messages as (upload kind, path of the spooled request body).
+        self.sent = []
+        self.content_types = {}
+        self.sessions = {}
+        # [path fragment, status, times left] for fail().
+        self.faults = []
+        # q= of every messages.list call.
+        self.list_queries = []
+
+    def sent_message(self, index: int = -1) -> bytes:
+        """The RFC 822 bytes of a received message, however it was uploaded."""
+        kind, path = self.sent[index]
+        with open(path, "rb") as f:
+            data = f.read()
+        if kind == "raw":
+            return base64.urlsafe_b64decode(json.loads(data)["raw"])
+        if kind == "multipart":
+            # multipart/related: JSON metadata, then the message.
+            boundary = re.search(r'boundary="?([^";]+)', self.content_types[path]).group(1).encode()
+            part = data.split(b"--" + boundary)[2]
+            body = re.split(rb"\r?\n\r?\n", part, maxsplit=1)[1]
+            return re.sub(rb"\r?\n$", b"", body)
+        return data
+
+    def fail(self, status: int, times: int = 1, path: str = "") -> None:
+        """Answer the next `times` requests whose path contains `path` with
+        `status`. A failed send or draft is still stored, as when Gmail fails
+        after accepting the message, unless the status is a 429."""
+        with self.lock:
+            self.faults.append([path, status, times])
+
+    def fault(self, path: str):
+        with self.lock:
+            for fault in self.faults:
+                if fault[0] in path and fault[2] > 0:
+                    fault[2] -= 1
+                    return fault[1]
+        return None
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.requests = self.batches = self.rejected = self.injected = 0
+            self.tokens = self.quota_rate
+            self.updated = time.monotonic()
+
+    def charge(self, units: int) -> bool:
+        """Take `units` from the bucket; False means the request is rate limited."""
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.tokens = min(self.quota_rate, self.tokens + (now - self.updated) * self.quota_rate)
+            self.updated = now
+            if random.random() < self.error_rate:
+                self.injected += 1
+                return False
+            if self.tokens < units:
+                self.rejected += 1
+                return False
+            self.tokens -= units
+            return True
+
+    def handle(self, method: str, path: str, query: dict):
+        if path.endswith("/profile"):
+            units, result = 1, (200, {"emailAddress": "me@example.com", "historyId": "1000"})
+        elif path.endswith("/messages") and method == "GET":
+            size = int(query.get("maxResults", ["100"])[0])
+            start = int(query.get("pageToken", ["0"])[0])
+            self.list_queries.append(query.get("q", [None])[0])
+            page = {"messages": [{"id": i, "threadId": self.messages[i]["threadId"]}
+                                 for i in self.ids[start:start + size]]}
+            if start + size < len(self.ids):
+                page["nextPageToken"] = str(start + size)
+            units, result = 5, (200, page)
+        elif (match := re.search(r"/messages/([^/]+)$", path)) and method == "GET":
+            msg = self.messages.get(match.group(1))
+            if msg is None:
+                result = (404, {"error": {"code": 404, "message": "Requested entity was not found."}})
+            elif query.get("format", ["full"])[0] == "metadata":
+                result = (200, {**msg, "payload": {k: v for k, v in msg["payload"].items() if k != "body"}})
+            else:
+                result = (200, msg)
+            units = 5
+        elif (match := re.search(r"/messages/([^/]+)/trash$", path)) and method == "POST":
+            msg = self.messages.get(match.group(1))
+            if msg is None:
+                result = (404, {"error": {"code": 404, "message": "Requested entity was not found."}})
+            else:
+                msg["labelIds"] = [l for l in msg["labelIds"] if l != "INBOX"] + ["TRASH"]
+                result = (200, {"id": msg["id"], "threadId": msg["threadId"], "labelIds": msg["labelIds"]})
+            units = 5
+        else:
+            return 404, {"error": {"code": 404, "message": path}}
+        if status := self.fault(path):
+            return status, {"error": {"code": status, "message": "Injected failure"}}
+        if not self.charge(units):
+            return 429, RATE_LIMITED
+        return result
+
+def _handler(mailbox: FakeMailbox):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, code, body, content_type="application/json"):
+            data = body if isinstance(body, bytes) else json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            attachment = re.search(r"/attachments/bytes-(\d+)$", url.path)
+            if attachment:
+                self.send_attachment(int(attachment.group(1)))
+            else:
+                self.reply(*mailbox.handle("GET", url.path, parse_qs(url.query)))
+
+        def send_attachment(self, size: int):
+            if not mailbox.charge(5):
+                self.reply(429, RATE_LIMITED)
+                return
+            full, rest = divmod(size, len(ATTACHMENT_BLOCK))
+            tail = base64.urlsafe_b64encode(ATTACHMENT_BLOCK[:rest])
+            head = f'{{\n  "size": {size},\n  "data": "'.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(head) + full * len(_ATTACHMENT_BLOCK_B64) + len(tail) + 3))
+            self.end_headers()
+            self.wfile.write(head)
+            for _ in range(full):
+                self.wfile.write(_ATTACHMENT_BLOCK_B64)
+            self.wfile.write(tail + b'"\n}')
+
+        def spool(self, path=None):
+            """Copy the request body to a file (a new temp file by default) in
+            1 MB chunks; returns its path."""
+            if path is None:
+                fd, path = tempfile.mkstemp(prefix="fake-gmail-")
+                os.close(fd)
+            remaining = int(self.headers.get("Content-Length", 0))
+            with open(path, "ab") as f:
+                while remaining:
+                    chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            return path
+
+        def sent_reply(self, kind, path, status=None):
+            mailbox.sent.append((kind, path))
+            if status:
+                self.reply(status, {"error": {"code": status, "message": "Injected failure"}})
+                return
+            self.reply(200, {"id": f"sent{len(mailbox.sent)}", "threadId": "t-sent", "labelIds": ["SENT"]})
+
+        def do_PUT(self):
+            # Resumable upload chunk: "Content-Range: bytes first-last/total".
+            session = mailbox.sessions.get(urlparse(self.path).path.rsplit("/", 1)[-1])
+            if session is None:
+                self.reply(404, {})
+                return
+            self.spool(session["path"])
+            received = os.path.getsize(session["path"])
+            total = re.search(r"/(\d+|\*)$", self.headers.get("Content-Range", ""))
+            if total and total.group(1) != "*" and received >= int(total.group(1)):
+                del mailbox.sessions[session["id"]]
+                self.sent_reply("resumable", session["path"])
+                return
+            self.send_response(308)
+            self.send_header("Range", f"bytes=0-{received - 1}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path.endswith(("/messages/send", "/drafts")):
+                status = mailbox.fault(url.path)
+                if status == 429 or not mailbox.charge(100 if url.path.endswith("/send") else 10):
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    self.reply(429, RATE_LIMITED)
+                    return
+                upload_type = parse_qs(url.query).get("uploadType", ["raw"])[0]
+                if status and upload_type == "resumable":
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    self.reply(status, {"error": {"code": status, "message": "Injected failure"}})
+                    return
+                if upload_type == "resumable":
+                    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    session_id = uuid.uuid4().hex
+                    fd, path = tempfile.mkstemp(prefix="fake-gmail-")
+                    os.close(fd)
+                    mailbox.sessions[session_id] = {"id": session_id, "path": path}
+                    self.send_response(200)
+                    self.send_header("Location", f"http://{self.headers['Host']}/upload/session/{session_id}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                path = self.spool()
+                mailbox.content_types[path] = self.headers.get("Content-Type", "")
+                self.sent_reply(upload_type if upload_type in ("media", "multipart") else "raw", path, status)
+                return
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            if url.path.endswith("/trash"):
+                self.reply(*mailbox.handle("POST", url.path, parse_qs(url.query)))
+                return
+            if not url.path.startswith("/batch"):
+                self.reply(404, {})
+                return
+            with mailbox.lock:
+                mailbox.batches += 1
+            boundary = re.search(r'boundary="?([^";]+)', self.headers["Content-Type"]).group(1)
+            out = []
+            for part in data.split("--" + boundary):
+                content_id = re.search(r"Content-ID: <(.*?)>", part)
+                request = re.search(r"(GET|POST) (\S+) HTTP", part)
+                if not content_id or not request:
+                    continue
+                sub_url = urlparse(request.group(2))
+                code, body = mailbox.handle(request.group(1), sub_url.path, parse_qs(sub_url.query))
+                out.append(f"--batch_boundary\r\nContent-Type: application/http\r\n"
+                           f"Content-ID: <response-{content_id.group(1)}>\r\n\r\n"
+                           f"HTTP/1.1 {code} X\r\nContent-Type: application/json\r\n\r\n{json.dumps(body)}\r\n")
+            out.append("--batch_boundary--\r\n")
+            self.reply(200, "".join(out).encode(), "multipart/mixed; boundary=batch_boundary")
+
+    return Handler
+
+def start(mailbox: FakeMailbox, port: int = 0) -> ThreadingHTTPServer:
+    """Serve `mailbox` on 127.0.0.1 in a background thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _handler(mailbox))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+async def fetch_fixed(service, ids, batch_size: int) -> int:
+    """The previous fetch: fixed-size batches all at once, failures dropped."""
+    fetched = 0
+
+    def callback(request_id, response, exception):
+        nonlocal fetched
+        fetched += exception is None
+
+    batches = []
+    for i in range(0, len(ids), batch_size):
+        batch = service.new_batch_http_request(callback=callback)
+        for msg_id in ids[i:i + batch_size]:
+            batch.add(service.users().messages().get(userId="me", id=msg_id, format="full"), request_id=msg_id)
+        batches.append(service._run(batch))
+    await asyncio.gather(*batches)
+    return fetched
+
+async def fetch_scheduled(service, ids) -> int:
+    responses = await service.execute_batch(
+        {msg_id: service.users().messages().get(userId="me", id=msg_id, format="full") for msg_id in ids}
+    )
+    return len(responses)
+
+async def run(mailbox: FakeMailbox, pages: int, page_size: int):
+    for name in ("fixed batches", "quota scheduler"):
+        mailbox.reset_counters()
+        # A fresh token per run, so each starts with its own scheduler.
+        service = gmail_service.get_service(f"fake-token-{name}")
+        start_time = time.perf_counter()
+        fetched = 0
+        for page in range(pages):
+            ids = mailbox.ids[page * page_size:(page + 1) * page_size]
+            if name == "fixed batches":
+                fetched += await fetch_fixed(service, ids, quota.GMAIL_BATCH_SIZE)
+            else:
+                fetched += await fetch_scheduled(service, ids)
+        elapsed = time.perf_counter() - start_time
+        print(f"{name}: {fetched}/{pages * page_size} messages in {elapsed:.2f}s, "
+              f"{mailbox.batches} batch calls, {mailbox.rejected} over quota, {mailbox.injected} injected 429s")
+        if name == "quota scheduler":
+            print(f"  scheduler: {gmail_service.scheduler_for(service.key).stats()}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--quota", type=float, default=250, help="units per second the fake allows")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="fraction of requests given a random 429")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+
+    mailbox = FakeMailbox(args.messages, args.quota, args.error_rate)
+    server = start(mailbox, args.port)
+    gmail_service.GMAIL_DISCOVERY_DOC["rootUrl"] = f"http://127.0.0.1:{server.server_address[1]}/"
+    asyncio.run(run(mailbox, args.messages // args.page_size, args.page_size))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
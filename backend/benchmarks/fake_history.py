@@ -0,0 +1,129 @@
+"""In-memory stand-in for Gmail's history API, and a change-feed simulation.
+
+FakeHistory has the same current_id()/since() interface as
+changes.GmailHistory, so a ChangeFeed can run against it without a Gmail
+account. Mutate the fake mailbox with add(), delete() and relabel().
+
+Run from the backend directory to watch several tabs share one poller and
+compare the quota cost with tabs re-listing the inbox on a timer:
+
+    python benchmarks/fake_history.py [--tabs N] [--seconds S] [--changes N]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import changes  # noqa: E402
+from changes import ChangeFeed, HistoryExpired  # noqa: E402
+
+# Gmail quota units per call (developers.google.com/gmail/api/reference/quota).
+QUOTA_HISTORY_LIST = 2
+QUOTA_MESSAGES_LIST = 5
+QUOTA_MESSAGES_GET = 5
+
+class FakeHistory:
+    """A mailbox whose every change is appended to a history log."""
+
+    def __init__(self, retain: int = 1000):
+        self.history_id = 1000
+        self.records: List[dict] = []
+        self.labels: Dict[str, List[str]] = {}
+        self.retain = retain
+        self.calls = 0
+
+    def _record(self, kind: str, msg_id: str, labels: List[str] = None) -> None:
+        self.history_id += 1
+        message = {"id": msg_id, "threadId": f"t{msg_id}"}
+        if labels is not None:
+            message["labelIds"] = labels
+        self.records.append({"id": str(self.history_id), kind: [{"message": message}]})
+        del self.records[:-self.retain]
+
+    def add(self, msg_id: str, labels: List[str] = ("INBOX", "UNREAD")) -> None:
+        self.labels[msg_id] = list(labels)
+        self._record("messagesAdded", msg_id, self.labels[msg_id])
+
+    def delete(self, msg_id: str) -> None:
+        self.labels.pop(msg_id, None)
+        self._record("messagesDeleted", msg_id)
+
+    def relabel(self, msg_id: str, add: List[str] = (), remove: List[str] = ()) -> None:
+        labels = [l for l in self.labels[msg_id] if l not in remove]
+        self.labels[msg_id] = labels + [l for l in add if l not in labels]
+        self._record("labelsAdded" if add else "labelsRemoved", msg_id, self.labels[msg_id])
+
+    async def current_id(self) -> str:
+        self.calls += 1
+        return str(self.history_id)
+
+    async def since(self, start_history_id: str) -> Tuple[List[dict], str]:
+        self.calls += 1
+        start = int(start_history_id)
+        if self.records and start < int(self.records[0]["id"]) - 1:
+            raise HistoryExpired(start_history_id)
+        return [r for r in self.records if int(r["id"]) > start], str(self.history_id)
+
+async def simulate(tabs: int, seconds: float, change_count: int, list_interval: float, page_size: int):
+    source = FakeHistory()
+    for i in range(page_size):
+        source.add(f"m{i}", ["INBOX"])
+    feed = ChangeFeed("me@example.com")
+    queues = [feed.subscribe(source) for _ in range(tabs)]
+    received = [0] * tabs
+
+    async def tab(i):
+        while True:
+            event, data = await queues[i].get()
+            if event == "changes":
+                received[i] += len(data["added"]) + len(data["removed"]) + len(data["labels"])
+
+    async def mailbox():
+        # A burst of activity in the first third, then an idle mailbox.
+        for n in range(change_count):
+            await asyncio.sleep(seconds / 3 / change_count)
+            choice = random.random()
+            if choice < 0.5 or not source.labels:
+                source.add(f"new{n}")
+            elif choice < 0.8:
+                source.relabel(random.choice(list(source.labels)), remove=["UNREAD"])
+            else:
+                source.delete(random.choice(list(source.labels)))
+
+    readers = [asyncio.create_task(tab(i)) for i in range(tabs)]
+    await asyncio.wait_for(mailbox(), seconds)
+    await asyncio.sleep(seconds * 2 / 3)
+    for queue in queues:
+        feed.unsubscribe(queue)
+    for reader in readers:
+        reader.cancel()
+
+    feed_quota = feed.polls * QUOTA_HISTORY_LIST
+    relists = tabs * int(seconds / list_interval)
+    list_quota = relists * (QUOTA_MESSAGES_LIST + page_size * QUOTA_MESSAGES_GET)
+    print(f"{tabs} tabs, {change_count} changes over {seconds:.1f}s")
+    print(f"change feed: {feed.polls} history.list polls, {feed_quota} quota units, "
+          f"final interval {feed.interval:.2f}s, updates per tab {received}")
+    print(f"timer re-list every {list_interval:.1f}s: {relists} listings, {list_quota} quota units")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tabs", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=6.0)
+    parser.add_argument("--changes", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    # Scale the poller's timings down so the run takes seconds, not minutes:
+    # 1s of simulation stands for 10s of real time.
+    changes.CHANGES_POLL_INTERVAL = 0.5
+    changes.CHANGES_MAX_INTERVAL = 6.0
+    simulated_list_interval = 3.0  # a 30s refetchInterval
+    asyncio.run(simulate(args.tabs, args.seconds, args.changes, simulated_list_interval, args.page_size))
+
+if __name__ == "__main__":
+    main()
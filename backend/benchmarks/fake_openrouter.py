@@ -0,0 +1,121 @@
+"""Fake OpenRouter chat completions server, for exercising openrouter.py offline.
+
+Answers POST /chat/completions, plain and with "stream": true, following a
+per-model script of behaviours, one per request:
+
+    200                 answer (also what happens once a script runs out)
+    503, 429, ...       fail with that status (and "Retry-After: 0")
+    ("delay", 2.0)      answer after two seconds
+    ("hang", 2.0)       send nothing for two seconds, then close
+
+Answers are "reply from <model>" with fixed token usage. Requests are
+recorded with the client port they came in on, so connection reuse shows
+up as repeated ports. Point openrouter.py at it with OPENROUTER_BASE_URL:
+
+    python benchmarks/fake_openrouter.py [--port 8090]
+    OPENROUTER_BASE_URL=http://127.0.0.1:8090 OPENROUTER_API_KEY=x uvicorn main:app
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+USAGE = {"prompt_tokens": 120, "completion_tokens": 8, "total_tokens": 128}
+
+class FakeOpenRouter:
+    """Scripts and the log of received requests, shared by all handlers."""
+
+    def __init__(self):
+        self.scripts = {}
+        self.lock = threading.Lock()
+        # (model, stream, client port) per request, in arrival order.
+        self.requests = []
+
+    def script(self, model: str, behaviours) -> None:
+        with self.lock:
+            self.scripts[model] = list(behaviours)
+
+    def next_behaviour(self, model: str, stream: bool, port: int):
+        with self.lock:
+            self.requests.append((model, stream, port))
+            script = self.scripts.get(model)
+            return script.pop(0) if script else 200
+
+    def models(self):
+        return [model for model, _, _ in self.requests]
+
+def _completion(model: str) -> dict:
+    return {"id": "gen-fake", "model": model, "usage": USAGE,
+            "choices": [{"message": {"role": "assistant", "content": f"reply from {model}"}}]}
+
+def _stream(model: str) -> bytes:
+    events = [": OPENROUTER PROCESSING"]
+    for word in f"reply from {model}".split(" "):
+        events.append("data: " + json.dumps({"choices": [{"delta": {"content": word + " "}}]}))
+    events.append("data: " + json.dumps({"choices": [{"delta": {}}], "usage": USAGE}))
+    events.append("data: [DONE]")
+    return "".join(event + "\n\n" for event in events).encode()
+
+def _handler(router: FakeOpenRouter):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, as the real API does.
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, code, data: bytes, content_type="application/json", headers=()):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            model, stream = body.get("model", ""), bool(body.get("stream"))
+            behaviour = router.next_behaviour(model, stream, self.client_address[1])
+            try:
+                if isinstance(behaviour, tuple) and behaviour[0] == "hang":
+                    time.sleep(behaviour[1])
+                    self.close_connection = True
+                    return
+                if isinstance(behaviour, tuple) and behaviour[0] == "delay":
+                    time.sleep(behaviour[1])
+                    behaviour = 200
+                if behaviour != 200:
+                    error = {"error": {"code": behaviour, "message": "Injected failure"}}
+                    self.reply(behaviour, json.dumps(error).encode(), headers=[("Retry-After", "0")])
+                elif stream:
+                    self.reply(200, _stream(model), "text/event-stream")
+                else:
+                    self.reply(200, json.dumps(_completion(model)).encode())
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on this request (timeout or hedge).
+                self.close_connection = True
+
+    return Handler
+
+def start(router: FakeOpenRouter, port: int = 0) -> ThreadingHTTPServer:
+    """Serve `router` on 127.0.0.1 in a background thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _handler(router))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args()
+    server = start(FakeOpenRouter(), args.port)
+    print(f"Fake OpenRouter on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from googleapiclient.errors import HttpError
+
+from log import get_logger
+
+logger = get_logger("changes")
+
+# Seconds between users.history.list polls right after a change, and the
+# most the interval grows to while the mailbox stays quiet. Every browser
+# tab of a mailbox shares the one poller.
+CHANGES_POLL_INTERVAL = float(os.getenv("MAIL_CHANGES_POLL_INTERVAL", 5))
+CHANGES_MAX_INTERVAL = float(os.getenv("MAIL_CHANGES_MAX_INTERVAL", 60))
+CHANGES_BACKOFF = 1.5
+# SSE comment sent on idle connections so proxies do not close them.
+CHANGES_KEEPALIVE = float(os.getenv("MAIL_CHANGES_KEEPALIVE", 25))
+# Events a slow subscriber may fall behind by before it is told to reload.
+CHANGES_QUEUE_SIZE = 100
+
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
+
+class HistoryExpired(Exception):
+    """The start historyId is too old for the source to replay from."""
+
+class GmailHistory:
+    """History source backed by the Gmail API.
+
+    Anything with the same two methods can stand in for it; see
+    benchmarks/fake_history.py.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    async def current_id(self) -> str:
+        profile = await self.service.execute(self.service.users().getProfile(userId='me'))
+        return profile['historyId']
+
+    async def since(self, start_history_id: str) -> Tuple[List[dict], str]:
+        """History records after `start_history_id` and the historyId they lead to."""
+        history, page_token, history_id = [], None, start_history_id
+        try:
+            while True:
+                response = await self.service.execute(self.service.users().history().list(
+                    userId='me', startHistoryId=start_history_id, historyTypes=HISTORY_TYPES,
+                    pageToken=page_token,
+                ))
+                history.extend(response.get('history', []))
+                history_id = response.get('historyId', history_id)
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    return history, history_id
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpired(str(e))
+            raise
+
+def summarize(history: List[dict]) -> Dict[str, Any]:
+    """Net effect of history records: message ids added and removed, and the
+    current labels of every message whose labels changed (or that is new)."""
+    added: Dict[str, None] = {}
+    removed: Dict[str, None] = {}
+    labels: Dict[str, List[str]] = {}
+    for record in history:
+        for item in record.get("messagesAdded", []):
+            msg = item["message"]
+            added[msg["id"]] = None
+            removed.pop(msg["id"], None)
+            if "labelIds" in msg:
+                labels[msg["id"]] = msg["labelIds"]
+        for item in record.get("messagesDeleted", []):
+            msg_id = item["message"]["id"]
+            labels.pop(msg_id, None)
+            if msg_id in added:
+                # Added and deleted since the last poll: nobody has seen it.
+                del added[msg_id]
+            else:
+                removed[msg_id] = None
+        for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+            msg = item["message"]
+            if "labelIds" in msg and msg["id"] not in removed:
+                labels[msg["id"]] = msg["labelIds"]
+    return {"added": list(added), "removed": list(removed), "labels": labels}
+
+class ChangeFeed:
+    """One history poller for a mailbox, fanned out to every subscriber.
+
+    The poller runs while at least one subscriber is connected. It polls
+    every CHANGES_POLL_INTERVAL seconds after a change and backs off to
+    CHANGES_MAX_INTERVAL while nothing happens.
+    """
+
+    def __init__(self, user: str):
+        self.user = user
+        self.source = None
+        self.history_id: Optional[str] = None
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.interval = CHANGES_POLL_INTERVAL
+
+    def subscribe(self, source) -> asyncio.Queue:
+        # The newest subscriber's credentials are the least likely to have expired.
+        self.source = source
+        queue = asyncio.Queue(maxsize=CHANGES_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        if self.history_id is not None:
+            queue.put_nowait(("ready", {"historyId": self.history_id}))
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+            if _feeds.get(self.user) is self:
+                del _feeds[self.user]
+
+    def publish(self, event: str, data: Dict[str, Any]) -> None:
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # Too far behind to catch up from deltas; have it reload.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(("reset", {"historyId": self.history_id}))
+
+    async def poll(self) -> None:
+        """One users.history.list round trip, published if anything changed."""
+        try:
+            history, history_id = await self.source.since(self.history_id)
+        except HistoryExpired:
+            self.history_id = await self.source.current_id()
+            self.interval = CHANGES_POLL_INTERVAL
+            self.publish("reset", {"historyId": self.history_id})
+            return
+        finally:
+            self.polls += 1
+        self.history_id = history_id
+        changes = summarize(history)
+        if changes["added"] or changes["removed"] or changes["labels"]:
+            self.interval = CHANGES_POLL_INTERVAL
+            self.publish("changes", {"historyId": history_id, **changes})
+        else:
+            self.interval = min(self.interval * CHANGES_BACKOFF, CHANGES_MAX_INTERVAL)
+
+    async def _run(self) -> None:
+        self.interval = CHANGES_POLL_INTERVAL
+        while self.history_id is None:
+            try:
+                self.history_id = await self.source.current_id()
+            except Exception as e:
+                logger.error("change_feed_error", error=str(e))
+                await asyncio.sleep(CHANGES_MAX_INTERVAL)
+        self.publish("ready", {"historyId": self.history_id})
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error("change_feed_error", error=str(e))
+                self.interval = CHANGES_MAX_INTERVAL
+
+_feeds: Dict[str, ChangeFeed] = {}
+
+def feed_for(user: str) -> ChangeFeed:
+    feed = _feeds.get(user)
+    if feed is None:
+        feed = _feeds[user] = ChangeFeed(user)
+    return feed
+
+def feed_stats() -> Dict[str, Any]:
+    """Totals across all feeds. Served without auth, so no mailbox is named."""
+    return {
+        "feeds": len(_feeds),
+        "subscribers": sum(len(feed.subscribers) for feed in _feeds.values()),
+        "polls": sum(feed.polls for feed in _feeds.values()),
+        "intervals": sorted(round(feed.interval, 1) for feed in _feeds.values()),
+    }
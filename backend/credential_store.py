@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+from google.oauth2.credentials import Credentials
+
+from cache import SingleFlight, TTLCache
+from log import get_logger
+
+logger = get_logger("credentials")
+
+CREDENTIAL_STORE_PATH = os.getenv(
+    "CREDENTIAL_STORE_PATH", os.path.join(os.path.dirname(__file__), "credentials.sqlite3")
+)
+TOKEN_URI = os.getenv("GOOGLE_TOKEN_URI", "https://oauth2.googleapis.com/token")
+# Access tokens are refreshed this many seconds before they expire.
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", 300))
+# Background refreshes stop for mailboxes unused this long; their next
+# request refreshes instead.
+TOKEN_REFRESH_IDLE = float(os.getenv("TOKEN_REFRESH_IDLE", 6 * 3600))
+SESSION_TTL = float(os.getenv("AUTH_SESSION_TTL", 30 * 24 * 3600))
+
+# Session handles are told apart from Google access tokens by this prefix.
+SESSION_PREFIX = "sess_"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS credentials (
+    user TEXT PRIMARY KEY,
+    refresh_token TEXT,
+    access_token TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+-- Only a hash of each session handle is kept.
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+class CredentialError(Exception):
+    """No usable credentials: unknown session, or the refresh token was revoked."""
+
+class TokenEndpointError(Exception):
+    """Google's token endpoint failed or could not be reached; worth retrying."""
+
+def is_session(token: str) -> bool:
+    return token.startswith(SESSION_PREFIX)
+
+def _session_hash(session: str) -> str:
+    return hashlib.sha256(session.encode()).hexdigest()
+
+class UserCredentials:
+    """The live credentials of one mailbox.
+
+    `credentials` is shared with the mailbox's GmailService and updated in
+    place on refresh. It carries no expiry or refresh token, so google-auth
+    never tries to refresh it itself on a request thread.
+    """
+
+    __slots__ = ("user", "credentials", "refresh_token", "expires_at", "last_used", "timer")
+
+    def __init__(self, user: str, access_token: str, refresh_token: Optional[str], expires_at: float):
+        self.user = user
+        self.credentials = Credentials(token=access_token)
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.last_used = time.time()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+class CredentialStore:
+    """OAuth credentials per mailbox, refreshed ahead of expiry.
+
+    Logging in stores the refresh token and hands out an opaque session
+    handle. Requests exchange the handle for the mailbox's current access
+    token without touching the network: a background timer refreshes it
+    TOKEN_REFRESH_MARGIN seconds before it expires, and concurrent
+    refreshes for one mailbox share a single token request. Only a token
+    that has already lapsed (e.g. after a long idle period) makes a
+    request wait.
+    """
+
+    def __init__(self, path: str = CREDENTIAL_STORE_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._users: Dict[str, UserCredentials] = {}
+        self._sessions = TTLCache(maxsize=4096, ttl=3600)
+        self._refreshes = SingleFlight()
+        self.refreshed = 0
+        self.failed = 0
+        self.waited = 0
+
+    def _save(self, entry: UserCredentials) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO credentials (user, refresh_token, access_token, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user) DO UPDATE SET refresh_token = excluded.refresh_token, "
+                "access_token = excluded.access_token, expires_at = excluded.expires_at",
+                (entry.user, entry.refresh_token, entry.credentials.token, entry.expires_at),
+            )
+
+    def _load(self, user: str) -> Optional[UserCredentials]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT refresh_token, access_token, expires_at FROM credentials WHERE user = ?", (user,)
+            ).fetchone()
+        return UserCredentials(user, row[1], row[0], row[2]) if row else None
+
+    def _session_user(self, session: str) -> Optional[str]:
+        key = _session_hash(session)
+        user = self._sessions.get(key)
+        if user is None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT user FROM sessions WHERE id = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+            if row is None:
+                return None
+            user = row[0]
+            self._sessions.set(key, user)
+        return user
+
+    async def login(self, user: str, access_token: str, refresh_token: Optional[str], expires_in: float) -> str:
+        """Store freshly issued tokens and return a new session handle."""
+        expires_at = time.time() + expires_in
+        entry = self._users.get(user) or await asyncio.to_thread(self._load, user)
+        if entry is None:
+            entry = UserCredentials(user, access_token, refresh_token, expires_at)
+        else:
+            # Google only sends a refresh token on consent; keep the old one otherwise.
+            entry.credentials.token = access_token
+            entry.refresh_token = refresh_token or entry.refresh_token
+            entry.expires_at = expires_at
+            entry.last_used = time.time()
+        self._users[user] = entry
+        await asyncio.to_thread(self._save, entry)
+        self._schedule(entry)
+
+        session = SESSION_PREFIX + secrets.token_urlsafe(32)
+
+        def insert():
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT INTO sessions (id, user, expires_at) VALUES (?, ?, ?)",
+                    (_session_hash(session), user, time.time() + SESSION_TTL),
+                )
+                self._conn.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),))
+
+        await asyncio.to_thread(insert)
+        return session
+
+    async def logout(self, session: str) -> None:
+        key = _session_hash(session)
+        self._sessions.pop(key)
+
+        def delete():
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM sessions WHERE id = ?", (key,))
+
+        await asyncio.to_thread(delete)
+
+    async def credentials(self, session: str) -> Credentials:
+        """Current credentials for a session handle; raises CredentialError."""
+        user = self._session_user(session)
+        if user is None:
+            raise CredentialError("Unknown or expired session")
+        entry = self._users.get(user)
+        if entry is None:
+            entry = await asyncio.to_thread(self._load, user)
+            if entry is None:
+                raise CredentialError("No credentials for this session")
+            entry = self._users.setdefault(user, entry)
+            self._schedule(entry)
+        entry.last_used = time.time()
+        if entry.expires_at - time.time() <= 0:
+            # The timer did not get to it (idle mailbox, or just restarted).
+            self.waited += 1
+            await self.refresh(entry)
+        return entry.credentials
+
+    async def refresh(self, entry: UserCredentials) -> None:
+        """Refresh a mailbox's access token; concurrent callers share one request."""
+        await self._refreshes.do(entry.user, lambda: self._refresh(entry))
+
+    async def _refresh(self, entry: UserCredentials) -> None:
+        if not entry.refresh_token:
+            raise CredentialError("Access token expired and no refresh token is stored")
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                response = await client.post(TOKEN_URI, data={
+                    "client_id": os.getenv("GOOGLE_CLIENT_ID"),
+                    "client_secret": os.getenv("GOOGLE_CLIENT_SECRET"),
+                    "refresh_token": entry.refresh_token,
+                    "grant_type": "refresh_token",
+                })
+        except httpx.HTTPError as e:
+            raise TokenEndpointError(f"Token refresh failed: {e!r}")
+        if response.status_code in (400, 401):
+            # invalid_grant: revoked or expired refresh token. Logging in again is the only fix.
+            self.failed += 1
+            await self._forget(entry.user)
+            raise CredentialError(f"Token refresh rejected: {response.text}")
+        if response.status_code != 200:
+            raise TokenEndpointError(f"Token refresh failed with {response.status_code}: {response.text}")
+        tokens = response.json()
+        entry.credentials.token = tokens["access_token"]
+        entry.expires_at = time.time() + tokens.get("expires_in", 3600)
+        entry.refresh_token = tokens.get("refresh_token", entry.refresh_token)
+        self.refreshed += 1
+        await asyncio.to_thread(self._save, entry)
+        self._schedule(entry)
+
+    async def _forget(self, user: str) -> None:
+        entry = self._users.pop(user, None)
+        if entry is not None and entry.timer is not None:
+            entry.timer.cancel()
+        # The session cache cannot be filtered by user; it refills from the table.
+        self._sessions.clear()
+
+        def delete():
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM credentials WHERE user = ?", (user,))
+                self._conn.execute("DELETE FROM sessions WHERE user = ?", (user,))
+
+        await asyncio.to_thread(delete)
+
+    def _schedule(self, entry: UserCredentials) -> None:
+        if entry.timer is not None:
+            entry.timer.cancel()
+        delay = max(entry.expires_at - TOKEN_REFRESH_MARGIN - time.time(), 0)
+        entry.timer = asyncio.get_running_loop().call_later(delay, self._on_timer, entry.user)
+
+    def _on_timer(self, user: str) -> None:
+        entry = self._users.get(user)
+        if entry is None:
+            return
+        entry.timer = None
+        if time.time() - entry.last_used > TOKEN_REFRESH_IDLE:
+            # Nobody is using it; stop refreshing until the next request.
+            del self._users[user]
+            return
+        asyncio.get_running_loop().create_task(self._background_refresh(entry))
+
+    async def _background_refresh(self, entry: UserCredentials) -> None:
+        try:
+            await self.refresh(entry)
+        except Exception as e:
+            logger.error("token_refresh_error", error=str(e))
+            if not isinstance(e, CredentialError) and entry.timer is None:
+                # Transient failure: try again shortly, well before expiry if possible.
+                entry.timer = asyncio.get_running_loop().call_later(30, self._on_timer, entry.user)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "waited": self.waited,
+            "refreshMargin": TOKEN_REFRESH_MARGIN,
+        }
+
+credential_store = CredentialStore()
@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import google_auth_httplib2
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from cache import TTLCache
+from log import get_logger
+from metrics import GMAIL_LATENCY
+from quota import (
+    GMAIL_MAX_RETRIES, GMAIL_RETRY_DEADLINE, QuotaScheduler, backoff, is_rate_limited, is_retryable,
+    request_units,
+)
+
+logger = get_logger("gmail")
+
+# Parsed once at import time from the discovery document bundled with
+# google-api-python-client, so building a service never touches the network.
+GMAIL_DISCOVERY_DOC = json.loads(discovery_cache.get_static_doc('gmail', 'v1'))
+
+GMAIL_MAX_WORKERS = int(os.getenv("GMAIL_MAX_WORKERS", 32))
+GMAIL_PER_USER_CONCURRENCY = int(os.getenv("GMAIL_PER_USER_CONCURRENCY", 4))
+GMAIL_HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", 30))
+
+# googleapiclient is synchronous, so every .execute() runs here instead of on
+# the event loop. Each worker thread keeps its own httplib2 connection pool
+# because httplib2.Http is not safe to share between threads.
+_executor = ThreadPoolExecutor(max_workers=GMAIL_MAX_WORKERS, thread_name_prefix="gmail")
+_thread_local = threading.local()
+
+# Access tokens live for an hour, so there is no point keeping services longer.
+_services = TTLCache(
+    maxsize=int(os.getenv("GMAIL_SERVICE_CACHE_SIZE", 512)),
+    ttl=float(os.getenv("GMAIL_SERVICE_CACHE_TTL", 1800)),
+)
+_user_limits = TTLCache(maxsize=4096, ttl=3600)
+_schedulers = TTLCache(maxsize=4096, ttl=3600)
+
+def token_key(token: str) -> str:
+    """Stable cache key for a bearer token that never stores the token itself."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _thread_http(credentials):
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = _thread_local.http = httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT)
+        # Resumable uploads answer 308 for "send the next chunk"; as in
+        # googleapiclient's build_http(), it must not be followed as a redirect.
+        http.redirect_codes = http.redirect_codes - {308}
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+
+def _user_limit(key: str) -> asyncio.Semaphore:
+    semaphore = _user_limits.get(key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(GMAIL_PER_USER_CONCURRENCY)
+        _user_limits.set(key, semaphore)
+    return semaphore
+
+def operation_name(request) -> str:
+    """"messages.get" for a users.messages.get request, as used in metrics."""
+    if isinstance(request, BatchHttpRequest):
+        return "batch"
+    return (getattr(request, "methodId", None) or "unknown").removeprefix("gmail.users.")
+
+def scheduler_for(key: str) -> QuotaScheduler:
+    scheduler = _schedulers.get(key)
+    if scheduler is None:
+        scheduler = QuotaScheduler()
+        _schedulers.set(key, scheduler)
+    return scheduler
+
+class GmailService:
+    """Gmail discovery resource for one token, with async request execution.
+
+    Requests are built exactly as with googleapiclient (`service.users()...`)
+    and then awaited with `await service.execute(request)`. Many requests of
+    the same kind go through `execute_batch()`, which sizes the batches.
+    Both are paced by the user's QuotaScheduler.
+    """
+
+    def __init__(self, token: str, credentials: Optional[Credentials] = None):
+        self.key = token_key(token)
+        self.credentials = credentials or Credentials(token=token)
+        self.resource = build_from_document(
+            GMAIL_DISCOVERY_DOC,
+            http=google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http()),
+        )
+
+    def users(self):
+        return self.resource.users()
+
+    def new_batch_http_request(self, callback=None):
+        return self.resource.new_batch_http_request(callback=callback)
+
+    async def execute(self, request):
+        """Execute a request on the Gmail thread pool within the user's quota,
+        retrying rate-limited and transient failures with backoff (see
+        quota.is_retryable for what is safe to retry)."""
+        scheduler = scheduler_for(self.key)
+        units = request_units(request)
+        deadline = time.monotonic() + GMAIL_RETRY_DEADLINE
+        for attempt in range(GMAIL_MAX_RETRIES + 1):
+            await scheduler.acquire(units)
+            try:
+                return await self._run(request)
+            except HttpError as e:
+                delay = backoff(attempt)
+                if (not is_retryable(e, request) or attempt == GMAIL_MAX_RETRIES
+                        or time.monotonic() + delay > deadline):
+                    raise
+                if is_rate_limited(e):
+                    scheduler.observe(1, 1)
+                scheduler.retried += 1
+                await asyncio.sleep(delay)
+
+    async def execute_batch(self, requests: Dict[str, Any]) -> Dict[str, Any]:
+        """Execute `requests` (request id -> request) in batches; returns the
+        responses by request id.
+
+        Sub-requests that were rate limited or failed transiently are retried
+        in smaller batches with exponential backoff, as long as that fits in
+        GMAIL_RETRY_DEADLINE. Whatever still fails is logged and left out,
+        unless nothing succeeded at all, in which case the error is raised.
+        """
+        scheduler = scheduler_for(self.key)
+        responses: Dict[str, Any] = {}
+        errors: Dict[str, Exception] = {}
+        pending = dict(requests)
+        deadline = time.monotonic() + GMAIL_RETRY_DEADLINE
+
+        async def run(ids):
+            throttled = 0
+
+            def callback(request_id, response, exception):
+                nonlocal throttled
+                if exception is None:
+                    responses[request_id] = response
+                    return
+                errors[request_id] = exception
+                throttled += is_rate_limited(exception)
+
+            batch = self.resource.new_batch_http_request(callback=callback)
+            for request_id in ids:
+                batch.add(pending[request_id], request_id=request_id)
+            await scheduler.acquire(sum(request_units(pending[request_id]) for request_id in ids))
+            try:
+                await self._run(batch, "batch." + operation_name(pending[ids[0]]))
+            except HttpError as e:
+                # The whole batch was turned away.
+                if not is_retryable(e):
+                    raise
+                errors.update((request_id, e) for request_id in ids)
+                throttled = len(ids) if is_rate_limited(e) else 0
+            scheduler.observe(len(ids), throttled)
+
+        for attempt in range(GMAIL_MAX_RETRIES + 1):
+            ids, size = list(pending), scheduler.batch_size
+            await asyncio.gather(*(run(ids[i:i + size]) for i in range(0, len(ids), size)))
+            retry = [request_id for request_id in ids if request_id in errors
+                     and is_retryable(errors[request_id], pending[request_id])]
+            delay = backoff(attempt)
+            if not retry or attempt == GMAIL_MAX_RETRIES or time.monotonic() + delay > deadline:
+                break
+            scheduler.retried += len(retry)
+            pending = {request_id: pending[request_id] for request_id in retry}
+            for request_id in retry:
+                del errors[request_id]
+            await asyncio.sleep(delay)
+
+        if errors:
+            scheduler.failed += len(errors)
+            if not responses:
+                raise next(iter(errors.values()))
+            for request_id, e in errors.items():
+                logger.error("gmail_batch_request_error", request_id=request_id, error=str(e))
+        return responses
+
+    async def _run(self, request, operation: Optional[str] = None):
+        async with _user_limit(self.key):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                _executor, self._execute_sync, request, operation or operation_name(request)
+            )
+
+    def _execute_sync(self, request, operation: str):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            response = request.execute(http=_thread_http(self.credentials))
+            outcome = "ok"
+            return response
+        except HttpError as e:
+            outcome = str(e.resp.status)
+            raise
+        finally:
+            GMAIL_LATENCY.observe(time.perf_counter() - started, operation, outcome)
+
+def get_service(token: str, credentials: Optional[Credentials] = None) -> GmailService:
+    """Return the Gmail service for this token, building it on a cache miss.
+
+    `token` may be a session handle, with `credentials` the ones it maps
+    to; the service then keeps one key across token refreshes.
+    """
+    key = token_key(token)
+    service = _services.get(key)
+    if service is None:
+        service = GmailService(token, credentials)
+        _services.set(key, service)
+    elif credentials is not None:
+        service.credentials = credentials
+    return service
+
+def cache_stats() -> dict:
+    return _services.stats()
+
+def quota_stats(key: str) -> dict:
+    return scheduler_for(key).stats()
@@ -0,0 +1,101 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from typing import Any, Optional
+
+# LOG_FORMAT is json (one object per line) or text.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{key}={value!r}" for key, value in getattr(record, "fields", {}).items())
+        line = f"{record.levelname} {record.name} {record.getMessage()} {fields}".rstrip()
+        return f"{line}\n{record.exc_text}" if record.exc_text else line
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread untouched, apart from the
+    traceback, which is rendered here because it cannot cross the queue."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+# Handlers run on the listener thread, so writing to stderr never blocks
+# the event loop.
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_listener: Optional[logging.handlers.QueueListener] = None
+_root = logging.getLogger("backend")
+_root.setLevel(LOG_LEVEL)
+_root.addHandler(_QueueHandler(_queue))
+_root.propagate = False
+
+def start() -> None:
+    global _listener
+    if _listener is None:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        _listener = logging.handlers.QueueListener(_queue, handler)
+        _listener.start()
+
+def stop() -> None:
+    """Flush what is queued and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+start()
+atexit.register(stop)
+
+class Logger:
+    """Structured logger: an event name plus keyword fields.
+
+        logger.error("thread_error", thread_id=thread_id, error=str(e))
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def _log(self, level: int, event: str, exc_info: bool, fields: dict) -> None:
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
+
+    def debug(self, event: str, **fields: Any) -> None:
+        self._log(logging.DEBUG, event, False, fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        self._log(logging.INFO, event, False, fields)
+
+    def warning(self, event: str, **fields: Any) -> None:
+        self._log(logging.WARNING, event, False, fields)
+
+    def error(self, event: str, **fields: Any) -> None:
+        self._log(logging.ERROR, event, False, fields)
+
+    def exception(self, event: str, **fields: Any) -> None:
+        self._log(logging.ERROR, event, True, fields)
+
+def get_logger(name: str) -> Logger:
+    return Logger(_root.getChild(name))
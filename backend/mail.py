@@ -1,13 +1,62 @@
-from fastapi import APIRouter, HTTPException, Header, Depends
+from fastapi import APIRouter, HTTPException, Header, Depends, Response, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, EmailStr
-from typing import List, Optional
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from typing import List, Literal, Optional
+import asyncio
 import base64
-from email.message import EmailMessage
+import hashlib
+import hmac
+import json
+import os
+import re
+
+from attachments import attachment_response, attachment_stats
+from cache import TTLCache
+from changes import CHANGES_KEEPALIVE, GmailHistory, feed_for, feed_stats
+from credential_store import CredentialError, TokenEndpointError, credential_store, is_session
+from gmail_service import get_service, cache_stats, quota_stats
+from log import get_logger
+from message import FastJSONResponse, ParsedMessage
+from mime import extract_body, fill_deferred
+from outgoing import MessageTooLarge, build_message, upload_request
+from sync import store, sync_mailbox, mailbox_user, get_profile
+from search_index import ensure_index, search_local, index_status
+
+logger = get_logger("mail")
 
 router = APIRouter(prefix="/api/mail", tags=["mail"])
 
+# Headers the list UI actually renders; used for format='metadata' listings.
+LIST_HEADERS = ['Subject', 'From', 'To', 'Date']
+
+# Message bodies never change, so they can be cached for as long as memory
+# allows. Keys are (token key, message id) so mailboxes never share entries.
+_bodies = TTLCache(
+    maxsize=int(os.getenv("MAIL_BODY_CACHE_SIZE", 500)),
+    ttl=float(os.getenv("MAIL_BODY_CACHE_TTL", 3600)),
+)
+
+# Bodies larger than this are cut (at a character boundary) before they are
+# decoded; 0 keeps them whole.
+MAX_BODY_BYTES = int(os.getenv("MAIL_MAX_BODY_BYTES", 0)) or None
+
+# Threads come back with bodies for only their newest messages; older ones
+# are fetched on demand.
+THREAD_BODIES = int(os.getenv("MAIL_THREAD_BODIES", 3))
+
+# Key for signing pagination cursors so clients cannot forge page tokens.
+# Without it a random key is used, and cursors do not survive a restart or
+# work across several server processes.
+CURSOR_SECRET = (os.getenv("MAIL_CURSOR_SECRET") or os.urandom(32).hex()).encode()
+
+# Page tokens of local search pages, and of Gmail pages older than the index.
+_LOCAL_TOKEN = re.compile(r"local:(\d+)")
+_OLDER_TOKEN = re.compile(r"older:(\d+):(.*)")
+
+# Speculatively fetched next pages: (token key, query signature, page token)
+# -> asyncio.Task. Short-lived because the mailbox keeps changing underneath.
+_pages = TTLCache(maxsize=128, ttl=float(os.getenv("MAIL_PREFETCH_TTL", 30)))
+
 class EmailFilter(BaseModel):
     labelIds: Optional[List[str]] = ['INBOX']
     maxResults: Optional[int] = 20
@@ -15,77 +64,218 @@ class EmailFilter(BaseModel):
     after: Optional[str] = None
     before: Optional[str] = None
     isUnread: Optional[bool] = None
+    includeBody: Optional[bool] = True  # False: metadata-only listing, bodies via /message/{id}/body
+    cursor: Optional[str] = None  # From the X-Next-Cursor header of the previous page
+    prefetch: Optional[bool] = False
 
 class ComposeEmail(BaseModel):
     to: EmailStr
     subject: str
     body: str
 
-def get_gmail_service(authorization: str = Header(...)):
+async def get_gmail_service(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid authorization header")
     
     token = authorization.split(" ")[1]
-    creds = Credentials(token=token)
-    return build('gmail', 'v1', credentials=creds)
+    if is_session(token):
+        # A session handle: the access token is held and refreshed server-side.
+        try:
+            credentials = await credential_store.credentials(token)
+        except CredentialError as e:
+            raise HTTPException(status_code=401, detail=str(e))
+        except TokenEndpointError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        return get_service(token, credentials)
+    return get_service(token)
 
-def extract_body(payload):
-    """Recursively extract the email body from the payload."""
-    body_html = ""
-    body_text = ""
-    
-    mime_type = payload.get('mimeType', '')
-    
-    # Direct body
-    if 'body' in payload and payload['body'].get('data'):
-        data = payload['body']['data']
-        decoded = base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
-        if 'html' in mime_type:
-            body_html = decoded
+@router.get("/cache/stats")
+async def service_cache_stats():
+    """Hit/miss counters for the per-token Gmail service and body caches."""
+    return {**cache_stats(), "bodies": _bodies.stats()}
+
+@router.get("/quota/stats")
+async def mail_quota_stats(service = Depends(get_gmail_service)):
+    """Quota units spent, throttling seen and the current batch size for this mailbox."""
+    return quota_stats(service.key)
+
+def get_message_request(service, message_id: str, include_body: bool = True):
+    """messages.get for a listing: full payload, or just the headers we render."""
+    if include_body:
+        return service.users().messages().get(userId='me', id=message_id, format='full')
+    return service.users().messages().get(
+        userId='me', id=message_id, format='metadata', metadataHeaders=LIST_HEADERS
+    )
+
+async def cache_body(service, message) -> dict:
+    """Extract the body of a full-format message and remember it.
+
+    Body parts Gmail left behind an attachmentId (large ones) are fetched
+    here, only for messages whose body is actually wanted.
+    """
+    key = (service.key, message['id'])
+    body = _bodies.get(key)
+    if body is None:
+        mime = extract_body(message['payload'], MAX_BODY_BYTES)
+        if mime.deferred:
+            parts = await asyncio.gather(*(
+                service.execute(service.users().messages().attachments().get(
+                    userId='me', messageId=message['id'], id=part['body']['attachmentId']
+                ))
+                for _, part in mime.deferred
+            ))
+            fill_deferred(mime, [part.get('data', '') for part in parts], MAX_BODY_BYTES)
+        body = {
+            "bodyHtml": mime.html,
+            "bodyText": mime.text,
+            "attachments": [a.to_dict() for a in mime.attachments],
+        }
+        _bodies.set(key, body)
+    return body
+
+def query_signature(list_kwargs: dict, include_body: bool) -> str:
+    raw = json.dumps([list_kwargs, include_body], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+def _cursor_mac(page_token: str, signature: str) -> str:
+    raw = json.dumps([page_token, signature]).encode()
+    return hmac.new(CURSOR_SECRET, raw, hashlib.sha256).hexdigest()[:32]
+
+def encode_cursor(page_token: str, signature: str) -> str:
+    raw = json.dumps({"p": page_token, "s": signature, "m": _cursor_mac(page_token, signature)},
+                     separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, signature: str) -> str:
+    """Page token inside a cursor; cursors only replay the query they came
+    from, and only ones this server issued are accepted."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    page_token = data.get("p") if isinstance(data, dict) else None
+    if not page_token or not isinstance(page_token, str) or data.get("s") != signature:
+        raise HTTPException(status_code=400, detail="Cursor does not match this query")
+    if not hmac.compare_digest(str(data.get("m", "")), _cursor_mac(page_token, signature)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return page_token
+
+async def fetch_messages(service, message_ids: List[str], include_body: bool = True) -> List[dict]:
+    """Batch-get messages, preserving the list order."""
+    responses = await service.execute_batch(
+        {message_id: get_message_request(service, message_id, include_body) for message_id in message_ids}
+    )
+    return [responses[message_id] for message_id in message_ids if message_id in responses]
+
+async def parse_message(service, msg, include_body: bool = True) -> ParsedMessage:
+    """ParsedMessage for a raw Gmail message in full or metadata format."""
+    return ParsedMessage.from_gmail(msg, await cache_body(service, msg) if include_body else None)
+
+async def get_messages(service, message_ids: List[str], include_body: bool = True,
+                       user: Optional[str] = None) -> List[ParsedMessage]:
+    """Parsed messages in `message_ids` order, served from the local store
+    where possible and batch-fetched from Gmail otherwise."""
+    found = {}
+    if user:
+        found = await asyncio.to_thread(store.get_messages, user, message_ids, include_body)
+    missing = [message_id for message_id in message_ids if message_id not in found]
+    if missing:
+        fetched = await asyncio.gather(*(
+            parse_message(service, msg, include_body)
+            for msg in await fetch_messages(service, missing, include_body)
+        ))
+        if user:
+            await asyncio.to_thread(store.put_messages, user, fetched)
+        found.update((msg.id, msg) for msg in fetched)
+    return [found[message_id] for message_id in message_ids if message_id in found]
+
+async def attach_bodies(service, messages: List[ParsedMessage], wanted: set,
+                        user: Optional[str] = None) -> List[ParsedMessage]:
+    """`messages` with bodies for the ids in `wanted`, taken from the body
+    cache, the local store or Gmail, in that order."""
+    missing = []
+    for msg in messages:
+        if msg.id not in wanted or msg.has_body:
+            continue
+        body = _bodies.get((service.key, msg.id))
+        if body is not None:
+            msg.set_body(body)
         else:
-            body_text = decoded
-    
-    # Multipart - recurse into parts
-    if 'parts' in payload:
-        for part in payload['parts']:
-            part_mime = part.get('mimeType', '')
-            if part_mime == 'text/html':
-                if part.get('body', {}).get('data'):
-                    body_html = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            elif part_mime == 'text/plain':
-                if part.get('body', {}).get('data'):
-                    body_text = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            elif 'multipart' in part_mime:
-                # Recurse into nested multipart
-                sub_html, sub_text = extract_body_recursive(part)
-                if sub_html:
-                    body_html = sub_html
-                if sub_text and not body_text:
-                    body_text = sub_text
-    
-    return body_html, body_text
-
-def extract_body_recursive(payload):
-    """Helper for nested multipart extraction."""
-    html = ""
-    text = ""
-    if 'parts' in payload:
-        for part in payload['parts']:
-            part_mime = part.get('mimeType', '')
-            if part_mime == 'text/html' and part.get('body', {}).get('data'):
-                html = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            elif part_mime == 'text/plain' and part.get('body', {}).get('data'):
-                text = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            elif 'multipart' in part_mime:
-                sub_html, sub_text = extract_body_recursive(part)
-                if sub_html:
-                    html = sub_html
-                if sub_text and not text:
-                    text = sub_text
-    return html, text
+            missing.append(msg.id)
+    if not missing:
+        return messages
+    fetched = {msg.id: msg for msg in await get_messages(service, missing, True, user)}
+    return [fetched.get(msg.id, msg) for msg in messages]
+
+async def _fetch_page(service, list_kwargs: dict, include_body: bool, page_token: Optional[str]):
+    # Sync first so stored labels are current before we serve from the store.
+    user = await sync_mailbox(service)
+    results = await service.execute(service.users().messages().list(
+        userId='me', pageToken=page_token, **list_kwargs
+    ))
+    ids = [m['id'] for m in results.get('messages', [])]
+    return await get_messages(service, ids, include_body, user), results.get('nextPageToken')
+
+async def load_page(service, list_kwargs: dict, include_body: bool,
+                    cursor: Optional[str] = None, prefetch: bool = False):
+    """One page of parsed messages plus the cursor for the page after it.
+
+    With `prefetch`, the next page is fetched in the background and parked in
+    a short-lived cache so the following request for it returns immediately.
+    """
+    signature = query_signature(list_kwargs, include_body)
+    page_token = decode_cursor(cursor, signature) if cursor else None
+
+    page = None
+    pending = _pages.pop((service.key, signature, page_token))
+    if pending is not None:
+        try:
+            page = await pending
+        except Exception as e:
+            logger.error("prefetch_error", error=str(e))
+    if page is None:
+        page = await _fetch_page(service, list_kwargs, include_body, page_token)
+
+    messages, next_token = page
+    if next_token and prefetch:
+        task = asyncio.create_task(_fetch_page(service, list_kwargs, include_body, next_token))
+        # Retrieve the exception on failure so an unused prefetch never warns.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _pages.set((service.key, signature, next_token), task)
+    return messages, encode_cursor(next_token, signature) if next_token else None
+
+def message_etag(messages: List[ParsedMessage], next_cursor: Optional[str] = None) -> str:
+    """Weak ETag for a message list.
+
+    Gmail messages are immutable apart from their labels, so ids, labels and
+    whether bodies are included pin down the response body.
+    """
+    digest = hashlib.blake2b(f"{next_cursor}\n".encode(), digest_size=16)
+    for m in messages:
+        digest.update(f"{m.id}\0{','.join(m.labelIds)}\0{int(m.has_body)}\n".encode())
+    return f'W/"{digest.hexdigest()}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored.
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+def paged_response(messages: List[ParsedMessage], next_cursor: Optional[str] = None,
+                   if_none_match: Optional[str] = None) -> Response:
+    """Messages as JSON, or 304 Not Modified if the client already has them."""
+    etag = message_etag(messages, next_cursor)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(messages, headers=headers)
 
 @router.post("/list")
-async def list_emails(filter: EmailFilter, service = Depends(get_gmail_service)):
+async def list_emails(filter: EmailFilter, if_none_match: Optional[str] = Header(None),
+                      service = Depends(get_gmail_service)):
     try:
         # Construct Gmail search query (q) from filters
         query_parts = []
@@ -99,175 +289,262 @@ async def list_emails(filter: EmailFilter, service = Depends(get_gmail_service))
             query_parts.append("is:unread")
         
         final_q = " ".join(query_parts) if query_parts else None
+        list_kwargs = {"labelIds": filter.labelIds, "maxResults": filter.maxResults, "q": final_q}
 
-        results = service.users().messages().list(
-            userId='me',
-            labelIds=filter.labelIds,
-            maxResults=filter.maxResults,
-            q=final_q
-        ).execute()
-        
-        messages = results.get('messages', [])
-        email_list = []
-        
-        if messages:
-            batch = service.new_batch_http_request()
-            
-            def callback(request_id, response, exception):
-                if exception:
-                    print(f"Error getting message {request_id}: {exception}")
-                else:
-                    headers = response['payload']['headers']
-                    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '(no subject)')
-                    curr_from = next((h['value'] for h in headers if h['name'] == 'From'), '(unknown)')
-                    curr_to = next((h['value'] for h in headers if h['name'] == 'To'), '')
-                    date = next((h['value'] for h in headers if h['name'] == 'Date'), '')
-                    
-                    # Extract full body
-                    body_html, body_text = extract_body(response['payload'])
-                    
-                    email_list.append({
-                        "id": response['id'],
-                        "threadId": response['threadId'],
-                        "labelIds": response.get('labelIds', []),
-                        "snippet": response.get('snippet', ''),
-                        "subject": subject,
-                        "from": curr_from,
-                        "to": curr_to,
-                        "date": date,
-                        "isRead": 'UNREAD' not in response.get('labelIds', []),
-                        "bodyHtml": body_html,
-                        "bodyText": body_text
-                    })
-
-            for msg in messages:
-                # Use 'full' format to get complete body
-                batch.add(service.users().messages().get(userId='me', id=msg['id'], format='full'), callback=callback)
-            
-            batch.execute()
-            
-        return email_list
+        messages, next_cursor = await load_page(
+            service, list_kwargs, filter.includeBody, filter.cursor, filter.prefetch
+        )
+        return paged_response(messages, next_cursor, if_none_match)
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Gmail API Error: {e}")
+        logger.exception("gmail_api_error", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/thread/{thread_id}")
-async def get_thread(thread_id: str, service = Depends(get_gmail_service)):
-    """Fetch all messages in a thread, sorted chronologically."""
+async def get_thread(thread_id: str, bodies: int = THREAD_BODIES, ids: Optional[str] = None,
+                     if_none_match: Optional[str] = Header(None), service = Depends(get_gmail_service)):
+    """Messages in a thread, sorted chronologically.
+
+    Every message has its metadata, but bodies are only included for the
+    last `bodies` messages and any listed in `ids` (comma-separated); the
+    rest come from /message/{id}/body or a repeat call with `ids`. The
+    thread is kept in the local store until the history feed reports a
+    change to it, so reopening it needs no Gmail call.
+    """
     try:
-        thread = service.users().threads().get(
-            userId='me', id=thread_id, format='full'
-        ).execute()
-        
-        thread_messages = []
-        for msg in thread.get('messages', []):
-            headers = msg['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '(no subject)')
-            msg_from = next((h['value'] for h in headers if h['name'] == 'From'), '(unknown)')
-            msg_to = next((h['value'] for h in headers if h['name'] == 'To'), '')
-            date = next((h['value'] for h in headers if h['name'] == 'Date'), '')
-            internal_date = int(msg.get('internalDate', 0))  # Epoch ms from Gmail
-            
-            body_html, body_text = extract_body(msg['payload'])
-            
-            thread_messages.append({
-                "id": msg['id'],
-                "threadId": msg['threadId'],
-                "labelIds": msg.get('labelIds', []),
-                "snippet": msg.get('snippet', ''),
-                "subject": subject,
-                "from": msg_from,
-                "to": msg_to,
-                "date": date,
-                "internalDate": internal_date,
-                "isRead": 'UNREAD' not in msg.get('labelIds', []),
-                "bodyHtml": body_html,
-                "bodyText": body_text
-            })
-        
-        # Sort by internalDate for correct chronological order
-        thread_messages.sort(key=lambda m: m['internalDate'])
-        return thread_messages
-    
+        user = await sync_mailbox(service)
+        thread_messages = None
+        if user:
+            thread_messages = await asyncio.to_thread(store.get_thread, user, thread_id)
+
+        if thread_messages is None:
+            thread = await service.execute(service.users().threads().get(
+                userId='me', id=thread_id, format='metadata', metadataHeaders=LIST_HEADERS
+            ))
+            thread_messages = [await parse_message(service, msg, False) for msg in thread.get('messages', [])]
+
+            # Sort by internalDate for correct chronological order
+            thread_messages.sort(key=lambda m: m.internalDate)
+            if user:
+                await asyncio.to_thread(
+                    store.put_thread, user, thread_id, thread_messages, thread.get('historyId')
+                )
+
+        wanted = {m.id for m in thread_messages[-bodies:]} if bodies > 0 else set()
+        if ids:
+            wanted.update(ids.split(","))
+        thread_messages = await attach_bodies(service, thread_messages, wanted, user)
+        return paged_response(thread_messages, if_none_match=if_none_match)
+
+    except Exception as e:
+        logger.exception("thread_error", thread_id=thread_id, error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/message/{message_id}/body")
+async def get_message_body(message_id: str, service = Depends(get_gmail_service)):
+    """Body of a single message, for listings fetched with includeBody=false."""
+    cached = _bodies.get((service.key, message_id))
+    if cached is not None:
+        return {"id": message_id, **cached}
+    try:
+        user = await mailbox_user(service)
+        if user:
+            stored = await asyncio.to_thread(store.get_messages, user, [message_id])
+            if message_id in stored:
+                msg = stored[message_id]
+                return {"id": message_id, "bodyHtml": msg.bodyHtml, "bodyText": msg.bodyText,
+                        "attachments": msg.attachments}
+        msg = await service.execute(service.users().messages().get(
+            userId='me', id=message_id, format='full'
+        ))
+        return {"id": message_id, **(await cache_body(service, msg))}
+    except Exception as e:
+        logger.exception("message_body_error", message_id=message_id, error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/message/{message_id}/attachment/{attachment_id}")
+async def get_attachment(message_id: str, attachment_id: str, filename: Optional[str] = None,
+                         mimeType: Optional[str] = None, range: Optional[str] = Header(None),
+                         service = Depends(get_gmail_service)):
+    """Attachment bytes, streamed; supports single-range Range requests.
+
+    `filename` and `mimeType` come from the message's attachment list and
+    only set the response headers; the response is always a download, and
+    types outside attachments.SAFE_MEDIA_TYPES go out as octet-stream.
+    """
+    try:
+        user = await mailbox_user(service) or service.key
+        key = hashlib.sha256(f"{user}\0{message_id}\0{attachment_id}".encode()).hexdigest()
+        return await attachment_response(service, key, message_id, attachment_id, range, filename, mimeType)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("attachment_error", message_id=message_id, error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/attachments/stats")
+async def mail_attachment_stats():
+    """Disk cache usage and hit rate for downloaded attachments."""
+    return attachment_stats()
+
+
+@router.get("/changes")
+async def mail_changes(service = Depends(get_gmail_service)):
+    """Server-Sent Events feed of mailbox changes, in place of re-listing.
+
+    Emits `ready` once the feed is following the mailbox, `changes` with the
+    ids added and removed and the new labels of changed messages, and
+    `reset` when the client should reload because deltas were lost.
+    """
+    try:
+        user = (await get_profile(service))['emailAddress']
     except Exception as e:
-        print(f"Thread Error: {e}")
+        logger.error("changes_error", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+    feed = feed_for(user)
+    queue = feed.subscribe(GmailHistory(service))
+
+    async def events():
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), CHANGES_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            feed.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/changes/stats")
+async def mail_changes_stats():
+    """Active change feeds, their subscribers and upstream polls so far."""
+    return feed_stats()
+
+@router.get("/index/status")
+async def get_index_status(service = Depends(get_gmail_service)):
+    """Progress of the local full-text index used by /search."""
+    user = await mailbox_user(service)
+    if not user:
+        return {"enabled": False, "backfilling": False, "indexedSince": None}
+    return await index_status(user)
+
 
 class SearchQuery(BaseModel):
     query: str
     maxResults: int = 10
+    includeBody: bool = True
+    cursor: Optional[str] = None
+    prefetch: bool = False
+
+async def search_messages(service, query: str, max_results: int = 10, include_body: bool = True,
+                          cursor: Optional[str] = None, prefetch: bool = False):
+    """One page of search results plus the next cursor, as for `load_page`.
+
+    Answers from the local index when it covers the query; local pages use
+    "local:<offset>" page tokens inside the same opaque cursor. When the
+    local results run out and Gmail may hold older matches, paging carries
+    on with "older:<epoch second>:<Gmail page token>" tokens for the same
+    query restricted to before the index window.
+    """
+    list_kwargs = {"q": query, "maxResults": max_results}
+    signature = query_signature(list_kwargs, include_body)
+    page_token = decode_cursor(cursor, signature) if cursor else None
+    if page_token and page_token.startswith("older:"):
+        return await _older_page(service, query, max_results, include_body, page_token, signature)
+
+    offset = None
+    if page_token and page_token.startswith("local:"):
+        match = _LOCAL_TOKEN.fullmatch(page_token)
+        if match is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        offset = int(match.group(1))
+    user = await sync_mailbox(service)
+    if user and (page_token is None or offset is not None):
+        await ensure_index(service, user)
+        local = await asyncio.to_thread(search_local, user, query, max_results, offset or 0)
+        if local is not None:
+            ids, older_than = local
+            next_token = None
+            if len(ids) == max_results:
+                next_token = f"local:{(offset or 0) + len(ids)}"
+            elif older_than is not None:
+                next_token = f"older:{older_than}:"
+                if not ids:
+                    return await _older_page(service, query, max_results, include_body, next_token, signature)
+            messages = await get_messages(service, ids, include_body, user)
+            return messages, encode_cursor(next_token, signature) if next_token else None
+    if offset is not None:
+        # The index stopped covering this query since the last page.
+        raise HTTPException(status_code=410, detail="Search results changed, restart the search")
+
+    return await load_page(service, list_kwargs, include_body, cursor, prefetch)
+
+async def _older_page(service, query: str, max_results: int, include_body: bool, page_token: str,
+                      signature: str):
+    """A page of Gmail matches older than the local index window."""
+    match = _OLDER_TOKEN.fullmatch(page_token)
+    if match is None:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    before, gmail_token = match.groups()
+    older_kwargs = {"q": f"{query} before:{before}", "maxResults": max_results}
+    messages, next_token = await _fetch_page(service, older_kwargs, include_body, gmail_token or None)
+    return messages, encode_cursor(f"older:{before}:{next_token}", signature) if next_token else None
 
 @router.post("/search")
-async def search_emails(search: SearchQuery, service = Depends(get_gmail_service)):
+async def search_emails(search: SearchQuery, if_none_match: Optional[str] = Header(None),
+                        service = Depends(get_gmail_service)):
     """Full-text Gmail search across subjects, body, and metadata."""
     try:
-        results = service.users().messages().list(
-            userId='me',
-            q=search.query,
-            maxResults=search.maxResults
-        ).execute()
-        
-        messages = results.get('messages', [])
-        email_list = []
-        
-        if messages:
-            batch = service.new_batch_http_request()
-            
-            def callback(request_id, response, exception):
-                if exception:
-                    print(f"Search error for {request_id}: {exception}")
-                else:
-                    headers = response['payload']['headers']
-                    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '(no subject)')
-                    curr_from = next((h['value'] for h in headers if h['name'] == 'From'), '(unknown)')
-                    date = next((h['value'] for h in headers if h['name'] == 'Date'), '')
-                    
-                    body_html, body_text = extract_body(response['payload'])
-                    
-                    email_list.append({
-                        "id": response['id'],
-                        "threadId": response['threadId'],
-                        "labelIds": response.get('labelIds', []),
-                        "snippet": response.get('snippet', ''),
-                        "subject": subject,
-                        "from": curr_from,
-                        "date": date,
-                        "isRead": 'UNREAD' not in response.get('labelIds', []),
-                        "bodyHtml": body_html,
-                        "bodyText": body_text
-                    })
-            
-            for msg in messages:
-                batch.add(service.users().messages().get(userId='me', id=msg['id'], format='full'), callback=callback)
-            
-            batch.execute()
-        
-        return email_list
+        messages, next_cursor = await search_messages(
+            service, search.query, search.maxResults, search.includeBody, search.cursor, search.prefetch
+        )
+        return paged_response(messages, next_cursor, if_none_match)
     
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Search Error: {e}")
+        logger.exception("search_error", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+async def send_message(service, to: str, subject: str, body: str, attachments=(),
+                       reply_to_id: Optional[str] = None, thread_id: Optional[str] = None,
+                       draft: bool = False):
+    """Build a message and send it (or save it as a draft) as a media upload."""
+    in_reply_to = await original_message_id(service, reply_to_id) if reply_to_id else None
+    message, size = await asyncio.to_thread(build_message, to, subject, body, attachments, in_reply_to)
+    try:
+        return await service.execute(upload_request(service, message, size, thread_id, draft))
+    finally:
+        message.close()
+
+async def original_message_id(service, message_id: str) -> Optional[str]:
+    """Message-ID header of the message being replied to, for threading."""
+    original = await service.execute(service.users().messages().get(
+        userId='me', id=message_id, format='metadata', metadataHeaders=['Message-ID']
+    ))
+    for header in original.get('payload', {}).get('headers', []):
+        if header['name'] == 'Message-ID':
+            return header['value']
+    return None
+
 @router.post("/send")
 async def send_email(email: ComposeEmail, service = Depends(get_gmail_service)):
     try:
-        message = EmailMessage()
-        message.set_content(email.body)
-        message['To'] = email.to
-        message['Subject'] = email.subject
-        
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        
-        create_message = {
-            'raw': encoded_message
-        }
-        
-        sent_message = service.users().messages().send(userId="me", body=create_message).execute()
-        return sent_message
+        return await send_message(service, email.to, email.subject, email.body)
     except Exception as e:
-        print(f"Send Email Error: {e}")
+        logger.exception("send_error", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 class ReplyEmail(BaseModel):
@@ -280,52 +557,112 @@ class ReplyEmail(BaseModel):
 @router.post("/reply")
 async def reply_to_email(email: ReplyEmail, service = Depends(get_gmail_service)):
     try:
-        # Get the original message to extract Message-ID header for threading
-        original = service.users().messages().get(userId='me', id=email.messageId, format='metadata', metadataHeaders=['Message-ID']).execute()
-        original_msg_id_header = ''
-        for header in original.get('payload', {}).get('headers', []):
-            if header['name'] == 'Message-ID':
-                original_msg_id_header = header['value']
-                break
-
-        message = EmailMessage()
-        message.set_content(email.body)
-        message['To'] = email.to
-        message['Subject'] = email.subject
-        if original_msg_id_header:
-            message['In-Reply-To'] = original_msg_id_header
-            message['References'] = original_msg_id_header
-        
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        
-        reply_message = service.users().messages().send(
-            userId="me",
-            body={
-                'raw': encoded_message,
-                'threadId': email.threadId
-            }
-        ).execute()
-        return reply_message
+        return await send_message(service, email.to, email.subject, email.body,
+                                  reply_to_id=email.messageId, thread_id=email.threadId)
     except Exception as e:
-        print(f"Reply Email Error: {e}")
+        logger.exception("reply_error", message_id=email.messageId, error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/compose")
+async def compose_email(
+    to: str = Form(""),
+    subject: str = Form(""),
+    body: str = Form(""),
+    messageId: Optional[str] = Form(None),
+    threadId: Optional[str] = Form(None),
+    draft: bool = Form(False),
+    attachments: List[UploadFile] = File([]),
+    service = Depends(get_gmail_service),
+):
+    """Send, reply or save a draft with attachments, as multipart/form-data.
+
+    Uploaded files are spooled to disk as they arrive and the message is
+    encoded from them a chunk at a time, so size is bounded by Gmail's
+    limit rather than by memory.
+    """
+    if not draft and not to:
+        raise HTTPException(status_code=400, detail="A recipient is required")
+    try:
+        files = [(f.filename, f.content_type, f.file) for f in attachments]
+        return await send_message(service, to, subject, body, files,
+                                  reply_to_id=messageId, thread_id=threadId, draft=draft)
+    except MessageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        logger.exception("compose_error", draft=draft, error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+# users.messages.batchModify accepts at most 1000 ids per call.
+BATCH_MODIFY_LIMIT = 1000
+
+# action -> (labels to add, labels to remove)
+BULK_ACTIONS = {
+    "mark_read": ([], ['UNREAD']),
+    "mark_unread": (['UNREAD'], []),
+    "archive": ([], ['INBOX']),
+    "trash": (['TRASH'], ['INBOX']),
+    "modify": ([], []),
+}
+
+class BulkModifyRequest(BaseModel):
+    messageIds: List[str]
+    action: Literal["mark_read", "mark_unread", "archive", "trash", "modify"]
+    addLabelIds: List[str] = []     # Extra labels, e.g. for action="modify"
+    removeLabelIds: List[str] = []
+
+async def bulk_modify(service, message_ids: List[str], add: List[str], remove: List[str]) -> List[dict]:
+    """batchModify in chunks Gmail accepts; one result per chunk."""
+    chunks = [message_ids[i:i + BATCH_MODIFY_LIMIT] for i in range(0, len(message_ids), BATCH_MODIFY_LIMIT)]
+    body = {}
+    if add:
+        body['addLabelIds'] = add
+    if remove:
+        body['removeLabelIds'] = remove
+    outcomes = await asyncio.gather(*[
+        service.execute(service.users().messages().batchModify(userId='me', body={'ids': chunk, **body}))
+        for chunk in chunks
+    ], return_exceptions=True)
+
+    results, modified = [], []
+    for chunk, outcome in zip(chunks, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error("batch_modify_error", count=len(chunk), error=str(outcome))
+            results.append({"count": len(chunk), "success": False, "error": str(outcome)})
+        else:
+            results.append({"count": len(chunk), "success": True})
+            modified.extend(chunk)
+
+    user = await mailbox_user(service)
+    if user and modified:
+        await asyncio.to_thread(store.update_labels, user, modified, add, remove)
+    return results
+
+@router.post("/bulk")
+async def bulk_modify_emails(req: BulkModifyRequest, service = Depends(get_gmail_service)):
+    """Mark read/unread, archive, trash or relabel many messages at once."""
+    add, remove = BULK_ACTIONS[req.action]
+    add = list(dict.fromkeys(add + req.addLabelIds))
+    remove = list(dict.fromkeys(remove + req.removeLabelIds))
+    if not req.messageIds or not (add or remove):
+        raise HTTPException(status_code=400, detail="Nothing to modify")
+    chunks = await bulk_modify(service, req.messageIds, add, remove)
+    if not any(chunk["success"] for chunk in chunks):
+        raise HTTPException(status_code=500, detail=chunks[0]["error"])
+    return {"success": all(chunk["success"] for chunk in chunks), "chunks": chunks}
+
 class MarkReadRequest(BaseModel):
     messageIds: List[str]
 
 @router.post("/mark-read")
 async def mark_as_read(req: MarkReadRequest, service = Depends(get_gmail_service)):
-    try:
-        for msg_id in req.messageIds:
-            service.users().messages().modify(
-                userId='me',
-                id=msg_id,
-                body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+    if not req.messageIds:
         return {"success": True}
-    except Exception as e:
-        print(f"Mark Read Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    chunks = await bulk_modify(service, req.messageIds, [], ['UNREAD'])
+    failed = [chunk for chunk in chunks if not chunk["success"]]
+    if failed:
+        logger.error("mark_read_error", error=failed[0]['error'])
+        raise HTTPException(status_code=500, detail=failed[0]["error"])
+    return {"success": True}
 
 class DraftEmail(BaseModel):
     to: str = ""
@@ -335,21 +672,9 @@ class DraftEmail(BaseModel):
 @router.post("/drafts/create")
 async def create_draft(email: DraftEmail, service = Depends(get_gmail_service)):
     try:
-        message = EmailMessage()
-        message.set_content(email.body)
-        if email.to:
-            message['To'] = email.to
-        message['Subject'] = email.subject
-        
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        
-        draft = service.users().drafts().create(
-            userId='me',
-            body={'message': {'raw': encoded_message}}
-        ).execute()
-        return draft
+        return await send_message(service, email.to, email.subject, email.body, draft=True)
     except Exception as e:
-        print(f"Create Draft Error: {e}")
+        logger.exception("create_draft_error", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 class TrashRequest(BaseModel):
@@ -359,11 +684,16 @@ class TrashRequest(BaseModel):
 async def trash_email(req: TrashRequest, service = Depends(get_gmail_service)):
     """Move an email to trash."""
     try:
-        service.users().messages().trash(
+        await service.execute(service.users().messages().trash(
             userId='me',
             id=req.messageId
-        ).execute()
+        ))
+        user = await mailbox_user(service)
+        if user:
+            # Kept, relabelled, as for a bulk trash: a restore only changes labels back.
+            add, remove = BULK_ACTIONS["trash"]
+            await asyncio.to_thread(store.update_labels, user, [req.messageId], add, remove)
         return {"success": True}
     except Exception as e:
-        print(f"Trash Error: {e}")
+        logger.exception("trash_error", message_id=req.messageId, error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -1,8 +1,9 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path="../.env.local")
@@ -10,8 +11,19 @@ load_dotenv(dotenv_path="../.env.local")
 from auth import router as auth_router
 from ai import router as ai_router
 from mail import router as mail_router
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware
+import attachments
+import metrics
+import openrouter
 
-app = FastAPI(title="Mail AI Backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await openrouter.aclose()
+    await attachments.aclose()
+
+app = FastAPI(title="Mail AI Backend", lifespan=lifespan)
 
 app.include_router(auth_router)
 app.include_router(ai_router)
@@ -23,12 +35,31 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Content-Range", "Accept-Ranges", "Content-Disposition"],
+)
+
+# Listings and threads can carry MBs of bodyHtml; compress them once they
+# are big enough to be worth it. Streaming responses are left alone.
+app.add_middleware(
+    CompressionMiddleware,
+    prefixes=["/api/mail"],
+    minimum_size=int(os.getenv("COMPRESS_MIN_SIZE", 1024)),
+    gzip_level=int(os.getenv("COMPRESS_GZIP_LEVEL", 6)),
+    brotli_quality=int(os.getenv("COMPRESS_BROTLI_QUALITY", 4)),
 )
 
+# Outermost, so the timings include CORS and compression.
+app.add_middleware(MetricsMiddleware)
+
 @app.get("/")
 def read_root():
     return {"message": "Mail AI Backend is running"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Request, Gmail and OpenRouter latency histograms for Prometheus."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
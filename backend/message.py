@@ -0,0 +1,116 @@
+from typing import Any, List, Optional
+
+import orjson
+from fastapi.responses import Response
+
+class ParsedMessage:
+    """One Gmail message in the shape the mail routes return.
+
+    Shared by listings, threads, search and the local store. Body fields
+    stay None for metadata-only fetches, and `to_dict()` then leaves them out.
+    """
+
+    __slots__ = (
+        "id", "threadId", "labelIds", "snippet", "subject", "sender", "to", "date",
+        "internalDate", "bodyHtml", "bodyText", "attachments",
+    )
+
+    def __init__(self, id: str, threadId: str, labelIds: List[str], snippet: str = "",
+                 subject: str = "(no subject)", sender: str = "(unknown)", to: str = "", date: str = "",
+                 internalDate: int = 0, bodyHtml: Optional[str] = None, bodyText: Optional[str] = None,
+                 attachments: Optional[List[dict]] = None):
+        self.id = id
+        self.threadId = threadId
+        self.labelIds = labelIds
+        self.snippet = snippet
+        self.subject = subject
+        self.sender = sender
+        self.to = to
+        self.date = date
+        self.internalDate = internalDate
+        self.bodyHtml = bodyHtml
+        self.bodyText = bodyText
+        self.attachments = attachments
+
+    @classmethod
+    def from_gmail(cls, msg: dict, body: Optional[dict] = None) -> "ParsedMessage":
+        """Build from a users.messages.get resource with one pass over its headers."""
+        subject = sender = to = date = None
+        for header in msg['payload'].get('headers', ()):
+            name = header['name']
+            # First occurrence wins, as with the old next(...) lookups.
+            if name == 'Subject':
+                if subject is None:
+                    subject = header['value']
+            elif name == 'From':
+                if sender is None:
+                    sender = header['value']
+            elif name == 'To':
+                if to is None:
+                    to = header['value']
+            elif name == 'Date':
+                if date is None:
+                    date = header['value']
+            else:
+                continue
+            if subject is not None and sender is not None and to is not None and date is not None:
+                break
+        parsed = cls(
+            msg['id'], msg['threadId'], msg.get('labelIds', []), msg.get('snippet', ''),
+            '(no subject)' if subject is None else subject,
+            '(unknown)' if sender is None else sender,
+            to or '', date or '', int(msg.get('internalDate', 0)),  # Epoch ms from Gmail
+        )
+        if body is not None:
+            parsed.set_body(body)
+        return parsed
+
+    def set_body(self, body: dict) -> None:
+        """Fill in the body fields from a mail.cache_body dict."""
+        self.bodyHtml = body["bodyHtml"]
+        self.bodyText = body["bodyText"]
+        self.attachments = body["attachments"]
+
+    @property
+    def isRead(self) -> bool:
+        return 'UNREAD' not in self.labelIds
+
+    @property
+    def has_body(self) -> bool:
+        return self.bodyHtml is not None
+
+    def to_dict(self) -> dict:
+        data = {
+            "id": self.id,
+            "threadId": self.threadId,
+            "labelIds": self.labelIds,
+            "snippet": self.snippet,
+            "subject": self.subject,
+            "from": self.sender,
+            "to": self.to,
+            "date": self.date,
+            "internalDate": self.internalDate,
+            "isRead": 'UNREAD' not in self.labelIds,
+        }
+        if self.bodyHtml is not None:
+            data["bodyHtml"] = self.bodyHtml
+            data["bodyText"] = self.bodyText
+            data["attachments"] = self.attachments
+        return data
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, ParsedMessage):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+class FastJSONResponse(Response):
+    """JSON response encoded straight from our objects with orjson.
+
+    Returning it from a route bypasses FastAPI's jsonable_encoder and
+    response validation, which is most of the per-message cost.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_default)
@@ -0,0 +1,158 @@
+import asyncio
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from log import get_logger
+
+logger = get_logger("metrics")
+
+# Requests slower than this are logged. A fraction PROFILE_SAMPLE_RATE of
+# requests runs under cProfile (one at a time), and the hottest functions
+# are logged when such a request turns out slow; 0 turns profiling off.
+SLOW_REQUEST_SECONDS = float(os.getenv("METRICS_SLOW_REQUEST_SECONDS", 2))
+PROFILE_SAMPLE_RATE = float(os.getenv("METRICS_PROFILE_SAMPLE_RATE", 0))
+PROFILE_TOP = int(os.getenv("METRICS_PROFILE_TOP", 25))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Histogram:
+    """Prometheus histogram with fixed buckets; safe to observe from any thread."""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._series.items())]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket = _labels(self.labels, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to serve a request, streaming bodies included.",
+    ["method", "route", "status"],
+)
+GMAIL_LATENCY = Histogram(
+    "gmail_request_duration_seconds", "Gmail API call latency, excluding time queued for quota or a worker.",
+    ["operation", "outcome"],
+)
+OPENROUTER_LATENCY = Histogram(
+    "openrouter_request_duration_seconds", "OpenRouter completion latency, to the last streamed token.",
+    ["model", "mode", "outcome"],
+)
+OPENROUTER_TOKENS = Histogram(
+    "openrouter_tokens", "Tokens per OpenRouter completion; _sum is the total billed.", ["model", "type"], buckets=TOKEN_BUCKETS,
+)
+
+REGISTRY = [REQUEST_LATENCY, GMAIL_LATENCY, OPENROUTER_LATENCY, OPENROUTER_TOKENS]
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+def observe_tokens(model: str, usage: Optional[dict]) -> None:
+    """Record the prompt and completion token counts of an OpenRouter `usage` object."""
+    for kind in ("prompt", "completion"):
+        tokens = (usage or {}).get(f"{kind}_tokens")
+        if tokens is not None:
+            OPENROUTER_TOKENS.observe(tokens, model, kind)
+
+_profiling = threading.Lock()
+
+def _profile_report(profile: cProfile.Profile) -> str:
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("tottime").print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+class MetricsMiddleware:
+    """Times every HTTP request into REQUEST_LATENCY, labelled by route
+    template so /message/{id} is one series, and logs slow ones.
+
+    A sampled request is run under cProfile. The profiler sees the whole
+    event loop thread, so concurrent requests show up in its report too;
+    Gmail calls on the worker pool do not.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status, streaming = 500, False
+
+        async def send_wrapper(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                streaming = any(name == b"content-type" and value.startswith(b"text/event-stream")
+                                for name, value in message.get("headers", []))
+            await send(message)
+
+        profile = None
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE and _profiling.acquire(blocking=False):
+            profile = cProfile.Profile()
+            profile.enable()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+                _profiling.release()
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            REQUEST_LATENCY.observe(elapsed, scope["method"], route, str(status))
+            # Event streams stay open by design; they are timed but never "slow".
+            if elapsed >= SLOW_REQUEST_SECONDS and not streaming:
+                fields = {"method": scope["method"], "route": route, "status": status,
+                          "seconds": round(elapsed, 3)}
+                if profile is not None:
+                    fields["profile"] = await asyncio.to_thread(_profile_report, profile)
+                logger.warning("slow_request", **fields)
@@ -0,0 +1,148 @@
+import base64
+import codecs
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+class Attachment:
+    """Descriptor of a non-body part; the data itself is never decoded here."""
+
+    __slots__ = ("partId", "filename", "mimeType", "size", "attachmentId")
+
+    def __init__(self, part: dict):
+        body = part.get('body', {})
+        self.partId = part.get('partId', '')
+        self.filename = part.get('filename', '')
+        self.mimeType = part.get('mimeType', '')
+        self.size = body.get('size', 0)
+        self.attachmentId = body.get('attachmentId')
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class MimeBody:
+    __slots__ = ("html", "text", "attachments", "truncated", "deferred")
+
+    def __init__(self, html: str = "", text: str = "", attachments: Optional[List[Attachment]] = None,
+                 truncated: bool = False):
+        self.html = html
+        self.text = text
+        self.attachments = attachments or []
+        self.truncated = truncated
+        # ("html" or "text", part) for body parts whose data Gmail left
+        # behind an attachmentId; see fill_deferred().
+        self.deferred: List[Tuple[str, dict]] = []
+
+@lru_cache(maxsize=64)
+def _normalize_charset(charset: str) -> str:
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return 'utf-8'
+
+def _header(part: dict, name: str) -> str:
+    for header in part.get('headers', []):
+        if header['name'].lower() == name:
+            return header['value']
+    return ''
+
+def _charset(part: dict) -> str:
+    for param in _header(part, 'content-type').split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            return _normalize_charset(value.strip('"\' ').lower())
+    return 'utf-8'
+
+def decode_part(part: dict, max_bytes: Optional[int] = None):
+    """Decode a part's base64url data; returns (text, truncated).
+
+    With `max_bytes`, only the base64 prefix needed for that many bytes is
+    decoded, and a multi-byte character cut at the boundary is dropped.
+    """
+    data = part.get('body', {}).get('data', '')
+    charset = _charset(part)
+    truncated = False
+    if max_bytes is not None and len(data) * 3 // 4 > max_bytes:
+        quads = -(-max_bytes // 3)  # ceil: 4 base64 chars carry 3 bytes
+        data = data[:quads * 4]
+        truncated = True
+    if len(data) % 4:
+        data += '=' * (-len(data) % 4)
+    raw = base64.urlsafe_b64decode(data)
+    if truncated:
+        raw = raw[:max_bytes]
+        decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        return decoder.decode(raw, final=False), True
+    return raw.decode(charset, errors='replace'), False
+
+def _is_attachment(part: dict) -> bool:
+    """A part with a filename or an attachment disposition.
+
+    Gmail also moves large text/html and text/plain bodies behind an
+    attachmentId, so without a filename only non-text parts that are not
+    marked inline count as attachments.
+    """
+    if part.get('filename'):
+        return True
+    disposition = _header(part, 'content-disposition').split(';')[0].strip().lower()
+    if disposition == 'attachment':
+        return True
+    if disposition == 'inline' or part.get('mimeType', '').startswith('text/'):
+        return False
+    return 'attachmentId' in part.get('body', {})
+
+def _has_content(part: dict) -> bool:
+    body = part.get('body', {})
+    return bool(body.get('data') or body.get('attachmentId'))
+
+def extract_body(payload: dict, max_bytes: Optional[int] = None) -> MimeBody:
+    """Pick the message's text/html and text/plain bodies in a single pass.
+
+    The part tree is walked iteratively in document order; the first inline
+    text/html and text/plain parts win. Only those two parts are decoded,
+    and every attachment part is reported as an Attachment instead. A
+    chosen part whose data Gmail did not include is left in `deferred`.
+    """
+    html_part = text_part = None
+    attachments = []
+
+    # A single-part message is its own only leaf.
+    stack = list(reversed(payload['parts'])) if 'parts' in payload else [payload]
+    while stack:
+        part = stack.pop()
+        if 'parts' in part:
+            stack.extend(reversed(part['parts']))
+            continue
+        if _is_attachment(part):
+            attachments.append(Attachment(part))
+            continue
+        if not _has_content(part):
+            continue
+        mime_type = part.get('mimeType', '')
+        if part is payload:
+            # The body of a single-part message may be any text type.
+            mime_type = 'text/html' if 'html' in mime_type else 'text/plain'
+        if mime_type == 'text/html' and html_part is None:
+            html_part = part
+        elif mime_type == 'text/plain' and text_part is None:
+            text_part = part
+
+    body = MimeBody(attachments=attachments)
+    for field, part in (("html", html_part), ("text", text_part)):
+        if part is None:
+            continue
+        if part.get('body', {}).get('data'):
+            _set_field(body, field, part, max_bytes)
+        else:
+            body.deferred.append((field, part))
+    return body
+
+def _set_field(body: MimeBody, field: str, part: dict, max_bytes: Optional[int]) -> None:
+    text, truncated = decode_part(part, max_bytes)
+    setattr(body, field, text)
+    body.truncated |= truncated
+
+def fill_deferred(body: MimeBody, data: List[str], max_bytes: Optional[int] = None) -> None:
+    """Decode the fetched data of `body.deferred`, in the same order."""
+    for (field, part), part_data in zip(body.deferred, data):
+        _set_field(body, field, {**part, 'body': {'data': part_data}}, max_bytes)
+    body.deferred = []
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from metrics import OPENROUTER_LATENCY, observe_tokens
+
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+DEFAULT_MODEL = os.getenv("OPENROUTER_MODEL", "nvidia/nemotron-3-nano-30b-a3b:free")
+
+CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", 60))
+MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", 2))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Hedging: if the first request is still running after the observed p95
+# latency, fire a second one (optionally on a fallback model) and take
+# whichever answers first.
+HEDGE_ENABLED = os.getenv("OPENROUTER_HEDGE", "0") == "1"
+HEDGE_FALLBACK_MODEL = os.getenv("OPENROUTER_FALLBACK_MODEL")
+HEDGE_DEFAULT_DELAY = float(os.getenv("OPENROUTER_HEDGE_AFTER", 8))
+HEDGE_MIN_SAMPLES = 20
+
+_client: Optional[httpx.AsyncClient] = None
+_latencies: deque = deque(maxlen=200)
+
+class OpenRouterError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+def get_client() -> httpx.AsyncClient:
+    """Shared keep-alive client; created lazily so it binds to the running loop."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=OPENROUTER_BASE_URL,
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+        )
+    return _client
+
+async def aclose() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY', '')}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": os.getenv("NEXT_PUBLIC_APP_URL", "http://localhost:3000"),
+        "X-Title": "Mail AI App",
+    }
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, honouring Retry-After when present."""
+    if retry_after:
+        try:
+            return min(float(retry_after), 30.0)
+        except ValueError:
+            pass
+    return random.uniform(0, min(0.5 * 2 ** attempt, 8.0))
+
+def hedge_delay() -> float:
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    ordered = sorted(_latencies)
+    return ordered[int(len(ordered) * 0.95) - 1]
+
+async def _post(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """POST a completion request, retrying transport errors, 429 and 5xx."""
+    model = payload["model"]
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        started = time.monotonic()
+        try:
+            response = await get_client().post("/chat/completions", json=payload, headers=_headers())
+        except httpx.TimeoutException as e:
+            OPENROUTER_LATENCY.observe(time.monotonic() - started, model, "complete", "timeout")
+            if attempt == MAX_RETRIES:
+                raise OpenRouterError(504, f"Timed out: {e!r}")
+        except httpx.TransportError as e:
+            OPENROUTER_LATENCY.observe(time.monotonic() - started, model, "complete", "error")
+            if attempt == MAX_RETRIES:
+                raise OpenRouterError(502, f"Connection error: {e!r}")
+        else:
+            elapsed = time.monotonic() - started
+            OPENROUTER_LATENCY.observe(elapsed, model, "complete",
+                                       "ok" if response.status_code == 200 else str(response.status_code))
+            if response.status_code == 200:
+                _latencies.append(elapsed)
+                data = response.json()
+                observe_tokens(model, data.get("usage"))
+                return data
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                raise OpenRouterError(response.status_code, response.text)
+            retry_after = response.headers.get("Retry-After")
+        await asyncio.sleep(_backoff(attempt, retry_after))
+
+async def _hedged(payload: Dict[str, Any]) -> Dict[str, Any]:
+    primary = asyncio.create_task(_post(payload))
+    pending = {primary}
+    error: Optional[BaseException] = None
+    # Everything sits inside the try so that, however this returns or is
+    # cancelled, no request is left running.
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_delay())
+        if done:
+            return primary.result()
+
+        hedge_payload = dict(payload, model=HEDGE_FALLBACK_MODEL or payload["model"])
+        pending.add(asyncio.create_task(_post(hedge_payload)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        # Wait for them to wind down so their connections go back to the pool.
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def chat_completion(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    hedge: Optional[bool] = None,
+    **params: Any,
+) -> Dict[str, Any]:
+    """Run a chat completion and return the decoded OpenRouter response."""
+    payload = {"model": model or DEFAULT_MODEL, "messages": messages, **params}
+    if HEDGE_ENABLED if hedge is None else hedge:
+        return await _hedged(payload)
+    return await _post(payload)
+
+async def stream_chat_completion(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    usage: Optional[Dict[str, Any]] = None,
+    **params: Any,
+) -> AsyncIterator[str]:
+    """Yield content deltas from a streamed completion.
+
+    Failures are retried like `chat_completion` only until the first delta
+    has been yielded; after that the error propagates to the caller. If a
+    `usage` dict is given it is filled from the final chunk's token usage.
+    """
+    payload = {"model": model or DEFAULT_MODEL, "messages": messages, "stream": True, **params}
+    model = payload["model"]
+    yielded = False
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        started = time.monotonic()
+        # Anything that leaves the attempt without setting this (the caller
+        # closing the stream, a malformed chunk) counts as an error.
+        outcome = "error"
+        try:
+            async with get_client().stream("POST", "/chat/completions", json=payload, headers=_headers()) as response:
+                if response.status_code != 200:
+                    outcome = str(response.status_code)
+                    body = (await response.aread()).decode(errors="replace")
+                    if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                        raise OpenRouterError(response.status_code, body)
+                    retry_after = response.headers.get("Retry-After")
+                else:
+                    final_usage = None
+                    async for line in response.aiter_lines():
+                        # OpenRouter interleaves ": OPENROUTER PROCESSING" comments.
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            raise OpenRouterError(502, json.dumps(chunk["error"]))
+                        if chunk.get("usage"):
+                            final_usage = chunk["usage"]
+                            if usage is not None:
+                                usage.update(final_usage)
+                        choices = chunk.get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            yielded = True
+                            yield delta
+                    outcome = "ok"
+                    observe_tokens(model, final_usage)
+                    return
+        except httpx.TimeoutException as e:
+            outcome = "timeout"
+            if yielded or attempt == MAX_RETRIES:
+                raise OpenRouterError(504, f"Timed out: {e!r}")
+        except httpx.TransportError as e:
+            if yielded or attempt == MAX_RETRIES:
+                raise OpenRouterError(502, f"Connection error: {e!r}")
+        finally:
+            OPENROUTER_LATENCY.observe(time.monotonic() - started, model, "stream", outcome)
+        await asyncio.sleep(_backoff(attempt, retry_after))
@@ -0,0 +1,108 @@
+import base64
+import os
+import tempfile
+import uuid
+from email.message import EmailMessage
+from email.policy import SMTP
+from typing import BinaryIO, Iterable, Optional, Tuple
+
+from googleapiclient.http import MediaIoBaseUpload
+
+# Outgoing messages are assembled in a spooled temp file: in memory up to
+# this many bytes, on disk beyond that.
+OUTGOING_SPOOL_MEMORY = int(os.getenv("MAIL_OUTGOING_SPOOL_MEMORY", 1024 * 1024))
+
+# Gmail's limit for a whole message, attachments and MIME encoding included.
+MAX_MESSAGE_BYTES = int(os.getenv("MAIL_MAX_MESSAGE_BYTES", 35 * 1024 * 1024))
+
+# Messages above this size go through a resumable upload, sent in chunks
+# of UPLOAD_CHUNK_SIZE (Google wants multiples of 256 KiB); smaller ones
+# as a single multipart request.
+UPLOAD_RESUMABLE_THRESHOLD = int(os.getenv("MAIL_UPLOAD_RESUMABLE_THRESHOLD", 5 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = max(1, int(os.getenv("MAIL_UPLOAD_CHUNK_SIZE", 1024 * 1024)) // (256 * 1024)) * 256 * 1024
+
+# Attachments are encoded this many input bytes at a time: a whole number
+# of 76-character base64 lines (57 bytes each).
+_ENCODE_CHUNK = 57 * 4096
+
+class MessageTooLarge(Exception):
+    """The message would exceed MAX_MESSAGE_BYTES."""
+
+def _headers(message: EmailMessage, to: str, subject: str, in_reply_to: Optional[str]) -> None:
+    if to:
+        message['To'] = to
+    message['Subject'] = subject
+    if in_reply_to:
+        message['In-Reply-To'] = in_reply_to
+        message['References'] = in_reply_to
+
+def _header_bytes(message: EmailMessage) -> bytes:
+    """Just the header block of `message`, so a body can be streamed after it."""
+    return b"".join(SMTP.fold_binary(name, value) for name, value in message.items()) + b"\r\n"
+
+def _check_size(out: BinaryIO) -> None:
+    if out.tell() > MAX_MESSAGE_BYTES:
+        raise MessageTooLarge(f"Message is larger than {MAX_MESSAGE_BYTES // (1024 * 1024)} MB")
+
+def _write_base64(out: BinaryIO, source: BinaryIO) -> None:
+    """Base64-encode `source` into `out` with CRLF line breaks, one chunk at a time."""
+    carry = b""
+    while chunk := source.read(_ENCODE_CHUNK):
+        chunk = carry + chunk
+        cut = len(chunk) - len(chunk) % 57
+        carry = chunk[cut:]
+        out.write(base64.encodebytes(chunk[:cut]).replace(b"\n", b"\r\n"))
+        _check_size(out)
+    if carry:
+        out.write(base64.encodebytes(carry).replace(b"\n", b"\r\n"))
+
+def build_message(to: str, subject: str, body: str,
+                  attachments: Iterable[Tuple[str, str, BinaryIO]] = (),
+                  in_reply_to: Optional[str] = None) -> Tuple[BinaryIO, int]:
+    """Write a MIME message to a spooled temp file; returns it rewound, and its size.
+
+    `attachments` are (filename, content type, file object) and are read
+    and encoded a chunk at a time, so neither they nor their base64 are
+    ever held whole. Blocking; raises MessageTooLarge.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=OUTGOING_SPOOL_MEMORY)
+    text = EmailMessage(policy=SMTP)
+    text.set_content(body)
+    attachments = list(attachments)
+    if not attachments:
+        _headers(text, to, subject, in_reply_to)
+        out.write(text.as_bytes())
+    else:
+        boundary = f"=_{uuid.uuid4().hex}"
+        message = EmailMessage(policy=SMTP)
+        _headers(message, to, subject, in_reply_to)
+        message['MIME-Version'] = '1.0'
+        message['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+        out.write(_header_bytes(message))
+        out.write(f"--{boundary}\r\n".encode())
+        del text['MIME-Version']
+        out.write(text.as_bytes())
+        for filename, content_type, source in attachments:
+            part = EmailMessage(policy=SMTP)
+            part['Content-Type'] = content_type or 'application/octet-stream'
+            part.add_header('Content-Disposition', 'attachment', filename=filename or 'attachment')
+            part['Content-Transfer-Encoding'] = 'base64'
+            out.write(f"\r\n--{boundary}\r\n".encode())
+            out.write(_header_bytes(part))
+            _write_base64(out, source)
+        out.write(f"\r\n--{boundary}--\r\n".encode())
+    _check_size(out)
+    size = out.tell()
+    out.seek(0)
+    return out, size
+
+def upload_request(service, message: BinaryIO, size: int, thread_id: Optional[str] = None, draft: bool = False):
+    """messages.send (or drafts.create) with the message as a media upload
+    instead of a base64 `raw` field in the JSON body."""
+    media = MediaIoBaseUpload(message, mimetype='message/rfc822', chunksize=UPLOAD_CHUNK_SIZE,
+                              resumable=size > UPLOAD_RESUMABLE_THRESHOLD)
+    if draft:
+        body = {'message': {'threadId': thread_id}} if thread_id else None
+        return service.users().drafts().create(userId='me', body=body, media_body=media)
+    body = {'threadId': thread_id} if thread_id else None
+    return service.users().messages().send(userId='me', body=body, media_body=media)
@@ -0,0 +1,98 @@
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Token budget for the whole prompt: system prompt, email context, history
+# and the user's message. The reply's max_tokens comes on top of this.
+PROMPT_TOKEN_BUDGET = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", 6000))
+# Most of the budget a single email body may take, however much is left.
+EMAIL_BODY_MAX_TOKENS = int(os.getenv("AI_EMAIL_BODY_MAX_TOKENS", 1500))
+# Per-message cap for conversation history, so one long summary does not
+# push out everything before it.
+HISTORY_MESSAGE_MAX_TOKENS = int(os.getenv("AI_HISTORY_MESSAGE_MAX_TOKENS", 400))
+
+# Chat templates add a few tokens of framing per message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_QUOTED_REPLY = re.compile(r"^\s*On .{0,200}wrote:\s*$", re.MULTILINE)
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, ~4 characters per token for English text.
+
+    Good enough for budgeting; the provider's reported usage is the real
+    number.
+    """
+    return (len(text) + 3) // 4
+
+def estimate_messages(messages: List[Dict[str, Any]]) -> int:
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        total += estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return total
+
+def condense(text: str) -> str:
+    """Drop what a model does not need from an email body: quoted replies,
+    "> " lines and runs of whitespace."""
+    match = _QUOTED_REPLY.search(text)
+    if match and text[:match.start()].strip():
+        text = text[:match.start()]
+    lines = [line for line in text.splitlines() if not line.lstrip().startswith(">")]
+    return re.sub(r"[ \t]+", " ", re.sub(r"\n\s*\n+", "\n\n", "\n".join(lines))).strip()
+
+_TRUNCATED = " [... {} more tokens truncated]"
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut `text` to at most `max_tokens`, at a word boundary, noting the cut."""
+    total = estimate_tokens(text)
+    if total <= max_tokens:
+        return text
+    # The note comes out of the allowance too; its count is at most `total`.
+    limit = (max_tokens - estimate_tokens(_TRUNCATED.format(total))) * 4
+    if limit <= 0:
+        return ""
+    cut = text.rfind(" ", 0, limit)
+    kept = text[:cut if cut > limit // 2 else limit].rstrip()
+    return kept + _TRUNCATED.format(total - estimate_tokens(kept))
+
+class Budget:
+    """Tokens left to spend on optional context."""
+
+    def __init__(self, total: int):
+        self.remaining = total
+
+    def spend(self, text: str) -> bool:
+        """Take `text` if it fits; returns whether it did."""
+        cost = estimate_tokens(text) + 1  # joining newline
+        if cost > self.remaining:
+            return False
+        self.remaining -= cost
+        return True
+
+def pack_history(history: List[Tuple[str, str]], budget: Budget, limit: int = 10) -> List[Dict[str, str]]:
+    """Newest-first (role, content) pairs that fit the budget, returned oldest first."""
+    packed = []
+    for role, content in reversed(history[-limit:]):
+        content = truncate_tokens(content, HISTORY_MESSAGE_MAX_TOKENS)
+        if not budget.spend(content):
+            break
+        budget.remaining -= MESSAGE_OVERHEAD_TOKENS
+        packed.append({"role": role, "content": content})
+    packed.reverse()
+    return packed
+
+def pack_lines(lines: List[str], budget: Budget) -> Tuple[List[str], int]:
+    """Leading `lines` that fit the budget, and how many were left out."""
+    for i, line in enumerate(lines):
+        if not budget.spend(line):
+            return lines[:i], len(lines) - i
+    return lines, 0
+
+def pack_body(body: str, budget: Budget, max_tokens: Optional[int] = None) -> str:
+    """Condensed body trimmed to the smaller of its cap and what is left;
+    empty if not even that fits."""
+    cap = EMAIL_BODY_MAX_TOKENS if max_tokens is None else max_tokens
+    body = truncate_tokens(condense(body), min(cap, budget.remaining - 1))
+    return body if body and budget.spend(body) else ""
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import random
+import time
+from typing import Any, Dict
+
+from googleapiclient.errors import HttpError
+
+# Gmail allows 250 quota units per user per second (as a moving average);
+# requests are paced to stay a little under that.
+GMAIL_QUOTA_RATE = float(os.getenv("GMAIL_QUOTA_RATE", 200))
+GMAIL_QUOTA_BURST = float(os.getenv("GMAIL_QUOTA_BURST", 250))
+
+# Batch size adapts to rate limiting: halved after a batch with throttled
+# sub-requests, grown by GMAIL_BATCH_STEP after a clean one. Gmail rejects
+# batches over 100 requests and starts rate limiting well before that.
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", 50))
+GMAIL_MIN_BATCH_SIZE = int(os.getenv("GMAIL_MIN_BATCH_SIZE", 5))
+GMAIL_BATCH_STEP = 5
+
+# Failed requests are retried with exponential backoff until either limit.
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", 4))
+GMAIL_RETRY_BASE = float(os.getenv("GMAIL_RETRY_BASE", 0.5))
+GMAIL_RETRY_DEADLINE = float(os.getenv("GMAIL_RETRY_DEADLINE", 10))
+
+# Quota units per method, from developers.google.com/gmail/api/reference/quota.
+METHOD_UNITS = {
+    "gmail.users.getProfile": 1,
+    "gmail.users.drafts.create": 10,
+    "gmail.users.history.list": 2,
+    "gmail.users.messages.attachments.get": 5,
+    "gmail.users.messages.batchModify": 50,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.messages.send": 100,
+    "gmail.users.messages.trash": 5,
+    "gmail.users.threads.get": 10,
+    "gmail.users.threads.list": 10,
+}
+DEFAULT_UNITS = 5
+
+_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+def request_units(request) -> int:
+    return METHOD_UNITS.get(getattr(request, "methodId", None), DEFAULT_UNITS)
+
+# Server errors worth retrying; rate limits are recognised separately.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+def is_rate_limited_status(status: int, content: bytes) -> bool:
+    if status == 429:
+        return True
+    # Gmail also reports per-user rate limits as 403s.
+    return status == 403 and any(reason.encode() in (content or b"") for reason in _RATE_LIMIT_REASONS)
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, HttpError) and is_rate_limited_status(error.resp.status, error.content)
+
+# Methods that must not run twice. A 5xx can come after Gmail has accepted
+# the message, so these are only retried when rate limited, which Gmail
+# answers before doing anything.
+NON_IDEMPOTENT_METHODS = {
+    "gmail.users.drafts.create",
+    "gmail.users.drafts.send",
+    "gmail.users.messages.import",
+    "gmail.users.messages.insert",
+    "gmail.users.messages.send",
+}
+
+def is_idempotent(request) -> bool:
+    return getattr(request, "methodId", None) not in NON_IDEMPOTENT_METHODS
+
+def is_retryable(error: Exception, request=None) -> bool:
+    """Rate limits and transient server errors; anything else will fail again.
+
+    With `request`, server errors only count for idempotent methods, and a
+    resumable upload is never retried once its session has started: its
+    stream is partly consumed and Gmail may already hold some of it.
+    """
+    if request is not None and getattr(request, "resumable_uri", None) is not None:
+        return False
+    if is_rate_limited(error):
+        return True
+    return (isinstance(error, HttpError) and error.resp.status in RETRY_STATUSES
+            and (request is None or is_idempotent(request)))
+
+def backoff(attempt: int) -> float:
+    # Jittered so throttled requests from several callers do not retry in step.
+    return GMAIL_RETRY_BASE * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+class QuotaScheduler:
+    """Quota pacing and batch sizing for one Gmail user.
+
+    `acquire()` is a token bucket in quota units refilled at
+    GMAIL_QUOTA_RATE per second. A request costing more than the bucket
+    holds waits for a full bucket and then takes it into debt, so big
+    batches pay for themselves by delaying whoever comes next.
+    """
+
+    def __init__(self, rate: float = GMAIL_QUOTA_RATE, burst: float = GMAIL_QUOTA_BURST):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.batch_size = GMAIL_BATCH_SIZE
+        self.error_rate = 0.0  # moving average of the throttled fraction per batch
+        self._lock = asyncio.Lock()
+        self.units = 0
+        self.waited = 0.0
+        self.throttled = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, units: int) -> None:
+        # The lock makes waiters queue in order instead of all waking at once.
+        async with self._lock:
+            self._refill()
+            need = min(units, self.capacity)
+            if self.tokens < need:
+                delay = (need - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self._refill()
+            self.tokens -= units
+            self.units += units
+
+    def observe(self, total: int, throttled: int) -> None:
+        """Adapt the batch size to one batch's outcome."""
+        self.error_rate = 0.8 * self.error_rate + 0.2 * (throttled / total if total else 0.0)
+        if throttled:
+            self.throttled += throttled
+            self.batch_size = max(GMAIL_MIN_BATCH_SIZE, self.batch_size // 2)
+            # Whatever Gmail thinks we used, we are out for now.
+            self.tokens = min(self.tokens, 0)
+        else:
+            self.batch_size = min(GMAIL_BATCH_SIZE, self.batch_size + GMAIL_BATCH_STEP)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batchSize": self.batch_size,
+            "errorRate": round(self.error_rate, 4),
+            "units": self.units,
+            "waitedSeconds": round(self.waited, 3),
+            "throttled": self.throttled,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from log import get_logger
+from sync import store
+
+logger = get_logger("search_index")
+
+# How far back the background backfill indexes a mailbox, and a cap on how
+# many messages it will fetch to get there. 0 days disables local search.
+INDEX_DAYS = int(os.getenv("MAIL_INDEX_DAYS", 30))
+INDEX_MAX_MESSAGES = int(os.getenv("MAIL_INDEX_MAX_MESSAGES", 2000))
+# Messages per messages.list page during the backfill; 500 is Gmail's maximum.
+INDEX_PAGE_SIZE = 500
+
+_TOKEN = re.compile(r'(-?)(\w+):("[^"]*"|\([^)]*\)|\S+)|(-?)"([^"]*)"|(\S+)')
+_FIELDS = {"from": "sender", "to": "recipients", "subject": "subject"}
+_IS_LABELS = {"unread": "UNREAD", "starred": "STARRED", "important": "IMPORTANT"}
+
+_backfills: Dict[str, asyncio.Task] = {}
+
+class LocalQuery:
+    """A Gmail `q=` string translated into an FTS5 expression and filters."""
+
+    def __init__(self):
+        self.terms: List[str] = []
+        self.after_ms: Optional[int] = None
+        self.before_ms: Optional[int] = None
+        self.labels: List[str] = []
+        self.without_labels: List[str] = ['SPAM', 'TRASH']  # Gmail search skips these too
+
+    @property
+    def match(self) -> Optional[str]:
+        return " AND ".join(self.terms) or None
+
+def _phrase(text: str) -> Optional[str]:
+    words = re.findall(r"\w+", text)
+    return '"' + " ".join(words) + '"' if words else None
+
+def _parse_date(value: str) -> Optional[int]:
+    if value.isdigit():
+        return int(value) * 1000
+    for fmt in ("%Y/%m/%d", "%Y-%m-%d"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp() * 1000)
+        except ValueError:
+            continue
+    return None
+
+def parse_query(q: str) -> Optional[LocalQuery]:
+    """Translate the Gmail operators we support locally.
+
+    Supports free words, quoted phrases, from:, to:, subject:, after:,
+    before: and is:unread/read/starred/important. Anything else (OR,
+    negation, label:, has:, ...) returns None so the caller asks Gmail.
+    """
+    query = LocalQuery()
+    for neg, op, value, phrase_neg, phrase, word in _TOKEN.findall(q):
+        if neg or phrase_neg:
+            return None
+        if op:
+            op = op.lower()
+            value = value.strip('"()')
+            if op in _FIELDS:
+                text = _phrase(value)
+                if text is None:
+                    return None
+                query.terms.append(f"{_FIELDS[op]} : {text}")
+            elif op in ("after", "before"):
+                ms = _parse_date(value)
+                if ms is None:
+                    return None
+                if op == "after":
+                    query.after_ms = ms
+                else:
+                    query.before_ms = ms
+            elif op == "is" and value.lower() == "read":
+                query.without_labels.append('UNREAD')
+            elif op == "is" and value.lower() in _IS_LABELS:
+                query.labels.append(_IS_LABELS[value.lower()])
+            else:
+                return None
+        else:
+            text = phrase or word
+            if text in ("OR", "{", "}") or text.startswith("-"):
+                return None
+            if text == "AND":
+                continue
+            text = _phrase(text)
+            if text:
+                query.terms.append(text)
+    return query
+
+def search_local(user: str, q: str, limit: int, offset: int = 0) -> Optional[Tuple[List[str], Optional[int]]]:
+    """Message ids answering `q` from the local index, and the epoch second
+    before which Gmail may hold more (None when the index covers the whole
+    query); None if only Gmail can answer.
+
+    The index holds every message newer than `indexed_since`. The first page
+    is authoritative when the query's range lies inside that window, or when
+    a full page of hits was found inside it (anything older ranks lower).
+    Later pages only follow a first page that was, so a short one just means
+    the window has run out.
+    """
+    if store is None:
+        return None
+    query = parse_query(q)
+    state = store.index_state(user)
+    if query is None or state is None or state["indexedSince"] is None:
+        return None
+    # Whole seconds, so Gmail's before: picks up exactly where this stops.
+    since = -(-state["indexedSince"] // 1000)
+    bounded = query.after_ms is not None and query.after_ms >= since * 1000
+    ids = store.search(
+        user, query.match, max(query.after_ms or 0, since * 1000), query.before_ms,
+        query.labels, query.without_labels, limit, offset,
+    )
+    if offset == 0 and len(ids) < limit and not bounded:
+        return None
+    return ids, None if bounded else since
+
+async def _backfill(service, user: str) -> None:
+    # Imported here because mail.py imports this module.
+    from mail import get_messages
+
+    started = time.monotonic()
+    after = datetime.now() - timedelta(days=INDEX_DAYS)
+    indexed_since = int(datetime(after.year, after.month, after.day).timestamp() * 1000)
+    q = f"after:{after:%Y/%m/%d}"
+    page_token, count, oldest = None, 0, None
+    try:
+        # Mark the index as started first so the history sync begins
+        # fetching new arrivals while the backfill runs.
+        await asyncio.to_thread(store.set_indexed_since, user, None)
+        while True:
+            results = await service.execute(service.users().messages().list(
+                userId='me', q=q, maxResults=INDEX_PAGE_SIZE, pageToken=page_token
+            ))
+            ids = [m['id'] for m in results.get('messages', [])]
+            messages = await get_messages(service, ids, True, user)
+            # A page whose messages all failed or were deleted leaves it as it was.
+            oldest = min((m.internalDate for m in messages), default=oldest)
+            count += len(ids)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+            if count >= INDEX_MAX_MESSAGES and oldest is not None:
+                # Listing is newest first, so everything after the oldest
+                # message fetched so far is complete.
+                indexed_since = oldest
+                break
+        await asyncio.to_thread(store.set_indexed_since, user, indexed_since)
+        logger.info("index_backfill_done", messages=count, seconds=round(time.monotonic() - started, 1))
+    except Exception as e:
+        logger.error("index_backfill_error", error=str(e))
+    finally:
+        _backfills.pop(user, None)
+
+async def ensure_index(service, user: str) -> None:
+    """Start the background backfill for a mailbox that has no complete index."""
+    if store is None or INDEX_DAYS <= 0 or user in _backfills:
+        return
+    state = await asyncio.to_thread(store.index_state, user)
+    if (state is not None and state["indexedSince"] is not None) or user in _backfills:
+        return
+    _backfills[user] = asyncio.create_task(_backfill(service, user))
+
+async def index_status(user: str) -> dict:
+    state = await asyncio.to_thread(store.index_state, user) if store is not None else None
+    return {
+        "enabled": store is not None and INDEX_DAYS > 0,
+        "backfilling": user in _backfills,
+        "indexedSince": state["indexedSince"] if state else None,
+    }
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+from log import get_logger
+from openrouter import chat_completion
+from prompt import Budget, HISTORY_MESSAGE_MAX_TOKENS, estimate_tokens, pack_lines, truncate_tokens
+
+logger = get_logger("sessions")
+
+# Conversations live server-side, keyed by the user and a client-chosen
+# session id, so requests only need the new message; clients also send a
+# few recent turns, used only to rebuild a session the server lost. Recent
+# turns are kept verbatim and older ones are folded into a rolling summary
+# plus a table of the email ids the conversation touched.
+SESSION_TTL = float(os.getenv("AI_SESSION_TTL", 6 * 3600))
+SESSION_MAX = int(os.getenv("AI_SESSION_MAX", 1000))
+# Messages (user and assistant each count) kept verbatim.
+SESSION_RECENT_MESSAGES = int(os.getenv("AI_SESSION_RECENT_MESSAGES", 6))
+# Compaction waits until this many messages have aged out, so the summary
+# is rewritten every couple of exchanges rather than on every one.
+SESSION_COMPACT_BATCH = int(os.getenv("AI_SESSION_COMPACT_BATCH", 4))
+SESSION_SUMMARY_MAX_TOKENS = int(os.getenv("AI_SESSION_SUMMARY_MAX_TOKENS", 300))
+SESSION_MAX_EMAILS = int(os.getenv("AI_SESSION_MAX_EMAILS", 30))
+# Summaries are a small, low-stakes call; a cheaper model can do them.
+SESSION_SUMMARY_MODEL = os.getenv("AI_SESSION_SUMMARY_MODEL")
+
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+SUMMARY_PROMPT = """You maintain the running summary of a conversation between a user and their email assistant.
+Merge the new messages into the existing summary. Keep what later requests may refer back to:
+what the user asked for, searches run, emails opened or drafted (with their IDs), recipients,
+dates and decisions. Drop greetings and chit-chat. Write plain sentences, at most {words} words.
+Reply with the summary only."""
+
+class Session:
+    """One assistant conversation: recent turns, the summary of older ones
+    and the emails referenced so far (id -> description, oldest first)."""
+
+    __slots__ = ("id", "key", "turns", "summary", "emails", "compacting")
+
+    def __init__(self, id: str, key: str):
+        self.id = id
+        self.key = key
+        self.turns: List[Tuple[str, str]] = []
+        self.summary = ""
+        self.emails: Dict[str, str] = {}
+        self.compacting: Optional[asyncio.Task] = None
+
+    def note_email(self, email_id: str, description: str = "") -> None:
+        """Move `email_id` to the newest end of the table, keeping a known description."""
+        if not email_id:
+            return
+        description = description or self.emails.pop(email_id, "")
+        self.emails.pop(email_id, None)
+        self.emails[email_id] = description
+        while len(self.emails) > SESSION_MAX_EMAILS:
+            del self.emails[next(iter(self.emails))]
+
+    def note_result(self, result: Dict[str, Any]) -> None:
+        for m in result.get("searchResults") or []:
+            self.note_email(m["id"], f"From: {m['from']} | Subject: {m['subject']} | Date: {m['date']}")
+        action = result.get("action") or {}
+        for email_id in [action.get("emailId")] + list(action.get("emailIds") or []):
+            self.note_email(email_id)
+
+    def memory(self, budget: Budget) -> str:
+        """Summary and email table for the prompt, within `budget`."""
+        parts = []
+        if self.summary:
+            summary = truncate_tokens(self.summary, min(SESSION_SUMMARY_MAX_TOKENS, budget.remaining - 1))
+            if summary and budget.spend(summary):
+                parts.append(f"Summary of the earlier conversation:\n{summary}")
+        if self.emails:
+            lines = [f"- ID:{email_id}" + (f" | {desc}" if desc else "")
+                     for email_id, desc in reversed(self.emails.items())]
+            lines, _ = pack_lines(lines, budget)
+            if lines:
+                parts.append("Emails referenced in this conversation (newest first):\n" + "\n".join(lines))
+        if not parts:
+            return ""
+        return "\nCONVERSATION MEMORY\n" + "\n\n".join(parts) + "\n"
+
+def describe_reply(result: Dict[str, Any]) -> str:
+    """An assistant turn as stored: its message plus the action it took."""
+    text = result.get("message") or ""
+    action = result.get("action")
+    if action:
+        text += f"\n[action: {json.dumps(action, separators=(',', ':'))}]"
+    return truncate_tokens(text.strip(), HISTORY_MESSAGE_MAX_TOKENS)
+
+_sessions = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)
+
+def valid_session_id(session_id: str) -> bool:
+    return bool(_SESSION_ID.match(session_id))
+
+def _key(owner: str, session_id: str) -> str:
+    # Ids are chosen by the client, so they are only unique per owner.
+    return f"{owner}:{session_id}"
+
+def get_session(owner: str, session_id: str) -> Session:
+    """The conversation `session_id` of `owner` (a stable key for the
+    authenticated user), started empty if there is none."""
+    key = _key(owner, session_id)
+    session = _sessions.get(key)
+    if session is None:
+        session = Session(session_id, key)
+        _sessions.set(key, session)
+    return session
+
+def drop_session(owner: str, session_id: str) -> bool:
+    session = _sessions.pop(_key(owner, session_id))
+    if session is not None and session.compacting is not None:
+        session.compacting.cancel()
+    return session is not None
+
+def record_turn(session: Session, message: str, result: Dict[str, Any]) -> None:
+    """Append an exchange and start compaction once enough turns have aged out."""
+    session.turns.append(("user", message))
+    session.turns.append(("assistant", describe_reply(result)))
+    session.note_result(result)
+    # Re-setting refreshes the TTL, so idle time rather than age expires it.
+    _sessions.set(session.key, session)
+    aged = len(session.turns) - SESSION_RECENT_MESSAGES
+    if aged >= SESSION_COMPACT_BATCH and session.compacting is None:
+        session.compacting = asyncio.get_running_loop().create_task(compact(session, aged))
+
+def _fallback_summary(summary: str, turns: List[Tuple[str, str]]) -> str:
+    """Extractive summary: one trimmed line per message, oldest lines dropped first."""
+    lines = [line for line in summary.splitlines() if line.strip()]
+    lines += [f"{'User' if role == 'user' else 'Assistant'}: {truncate_tokens(' '.join(content.split()), 40)}"
+              for role, content in turns]
+    kept, total = [], 0
+    for line in reversed(lines):
+        total += estimate_tokens(line) + 1
+        if total > SESSION_SUMMARY_MAX_TOKENS:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+async def summarize(summary: str, turns: List[Tuple[str, str]]) -> str:
+    transcript = "\n".join(f"{role}: {content}" for role, content in turns)
+    prompt = f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+    data = await chat_completion(
+        [
+            {"role": "system", "content": SUMMARY_PROMPT.format(words=SESSION_SUMMARY_MAX_TOKENS * 3 // 4)},
+            {"role": "user", "content": prompt},
+        ],
+        model=SESSION_SUMMARY_MODEL,
+        hedge=False,
+        temperature=0,
+        max_tokens=SESSION_SUMMARY_MAX_TOKENS + 100,
+    )
+    return truncate_tokens((data["choices"][0]["message"]["content"] or "").strip(), SESSION_SUMMARY_MAX_TOKENS)
+
+async def compact(session: Session, count: int) -> None:
+    """Fold the oldest `count` messages into the summary.
+
+    Runs after the reply has been sent. Turns only ever get appended, so
+    the first `count` are still the ones summarized when this finishes.
+    """
+    old = session.turns[:count]
+    try:
+        summary = ""
+        if os.getenv("OPENROUTER_API_KEY"):
+            try:
+                summary = await summarize(session.summary, old)
+            except Exception as e:
+                logger.error("session_summary_error", error=str(e))
+        session.summary = summary or _fallback_summary(session.summary, old)
+        del session.turns[:count]
+    finally:
+        session.compacting = None
+
+def session_stats() -> Dict[str, Any]:
+    return {**_sessions.stats(), "recentMessages": SESSION_RECENT_MESSAGES,
+            "summaryMaxTokens": SESSION_SUMMARY_MAX_TOKENS}
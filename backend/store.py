@@ -0,0 +1,306 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from message import ParsedMessage
+
+STORE_PATH = os.getenv("MAIL_STORE_PATH", os.path.join(os.path.dirname(__file__), "mail_store.sqlite3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    thread_id TEXT NOT NULL,
+    label_ids TEXT NOT NULL,
+    internal_date INTEGER NOT NULL,
+    snippet TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    date TEXT NOT NULL,
+    body_html TEXT,
+    body_text TEXT,
+    attachments TEXT,
+    has_body INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user, id)
+);
+CREATE INDEX IF NOT EXISTS messages_thread ON messages (user, thread_id);
+
+-- Threads whose full message list is in `messages` (bodies may still be
+-- missing), as of the thread's `history_id`. Dropped when the history feed
+-- reports a later message added to or deleted from the thread.
+CREATE TABLE IF NOT EXISTS threads (
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    history_id TEXT,
+    PRIMARY KEY (user, id)
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    user TEXT PRIMARY KEY,
+    history_id TEXT NOT NULL,
+    synced_at REAL NOT NULL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    user UNINDEXED,
+    id UNINDEXED,
+    subject,
+    sender,
+    recipients,
+    body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+
+-- Every message with internal_date >= indexed_since is in the store with its
+-- body. NULL while the initial backfill is still running.
+CREATE TABLE IF NOT EXISTS index_state (
+    user TEXT PRIMARY KEY,
+    indexed_since INTEGER
+);
+"""
+
+_SET_STATE = (
+    "INSERT INTO sync_state (user, history_id, synced_at) VALUES (?, ?, ?) "
+    "ON CONFLICT (user) DO UPDATE SET history_id = excluded.history_id, synced_at = excluded.synced_at"
+)
+
+_COLUMNS = "id, thread_id, label_ids, internal_date, snippet, subject, sender, recipients, date, body_html, body_text, attachments, has_body"
+
+class MessageStore:
+    """Parsed Gmail messages, thread membership and sync state, per mailbox.
+
+    Messages go in and come out as the ParsedMessage the mail routes return.
+    All methods are synchronous and guarded by one lock; callers on the
+    event loop should run them via asyncio.to_thread.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(messages)")}
+        if "attachments" not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN attachments TEXT")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(threads)")}
+        if "history_id" not in columns:
+            self._conn.execute("ALTER TABLE threads ADD COLUMN history_id TEXT")
+        self._lock = threading.Lock()
+
+    def get_state(self, user: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT history_id, synced_at FROM sync_state WHERE user = ?", (user,)
+            ).fetchone()
+        return {"historyId": row[0], "syncedAt": row[1]} if row else None
+
+    def set_state(self, user: str, history_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(_SET_STATE, (user, history_id, time.time()))
+
+    def reset(self, user: str) -> None:
+        """Forget everything about a mailbox, e.g. when its history expired."""
+        with self._lock, self._conn:
+            for table in ("messages", "threads", "sync_state", "messages_fts", "index_state"):
+                self._conn.execute(f"DELETE FROM {table} WHERE user = ?", (user,))
+
+    def put_messages(self, user: str, messages: Iterable[ParsedMessage]) -> None:
+        """Upsert parsed messages; a message without a body keeps any stored one."""
+        rows = [
+            (
+                user, m.id, m.threadId, json.dumps(m.labelIds), m.internalDate,
+                m.snippet, m.subject, m.sender, m.to, m.date,
+                m.bodyHtml, m.bodyText, json.dumps(m.attachments or []), int(m.has_body),
+            )
+            for m in messages
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT INTO messages (user, {_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user, id) DO UPDATE SET "
+                "label_ids = excluded.label_ids, snippet = excluded.snippet, "
+                "body_html = CASE WHEN excluded.has_body THEN excluded.body_html ELSE body_html END, "
+                "body_text = CASE WHEN excluded.has_body THEN excluded.body_text ELSE body_text END, "
+                "attachments = CASE WHEN excluded.has_body THEN excluded.attachments ELSE attachments END, "
+                "has_body = MAX(has_body, excluded.has_body)",
+                rows,
+            )
+            for row in rows:
+                self._reindex(user, row[1])
+
+    def _reindex(self, user: str, message_id: str) -> None:
+        self._conn.execute("DELETE FROM messages_fts WHERE user = ? AND id = ?", (user, message_id))
+        row = self._conn.execute(
+            "SELECT subject, sender, recipients, body_text, body_html FROM messages WHERE user = ? AND id = ?",
+            (user, message_id),
+        ).fetchone()
+        if row:
+            body = row[3] or _strip_html(row[4] or "")
+            self._conn.execute(
+                "INSERT INTO messages_fts (user, id, subject, sender, recipients, body) VALUES (?, ?, ?, ?, ?, ?)",
+                (user, message_id, row[0], row[1], row[2], body),
+            )
+
+    def get_messages(self, user: str, ids: List[str], with_body: bool = True) -> Dict[str, ParsedMessage]:
+        """Stored messages among `ids`, skipping those without a body if one is needed."""
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit.
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                query = f"SELECT {_COLUMNS} FROM messages WHERE user = ? AND id IN ({placeholders})"
+                if with_body:
+                    query += " AND has_body = 1"
+                for row in self._conn.execute(query, (user, *chunk)):
+                    found[row[0]] = _to_message(row, with_body)
+        return found
+
+    def get_thread(self, user: str, thread_id: str) -> Optional[List[ParsedMessage]]:
+        """Metadata of every message in a stored thread, oldest first, or None.
+
+        Bodies are left out; get_messages returns those that are stored.
+        """
+        with self._lock:
+            if not self._conn.execute(
+                "SELECT 1 FROM threads WHERE user = ? AND id = ?", (user, thread_id)
+            ).fetchone():
+                return None
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM messages WHERE user = ? AND thread_id = ? ORDER BY internal_date",
+                (user, thread_id),
+            ).fetchall()
+        if not rows:
+            return None
+        return [_to_message(row, False) for row in rows]
+
+    def put_thread(self, user: str, thread_id: str, messages: List[ParsedMessage],
+                   history_id: Optional[str] = None) -> None:
+        """Store a thread's complete message list as of its `history_id`."""
+        self.put_messages(user, messages)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO threads (user, id, history_id) VALUES (?, ?, ?)",
+                (user, thread_id, history_id),
+            )
+
+    def _drop_thread(self, user: str, thread_id: str, record_id: Optional[str]) -> None:
+        # A thread fetched after this history record already includes it.
+        if record_id is None:
+            self._conn.execute("DELETE FROM threads WHERE user = ? AND id = ?", (user, thread_id))
+        else:
+            self._conn.execute(
+                "DELETE FROM threads WHERE user = ? AND id = ? "
+                "AND (history_id IS NULL OR CAST(history_id AS INTEGER) < ?)",
+                (user, thread_id, int(record_id)),
+            )
+
+    def apply_history(self, user: str, history: List[dict], history_id: str) -> None:
+        """Apply a users.history.list delta and advance the stored historyId."""
+        with self._lock, self._conn:
+            for record in history:
+                for item in record.get("messagesAdded", []):
+                    self._drop_thread(user, item["message"]["threadId"], record.get("id"))
+                for item in record.get("messagesDeleted", []):
+                    msg = item["message"]
+                    self._conn.execute("DELETE FROM messages WHERE user = ? AND id = ?", (user, msg["id"]))
+                    self._conn.execute("DELETE FROM messages_fts WHERE user = ? AND id = ?", (user, msg["id"]))
+                    self._drop_thread(user, msg["threadId"], record.get("id"))
+                for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                    # The history record carries the message's labels after the change.
+                    msg = item["message"]
+                    if "labelIds" in msg:
+                        self._conn.execute(
+                            "UPDATE messages SET label_ids = ? WHERE user = ? AND id = ?",
+                            (json.dumps(msg["labelIds"]), user, msg["id"]),
+                        )
+            self._conn.execute(_SET_STATE, (user, history_id, time.time()))
+
+    def delete_messages(self, user: str, ids: List[str]) -> None:
+        """Drop messages so the next read refetches them from Gmail."""
+        with self._lock, self._conn:
+            for message_id in ids:
+                row = self._conn.execute(
+                    "DELETE FROM messages WHERE user = ? AND id = ? RETURNING thread_id", (user, message_id)
+                ).fetchone()
+                self._conn.execute("DELETE FROM messages_fts WHERE user = ? AND id = ?", (user, message_id))
+                if row:
+                    self._conn.execute("DELETE FROM threads WHERE user = ? AND id = ?", (user, row[0]))
+
+    def update_labels(self, user: str, ids: List[str], add: List[str] = (), remove: List[str] = ()) -> None:
+        """Mirror a label change we just made through the API."""
+        with self._lock, self._conn:
+            for message_id in ids:
+                row = self._conn.execute(
+                    "SELECT label_ids FROM messages WHERE user = ? AND id = ?", (user, message_id)
+                ).fetchone()
+                if row is None:
+                    continue
+                labels = [l for l in json.loads(row[0]) if l not in remove]
+                labels += [l for l in add if l not in labels]
+                self._conn.execute(
+                    "UPDATE messages SET label_ids = ? WHERE user = ? AND id = ?",
+                    (json.dumps(labels), user, message_id),
+                )
+
+    def index_state(self, user: str) -> Optional[dict]:
+        """None if no index was ever started, else {"indexedSince": ms or None}."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT indexed_since FROM index_state WHERE user = ?", (user,)
+            ).fetchone()
+        return {"indexedSince": row[0]} if row else None
+
+    def set_indexed_since(self, user: str, indexed_since: Optional[int]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO index_state (user, indexed_since) VALUES (?, ?) "
+                "ON CONFLICT (user) DO UPDATE SET indexed_since = excluded.indexed_since",
+                (user, indexed_since),
+            )
+
+    def search(self, user: str, match: Optional[str], after_ms: Optional[int] = None,
+               before_ms: Optional[int] = None, labels: List[str] = (), without_labels: List[str] = (),
+               limit: int = 10, offset: int = 0) -> List[str]:
+        """Ids of stored messages matching an FTS5 expression and filters, newest first."""
+        if match:
+            query = ("SELECT m.id FROM messages_fts f JOIN messages m ON m.user = f.user AND m.id = f.id "
+                     "WHERE messages_fts MATCH ? AND f.user = ?")
+            params: list = [match, user]
+        else:
+            query = "SELECT m.id FROM messages m WHERE m.user = ?"
+            params = [user]
+        if after_ms is not None:
+            query += " AND m.internal_date >= ?"
+            params.append(after_ms)
+        if before_ms is not None:
+            query += " AND m.internal_date < ?"
+            params.append(before_ms)
+        for label in labels:
+            query += " AND m.label_ids LIKE ?"
+            params.append(f'%"{label}"%')
+        for label in without_labels:
+            query += " AND m.label_ids NOT LIKE ?"
+            params.append(f'%"{label}"%')
+        query += " ORDER BY m.internal_date DESC LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        with self._lock:
+            return [row[0] for row in self._conn.execute(query, params)]
+
+def _strip_html(html: str) -> str:
+    return re.sub(r"\s+", " ", re.sub(r"<[^>]+>", " ", re.sub(r"(?is)<(script|style).*?</\1>", " ", html)))
+
+def _to_message(row, with_body: bool) -> ParsedMessage:
+    message = ParsedMessage(
+        row[0], row[1], json.loads(row[2]), row[4], row[5], row[6], row[7], row[8], row[3],
+    )
+    if with_body:
+        message.bodyHtml = row[9] or ""
+        message.bodyText = row[10] or ""
+        message.attachments = json.loads(row[11] or "[]")
+    return message
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+from googleapiclient.errors import HttpError
+
+from cache import TTLCache
+from log import get_logger
+from store import MessageStore
+
+logger = get_logger("sync")
+
+STORE_ENABLED = os.getenv("MAIL_STORE_ENABLED", "1") == "1"
+# How long the store counts as fresh after a history sync before the next
+# request pays for another users.history.list round trip.
+SYNC_INTERVAL = float(os.getenv("MAIL_STORE_SYNC_INTERVAL", 15))
+
+store = MessageStore() if STORE_ENABLED else None
+
+# token key -> {"emailAddress", "historyId"} from users.getProfile.
+_profiles = TTLCache(maxsize=1024, ttl=3600)
+_sync_locks = TTLCache(maxsize=4096, ttl=3600)
+
+async def get_profile(service) -> dict:
+    profile = _profiles.get(service.key)
+    if profile is None:
+        profile = await service.execute(service.users().getProfile(userId='me'))
+        _profiles.set(service.key, profile)
+    return profile
+
+def _sync_lock(user: str) -> asyncio.Lock:
+    lock = _sync_locks.get(user)
+    if lock is None:
+        lock = asyncio.Lock()
+        _sync_locks.set(user, lock)
+    return lock
+
+async def _apply_history(service, user: str, start_history_id: str) -> None:
+    history, page_token, history_id = [], None, start_history_id
+    while True:
+        response = await service.execute(service.users().history().list(
+            userId='me', startHistoryId=start_history_id, pageToken=page_token
+        ))
+        history.extend(response.get('history', []))
+        history_id = response.get('historyId', history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    await asyncio.to_thread(store.apply_history, user, history, history_id)
+
+    # A mailbox with a search index must hold every new message in full,
+    # otherwise local search would silently miss it.
+    added = [item['message']['id'] for record in history for item in record.get('messagesAdded', [])]
+    if added and await asyncio.to_thread(store.index_state, user) is not None:
+        # Imported here because mail.py imports this module.
+        from mail import get_messages
+        await get_messages(service, added, True, user)
+
+async def mailbox_user(service) -> Optional[str]:
+    """Mailbox address for the store, without syncing; None if unavailable."""
+    if store is None:
+        return None
+    try:
+        return (await get_profile(service))['emailAddress']
+    except Exception as e:
+        logger.error("profile_error", error=str(e))
+        return None
+
+async def sync_mailbox(service) -> Optional[str]:
+    """Bring the local store up to date and return the mailbox address.
+
+    Returns None when the store is disabled or Gmail could not be reached,
+    in which case callers should go straight to Gmail.
+    """
+    if store is None:
+        return None
+    try:
+        profile = await get_profile(service)
+        user = profile['emailAddress']
+        async with _sync_lock(user):
+            state = await asyncio.to_thread(store.get_state, user)
+            if state is None:
+                # Nothing stored yet: start following history from now and
+                # let messages fill in as they are fetched.
+                await asyncio.to_thread(store.set_state, user, profile['historyId'])
+            elif time.time() - state['syncedAt'] >= SYNC_INTERVAL:
+                try:
+                    await _apply_history(service, user, state['historyId'])
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    # startHistoryId is too old for Gmail to replay; start over.
+                    logger.warning("history_expired", error=str(e))
+                    _profiles.pop(service.key)
+                    profile = await get_profile(service)
+                    await asyncio.to_thread(store.reset, user)
+                    await asyncio.to_thread(store.set_state, user, profile['historyId'])
+        return user
+    except Exception as e:
+        logger.error("store_sync_error", error=str(e))
+        return None
@@ -0,0 +1,35 @@
+"""Backend modules on sys.path, on-disk state in a temp directory, and a
+fake Gmail server (benchmarks/fake_gmail.py) to run requests against."""
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BACKEND, os.path.join(BACKEND, "benchmarks")]
+
+_STATE = tempfile.mkdtemp(prefix="mail-ai-tests-")
+os.environ.setdefault("MAIL_STORE_PATH", os.path.join(_STATE, "mail_store.sqlite3"))
+os.environ.setdefault("CREDENTIAL_STORE_PATH", os.path.join(_STATE, "credentials.sqlite3"))
+os.environ.setdefault("MAIL_ATTACHMENT_CACHE_DIR", os.path.join(_STATE, "attachments"))
+os.environ.setdefault("GMAIL_RETRY_BASE", "0.01")
+
+@pytest.fixture
+def gmail():
+    """(FakeMailbox, GmailService) with the service talking to the fake."""
+    import fake_gmail
+    import gmail_service
+
+    mailbox = fake_gmail.FakeMailbox(30, quota_rate=10000, error_rate=0)
+    server = fake_gmail.start(mailbox)
+    root_url = gmail_service.GMAIL_DISCOVERY_DOC["rootUrl"]
+    gmail_service.GMAIL_DISCOVERY_DOC["rootUrl"] = f"http://127.0.0.1:{server.server_address[1]}/"
+    try:
+        yield mailbox, gmail_service.get_service(f"test-{uuid.uuid4().hex}")
+    finally:
+        gmail_service.GMAIL_DISCOVERY_DOC["rootUrl"] = root_url
+        server.shutdown()
+        for _, path in mailbox.sent:
+            os.remove(path)
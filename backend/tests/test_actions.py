@@ -0,0 +1,31 @@
+import pytest
+
+from actions import parse_reply
+
+def test_parse_reply_valid():
+    reply, outcome = parse_reply('{"action": {"type": "navigate", "view": "sent"}, "message": "Going"}')
+    assert outcome == "valid" and reply.action.view == "sent" and reply.message == "Going"
+
+@pytest.mark.parametrize("content", [
+    '```json\n{"action": null, "message": "hi"}\n```',
+    '{"action": null, "message": "hi",}',
+    '{"action": null, "message": "hi"',
+    'Sure! {"action": null, "message": "hi"} Anything else?',
+])
+def test_parse_reply_tolerated(content):
+    reply, outcome = parse_reply(content)
+    assert outcome == "tolerated" and reply.message == "hi"
+
+def test_parse_reply_plain_text_is_a_message():
+    reply, outcome = parse_reply("You have no unread mail.")
+    assert outcome == "plain" and reply.message == "You have no unread mail." and reply.action is None
+
+@pytest.mark.parametrize("content, error", [
+    ("", "expected a JSON object"),
+    ('["a"]', "expected a JSON object"),
+    ('{"action": {"type": "navigate", "view": "spam"}}', "schema mismatch"),
+    ('{"action": null, "message": ""}', "neither an action nor a message"),
+])
+def test_parse_reply_errors(content, error):
+    reply, problem = parse_reply(content)
+    assert reply is None and error in problem
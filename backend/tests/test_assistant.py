@@ -0,0 +1,23 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import ai
+
+def client():
+    app = FastAPI()
+    app.include_router(ai.router)
+    return TestClient(app)
+
+def test_expired_credentials_fall_back_to_no_tools(monkeypatch):
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    calls = []
+
+    async def complete(key, messages, service=None, known_ids=None):
+        calls.append(service)
+        return {"action": None, "message": "Answered without Gmail.", "needsConfirmation": False}
+
+    monkeypatch.setattr(ai, "complete", complete)
+    response = client().post("/api/assistant", json={"message": "what did alice say about the budget?"},
+                             headers={"Authorization": "Bearer sess_unknown"})
+    assert response.status_code == 200 and response.json()["message"] == "Answered without Gmail."
+    assert calls == [None]
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from ai import EnvelopeStreamParser
+
+def feed_all(parser, text, step):
+    events = []
+    for i in range(0, len(text), step):
+        events += parser.feed(text[i:i + step])
+    return events
+
+ENVELOPE = {"action": {"type": "search", "query": "a \"b\" {c}"}, "message": "Searching é \\ \"now\"\n"}
+
+@pytest.mark.parametrize("step", [1, 2, 3, 7, 1000])
+def test_envelope_parser_any_chunking(step):
+    text = "```json\n" + json.dumps(ENVELOPE) + "\n```"
+    events = feed_all(EnvelopeStreamParser(), text, step)
+    assert events[0] == ("action", ENVELOPE["action"])
+    assert "".join(delta for kind, delta in events if kind == "message") == ENVELOPE["message"]
+    assert [kind for kind, _ in events].count("action") == 1
+
+def test_envelope_parser_message_before_action():
+    parser = EnvelopeStreamParser()
+    events = parser.feed('{"message": "Hel')
+    assert events == [("message", "Hel")]
+    events = parser.feed('lo", "action": {"type": "logout"}}')
+    assert events == [("message", "lo"), ("action", {"type": "logout"})]
+
+def test_envelope_parser_never_splits_an_escape():
+    parser = EnvelopeStreamParser()
+    assert parser.feed('{"message": "caf\\u00') == [("message", "caf")]
+    assert parser.feed('e9"}') == [("message", "é")]
+
+def test_envelope_parser_null_action_and_trailing_text():
+    parser = EnvelopeStreamParser()
+    events = parser.feed('{"action": null, "message": "ok"} trailing {"action": 1}')
+    assert events == [("action", None), ("message", "ok")]
+    assert parser.finished
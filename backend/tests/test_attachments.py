@@ -0,0 +1,191 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+import attachments
+from attachments import AttachmentCache, _slice, attachment_response, parse_range
+from fake_gmail import ATTACHMENT_BLOCK
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("", None),
+    ("bytes=-", None),
+    ("items=0-5", None),
+    ("bytes=0-1,4-5", None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=10-", (10, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=5-4", "bytes=2000-3000"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(HTTPException) as e:
+        parse_range(header, 1000)
+    assert e.value.status_code == 416 and e.value.headers["Content-Range"] == "bytes */1000"
+
+class Chunks:
+    """An async chunk stream that records how far it was read and whether it was closed."""
+
+    def __init__(self, data: bytes, size: int):
+        self.chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        self.read = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.read == len(self.chunks):
+            raise StopAsyncIteration
+        self.read += 1
+        return self.chunks[self.read - 1]
+
+    async def aclose(self):
+        self.closed = True
+
+def slice_of(chunks, start, end):
+    async def collect():
+        return b"".join([chunk async for chunk in _slice(chunks, start, end)])
+    return asyncio.run(collect())
+
+@pytest.mark.parametrize("start, end", [(0, 0), (0, 99), (3, 17), (9, 10), (50, 99), (99, 99)])
+def test_slice(start, end):
+    data = bytes(range(100))
+    chunks = Chunks(data, 10)
+    assert slice_of(chunks, start, end) == data[start:end + 1]
+    # Stops reading once past the end, and closes the stream either way.
+    assert chunks.read == end // 10 + 1 and chunks.closed
+
+def test_cache_lru_eviction(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=250)
+
+    def put(key, size, mtime):
+        f, temp_path = cache.writer()
+        with f:
+            f.write(b"x" * size)
+        cache.commit(temp_path, key)
+        os.utime(os.path.join(str(tmp_path), key), (mtime, mtime))
+
+    put("a", 100, 1)
+    put("b", 100, 2)
+    assert cache.lookup("a") == (os.path.join(str(tmp_path), "a"), 100)  # now the most recent
+    put("c", 100, 3)
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") is not None and cache.lookup("c") is not None
+    stats = cache.stats()
+    assert stats["files"] == 2 and stats["bytes"] == 200 and stats["evictions"] == 1
+    assert stats["hits"] == 3 and stats["misses"] == 1
+
+def test_cache_discard_and_disabled(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=1000)
+    f, temp_path = cache.writer()
+    f.close()
+    cache.discard(temp_path)
+    assert os.listdir(str(tmp_path)) == []
+    assert AttachmentCache(str(tmp_path / "off"), max_bytes=0).lookup("a") is None
+
+def download(service, attachment_id, range_header=None):
+    async def run():
+        try:
+            response = await attachment_response(service, f"key-{attachment_id}", "m00001", attachment_id,
+                                                 range_header, "a.bin", "application/octet-stream")
+            body = b"".join([chunk async for chunk in response.body_iterator])
+            return response, body
+        finally:
+            await attachments.aclose()
+    return asyncio.run(run())
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = AttachmentCache(str(tmp_path), max_bytes=10 ** 7)
+    monkeypatch.setattr(attachments, "attachment_cache", cache)
+    return cache
+
+def test_download_is_cached_and_served_by_range(gmail, cache):
+    mailbox, service = gmail
+    size = 300000
+    expected = (ATTACHMENT_BLOCK * 2)[:size]
+    response, body = download(service, f"bytes-{size}")
+    assert body == expected and response.headers["Content-Length"] == str(size)
+    assert cache.stats()["files"] == 1
+
+    requests = mailbox.requests
+    response, body = download(service, f"bytes-{size}", "bytes=1000-1999")
+    assert response.status_code == 206 and body == expected[1000:2000]
+    assert response.headers["Content-Range"] == f"bytes 1000-1999/{size}"
+    assert mailbox.requests == requests  # served from the cache
+
+def test_ranged_download_not_cached(gmail, cache):
+    _, service = gmail
+    response, body = download(service, "bytes-5000", "bytes=-10")
+    assert response.status_code == 206 and body == ATTACHMENT_BLOCK[4990:5000]
+    assert cache.stats()["files"] == 0
+
+@pytest.mark.parametrize("spec_version", ["2.0", "2.4"])
+def test_client_disconnect_closes_the_download(gmail, cache, monkeypatch, spec_version):
+    _, service = gmail
+    downloads = []
+    open_attachment = attachments.open_attachment
+
+    async def recording(*args):
+        downloads.append(await open_attachment(*args))
+        return downloads[-1]
+
+    monkeypatch.setattr(attachments, "open_attachment", recording)
+    bodies = []
+    gone = asyncio.Event()
+
+    async def receive():
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            bodies.append(message)
+            if spec_version == "2.4":
+                raise OSError("client went away")
+            gone.set()
+            await asyncio.sleep(1)
+
+    async def run():
+        try:
+            response = await attachment_response(service, "key-disconnect", "m00001", "bytes-1000000",
+                                                 None, "a.bin", None)
+            scope = {"type": "http", "asgi": {"spec_version": spec_version}}
+            try:
+                await response(scope, receive, send)
+            except Exception:
+                pass
+            # Checked before the loop closes, which would finalize everything anyway.
+            return downloads[0]._response.is_closed, os.listdir(cache.directory)
+        finally:
+            await attachments.aclose()
+
+    assert asyncio.run(run()) == (True, [])
+    assert len(bodies) == 1
+
+def test_truncated_upstream_aborts_the_stream():
+    class Upstream:
+        closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    async def rest():
+        yield b"REVG"
+
+    upstream = Upstream()
+    download = attachments.AttachmentDownload(upstream, rest(), b"QUJD", 6)
+
+    async def read():
+        return [chunk async for chunk in download]
+
+    with pytest.raises(attachments.AttachmentTruncated):
+        asyncio.run(read())
+    assert upstream.closed
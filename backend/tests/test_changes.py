@@ -0,0 +1,87 @@
+import asyncio
+
+import changes
+from changes import ChangeFeed, summarize
+from fake_history import FakeHistory
+
+USER = "me@example.com"
+
+def record(history_id, kind, msg_id, thread_id, labels=None):
+    message = {"id": msg_id, "threadId": thread_id}
+    if labels is not None:
+        message["labelIds"] = labels
+    return {"id": str(history_id), kind: [{"message": message}]}
+
+def test_summarize_nets_out_changes():
+    history = [
+        record(1, "messagesAdded", "a", "ta", ["INBOX"]),
+        record(2, "messagesAdded", "b", "tb", ["INBOX"]),
+        record(3, "messagesDeleted", "b", "tb"),
+        record(4, "messagesDeleted", "c", "tc"),
+        record(5, "labelsAdded", "d", "td", ["INBOX", "STARRED"]),
+        record(6, "labelsRemoved", "c", "tc", []),
+    ]
+    assert summarize(history) == {"added": ["a"], "removed": ["c"],
+                                  "labels": {"a": ["INBOX"], "d": ["INBOX", "STARRED"]}}
+
+def feed_with(source):
+    feed = ChangeFeed(USER)
+    feed.source = source
+    feed.history_id = asyncio.run(source.current_id())
+    feed.subscribers.add(asyncio.Queue(maxsize=changes.CHANGES_QUEUE_SIZE))
+    return feed, next(iter(feed.subscribers))
+
+def test_poll_publishes_changes_and_backs_off_when_quiet():
+    source = FakeHistory()
+    feed, queue = feed_with(source)
+    asyncio.run(feed.poll())
+    assert queue.empty() and feed.interval == changes.CHANGES_POLL_INTERVAL * changes.CHANGES_BACKOFF
+    source.add("m1")
+    asyncio.run(feed.poll())
+    event, data = queue.get_nowait()
+    assert event == "changes" and data["added"] == ["m1"] and data["historyId"] == str(source.history_id)
+    assert feed.interval == changes.CHANGES_POLL_INTERVAL and feed.polls == 2
+
+def test_poll_resets_on_expired_history():
+    source = FakeHistory(retain=2)
+    feed, queue = feed_with(source)
+    for i in range(5):
+        source.add(f"m{i}")
+    asyncio.run(feed.poll())
+    assert queue.get_nowait() == ("reset", {"historyId": str(source.history_id)})
+    assert feed.history_id == str(source.history_id)
+
+def test_slow_subscriber_is_told_to_reload(monkeypatch):
+    monkeypatch.setattr(changes, "CHANGES_QUEUE_SIZE", 2)
+    feed, queue = feed_with(FakeHistory())
+    for i in range(3):
+        feed.publish("changes", {"n": i})
+    assert queue.qsize() == 1 and queue.get_nowait()[0] == "reset"
+
+def test_subscribers_share_one_poller(monkeypatch):
+    monkeypatch.setattr(changes, "CHANGES_POLL_INTERVAL", 0.01)
+    source = FakeHistory()
+
+    async def run():
+        feed = ChangeFeed("shared@example.com")
+        queues = [feed.subscribe(source) for _ in range(3)]
+        task = feed.task
+        assert [await q.get() for q in queues] == [("ready", {"historyId": "1000"})] * 3
+        source.add("m1")
+        events = [await asyncio.wait_for(q.get(), 1) for q in queues]
+        for queue in queues:
+            feed.unsubscribe(queue)
+        await asyncio.sleep(0)
+        return events, task
+
+    events, task = asyncio.run(run())
+    assert all(event == "changes" and data["added"] == ["m1"] for event, data in events)
+    assert task.cancelled()
+
+def test_feed_stats_name_no_mailbox():
+    feed = changes.feed_for("private@example.com")
+    try:
+        assert "private@example.com" not in str(changes.feed_stats())
+        assert feed.interval in changes.feed_stats()["intervals"]
+    finally:
+        del changes._feeds["private@example.com"]
@@ -0,0 +1,62 @@
+import asyncio
+import gzip
+
+import pytest
+
+from compression import CompressionMiddleware
+
+def scope(path="/api/x"):
+    return {"type": "http", "path": path, "headers": [(b"accept-encoding", b"gzip")]}
+
+def start(content_type: bytes):
+    return {"type": "http.response.start", "status": 200, "headers": [(b"content-type", content_type)]}
+
+def run(app):
+    """Messages the middleware sent, and those sent by the time the app
+    sent its first body message."""
+    sent, at_first_body = [], []
+
+    async def send(message):
+        sent.append(message)
+
+    async def wrapped(scope, receive, send):
+        async def tracked(message):
+            if message["type"] == "http.response.body" and not at_first_body:
+                at_first_body.append(list(sent))
+            await send(message)
+        await app(scope, receive, tracked)
+
+    asyncio.run(CompressionMiddleware(wrapped, prefixes=("/api",))(scope(), None, send))
+    return sent, at_first_body[0]
+
+@pytest.mark.parametrize("content_type", [b"text/event-stream", b"application/octet-stream", b"image/png"])
+def test_start_forwarded_at_once_for_non_compressible_types(content_type):
+    body = {"type": "http.response.body", "body": b"x" * 5000}
+
+    async def app(scope, receive, send):
+        await send(start(content_type))
+        await send(body)
+
+    sent, before_body = run(app)
+    assert before_body == [start(content_type)]
+    assert sent == [start(content_type), body]
+
+def test_json_is_compressed():
+    payload = b'{"a": "' + b"x" * 5000 + b'"}'
+
+    async def app(scope, receive, send):
+        await send(start(b"application/json"))
+        await send({"type": "http.response.body", "body": payload})
+
+    sent, before_body = run(app)
+    assert before_body == []
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip" and gzip.decompress(sent[1]["body"]) == payload
+
+def test_small_json_passes_through():
+    async def app(scope, receive, send):
+        await send(start(b"application/json"))
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    sent, _ = run(app)
+    assert sent == [start(b"application/json"), {"type": "http.response.body", "body": b"{}"}]
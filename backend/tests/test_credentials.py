@@ -0,0 +1,59 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi import HTTPException
+
+import credential_store
+import mail
+from credential_store import CredentialStore
+
+def token_endpoint(status: int):
+    """A local stand-in for Google's token endpoint answering `status`."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = json.dumps({"access_token": "fresh", "expires_in": 3600} if status == 200
+                              else {"error": "invalid_grant" if status == 400 else "backend_error"}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@pytest.mark.parametrize("status, expected", [(200, None), (400, 401), (500, 503), (None, 503)])
+def test_refresh_failures_map_to_client_statuses(tmp_path, monkeypatch, status, expected):
+    server = token_endpoint(status or 200)
+    url = f"http://127.0.0.1:{server.server_address[1]}/token"
+    if status is None:
+        # Nothing listening: a connection error.
+        server.shutdown()
+        server.server_close()
+    monkeypatch.setattr(credential_store, "TOKEN_URI", url)
+    store = CredentialStore(str(tmp_path / "credentials.sqlite3"))
+    monkeypatch.setattr(mail, "credential_store", store)
+
+    async def run():
+        # Already expired, so the first use has to refresh.
+        session = await store.login("me@example.com", "stale", "refresh-token", 0)
+        return await mail.get_gmail_service(f"Bearer {session}")
+
+    try:
+        if expected is None:
+            assert asyncio.run(run()).credentials.token == "fresh"
+        else:
+            with pytest.raises(HTTPException) as e:
+                asyncio.run(run())
+            assert e.value.status_code == expected
+    finally:
+        if status is not None:
+            server.shutdown()
@@ -0,0 +1,64 @@
+import asyncio
+import io
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from gmail_service import scheduler_for
+from outgoing import upload_request
+from quota import GMAIL_BATCH_SIZE, GMAIL_BATCH_STEP
+
+def send(service):
+    message = io.BytesIO(b"To: a@example.com\r\nSubject: s\r\n\r\nbody\r\n")
+    return service.execute(upload_request(service, message, len(message.getvalue())))
+
+def test_read_retried_on_server_error(gmail):
+    mailbox, service = gmail
+    mailbox.fail(503, path="/messages/m00001")
+    msg = asyncio.run(service.execute(service.users().messages().get(userId="me", id="m00001")))
+    assert msg["id"] == "m00001"
+
+def test_send_not_retried_on_server_error(gmail):
+    mailbox, service = gmail
+    mailbox.fail(503, path="/messages/send")
+    with pytest.raises(HttpError):
+        asyncio.run(send(service))
+    # Gmail kept the message; a retry would have sent it twice.
+    assert len(mailbox.sent) == 1
+
+def test_send_retried_when_rate_limited(gmail):
+    mailbox, service = gmail
+    mailbox.fail(429, path="/messages/send")
+    response = asyncio.run(send(service))
+    assert response["labelIds"] == ["SENT"]
+    assert len(mailbox.sent) == 1
+
+def fetch(service, ids):
+    return asyncio.run(service.execute_batch(
+        {msg_id: service.users().messages().get(userId="me", id=msg_id) for msg_id in ids}
+    ))
+
+def test_batch_retries_throttled_sub_requests_in_smaller_batches(gmail):
+    mailbox, service = gmail
+    ids = sorted(mailbox.messages)
+    mailbox.fail(429, times=4, path="/messages/m0000")
+    mailbox.fail(503, times=2, path="/messages/m0001")
+    responses = fetch(service, ids)
+    assert sorted(responses) == ids
+    scheduler = scheduler_for(service.key)
+    assert scheduler.throttled == 4 and scheduler.retried == 6 and scheduler.failed == 0
+    # Halved after the throttled batch, then grown by one step after the clean retry.
+    assert scheduler.batch_size == GMAIL_BATCH_SIZE // 2 + GMAIL_BATCH_STEP
+    assert mailbox.batches == 2
+
+def test_batch_leaves_out_what_cannot_be_fetched(gmail):
+    mailbox, service = gmail
+    responses = fetch(service, ["m00001", "missing", "m00002"])
+    assert sorted(responses) == ["m00001", "m00002"]
+    assert scheduler_for(service.key).failed == 1 and mailbox.batches == 1
+
+def test_batch_raises_when_nothing_succeeds(gmail):
+    _, service = gmail
+    with pytest.raises(HttpError) as e:
+        fetch(service, ["missing-1", "missing-2"])
+    assert e.value.resp.status == 404
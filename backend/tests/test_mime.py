@@ -0,0 +1,98 @@
+import asyncio
+import base64
+
+from fake_gmail import ATTACHMENT_BLOCK
+from mail import get_messages
+from mime import decode_part, extract_body, fill_deferred
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def text(mime_type: str, content: str, charset: str = None, **extra) -> dict:
+    part = {"mimeType": mime_type, "filename": "", "body": {"data": b64(content.encode(charset or "utf-8"))}}
+    if charset:
+        part["headers"] = [{"name": "Content-Type", "value": f'{mime_type}; charset="{charset}"'}]
+    part.update(extra)
+    return part
+
+def attachment(filename: str, attachment_id: str = "att-1", mime_type: str = "application/pdf") -> dict:
+    return {"partId": "9", "mimeType": mime_type, "filename": filename,
+            "body": {"attachmentId": attachment_id, "size": 1234}}
+
+def test_single_part_message():
+    body = extract_body(text("text/plain", "just text"))
+    assert body.text == "just text" and body.html == "" and body.attachments == []
+
+def test_first_html_and_text_win_in_document_order():
+    payload = {"mimeType": "multipart/mixed", "parts": [
+        {"mimeType": "multipart/alternative", "parts": [
+            text("text/plain", "plain"),
+            text("text/html", "<p>html</p>"),
+        ]},
+        text("text/plain", "forwarded plain"),
+        attachment("report.pdf"),
+    ]}
+    body = extract_body(payload)
+    assert body.text == "plain" and body.html == "<p>html</p>"
+    assert [(a.filename, a.attachmentId, a.size) for a in body.attachments] == [("report.pdf", "att-1", 1234)]
+
+def test_text_attachment_is_not_the_body():
+    payload = {"mimeType": "multipart/mixed", "parts": [
+        text("text/plain", "notes", filename="notes.txt"),
+        text("text/plain", "the body"),
+    ]}
+    body = extract_body(payload)
+    assert body.text == "the body" and [a.filename for a in body.attachments] == ["notes.txt"]
+
+def test_charset_is_honoured():
+    body = extract_body(text("text/plain", "Grüße", charset="iso-8859-1"))
+    assert body.text == "Grüße"
+
+def test_truncation_drops_a_split_character():
+    payload = text("text/plain", "ab€")  # the euro sign is three bytes
+    assert decode_part(payload, max_bytes=3) == ("ab", True)
+    assert decode_part(payload, max_bytes=5) == ("ab€", False)
+    body = extract_body(payload, max_bytes=4)
+    assert body.text == "ab" and body.truncated
+
+def test_large_body_behind_an_attachment_id_is_deferred():
+    payload = {"mimeType": "multipart/alternative", "parts": [
+        text("text/plain", "short plain"),
+        {"mimeType": "text/html", "filename": "", "body": {"attachmentId": "big-html", "size": 900000}},
+    ]}
+    body = extract_body(payload)
+    assert body.attachments == [] and body.text == "short plain" and body.html == ""
+    assert [(field, part["body"]["attachmentId"]) for field, part in body.deferred] == [("html", "big-html")]
+    fill_deferred(body, [b64(b"<p>big</p>")])
+    assert body.html == "<p>big</p>" and body.deferred == []
+
+def test_dispositions_decide_filename_less_parts():
+    disposition = lambda value: {"headers": [{"name": "Content-Disposition", "value": value}]}
+    payload = {"mimeType": "multipart/mixed", "parts": [
+        text("text/plain", "the body"),
+        {**text("text/plain", "log output"), **disposition("attachment")},
+        {**attachment(""), **disposition("inline")},
+        attachment("", "att-2", "application/octet-stream"),
+    ]}
+    body = extract_body(payload)
+    assert body.text == "the body"
+    assert [a.attachmentId for a in body.attachments] == [None, "att-2"]
+
+def test_deferred_body_fetched_from_gmail(gmail):
+    mailbox, service = gmail
+    mailbox.messages["m00001"]["payload"] = {"mimeType": "multipart/alternative", "parts": [
+        text("text/plain", "plain"),
+        {"mimeType": "text/html", "filename": "", "body": {"attachmentId": "bytes-100", "size": 100}},
+    ]}
+    [msg] = asyncio.run(get_messages(service, ["m00001"]))
+    assert msg.bodyText == "plain" and msg.bodyHtml == ATTACHMENT_BLOCK[:100].decode()
+    assert msg.attachments == []
+
+def test_single_part_attachment_is_listed():
+    payload = {**attachment("scan.pdf"), "partId": ""}
+    body = extract_body(payload)
+    assert body.text == body.html == "" and [a.filename for a in body.attachments] == ["scan.pdf"]
+
+def test_single_part_of_another_text_type_is_the_body():
+    body = extract_body(text("text/calendar", "BEGIN:VCALENDAR"))
+    assert body.text == "BEGIN:VCALENDAR" and body.attachments == []
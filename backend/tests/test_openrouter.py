@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import ai
+import fake_openrouter
+import openrouter
+from openrouter import OpenRouterError
+
+@pytest.fixture
+def fake(monkeypatch):
+    router = fake_openrouter.FakeOpenRouter()
+    server = fake_openrouter.start(router)
+    monkeypatch.setattr(openrouter, "OPENROUTER_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(openrouter, "_backoff", lambda attempt, retry_after=None: 0)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "test")
+    monkeypatch.setattr(openrouter, "_client", None)
+    yield router
+    server.shutdown()
+
+def run(coro):
+    """Run `coro` on a fresh loop with a fresh client, closed afterwards."""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await openrouter.aclose()
+    return asyncio.run(main())
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+def test_retries_server_errors_and_reuses_the_connection(fake):
+    fake.script("m", [503, 429])
+    data = run(openrouter.chat_completion(MESSAGES, model="m", hedge=False))
+    assert data["choices"][0]["message"]["content"] == "reply from m"
+    assert len(fake.requests) == 3
+    assert len({port for _, _, port in fake.requests}) == 1
+
+def test_gives_up_after_max_retries(fake):
+    fake.script("m", [503] * (openrouter.MAX_RETRIES + 1))
+    with pytest.raises(OpenRouterError) as e:
+        run(openrouter.chat_completion(MESSAGES, model="m", hedge=False))
+    assert e.value.status_code == 503
+
+def test_client_errors_are_not_retried(fake):
+    fake.script("m", [400])
+    with pytest.raises(OpenRouterError):
+        run(openrouter.chat_completion(MESSAGES, model="m", hedge=False))
+    assert len(fake.requests) == 1
+
+def test_read_timeout_is_retried_then_reported(fake, monkeypatch):
+    monkeypatch.setattr(openrouter, "READ_TIMEOUT", 0.2)
+    fake.script("m", [("hang", 1)] * (openrouter.MAX_RETRIES + 1))
+    with pytest.raises(OpenRouterError) as e:
+        run(openrouter.chat_completion(MESSAGES, model="m", hedge=False))
+    assert e.value.status_code == 504 and len(fake.requests) == openrouter.MAX_RETRIES + 1
+
+def test_hedge_answers_from_the_fallback_when_the_primary_is_slow(fake, monkeypatch):
+    monkeypatch.setattr(openrouter, "HEDGE_DEFAULT_DELAY", 0.1)
+    monkeypatch.setattr(openrouter, "HEDGE_FALLBACK_MODEL", "fallback")
+    fake.script("m", [("delay", 2)])
+    started = time.monotonic()
+    data = run(openrouter.chat_completion(MESSAGES, model="m", hedge=True))
+    assert data["model"] == "fallback" and time.monotonic() - started < 1.5
+    assert fake.models() == ["m", "fallback"]
+
+def test_hedge_not_fired_for_a_fast_answer(fake, monkeypatch):
+    monkeypatch.setattr(openrouter, "HEDGE_DEFAULT_DELAY", 1)
+    run(openrouter.chat_completion(MESSAGES, model="m", hedge=True))
+    assert fake.models() == ["m"]
+
+def test_cancelling_a_hedged_call_cancels_the_request(fake, monkeypatch):
+    monkeypatch.setattr(openrouter, "HEDGE_DEFAULT_DELAY", 5)
+    fake.script("m", [("delay", 2)])
+
+    async def cancel_early():
+        task = asyncio.create_task(openrouter.chat_completion(MESSAGES, model="m", hedge=True))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Nothing of the call may outlive it.
+        return [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    assert run(cancel_early()) == []
+
+def test_stream_yields_deltas_and_usage(fake):
+    fake.script("m", [502])
+    usage = {}
+
+    async def collect():
+        return "".join([delta async for delta in openrouter.stream_chat_completion(MESSAGES, model="m", usage=usage)])
+
+    assert run(collect()) == "reply from m "
+    assert usage["prompt_tokens"] == fake_openrouter.USAGE["prompt_tokens"]
+    assert fake.requests[-1][1] is True and len(fake.requests) == 2
+
+def test_assistant_passes_the_provider_status_through(fake):
+    app = FastAPI()
+    app.include_router(ai.router)
+    fake.script(ai.DEFAULT_MODEL, [503] * (openrouter.MAX_RETRIES + 1))
+    with TestClient(app) as client:
+        response = client.post("/api/assistant", json={"message": "what did alice say about the budget?"})
+    assert response.status_code == 503 and "AI Provider Error" in response.json()["detail"]
@@ -0,0 +1,25 @@
+import pytest
+
+from prompt import Budget, estimate_tokens, pack_body, truncate_tokens
+
+TEXT = " ".join(f"word{i}" for i in range(500))
+
+@pytest.mark.parametrize("max_tokens", [12, 13, 20, 50, 333])
+def test_truncation_note_fits_the_limit(max_tokens):
+    cut = truncate_tokens(TEXT, max_tokens)
+    assert estimate_tokens(cut) <= max_tokens
+    assert cut.endswith("more tokens truncated]") and TEXT.startswith(cut.split(" [...")[0])
+
+def test_truncation_too_small_for_the_note():
+    assert truncate_tokens(TEXT, 5) == ""
+    assert truncate_tokens("short", 5) == "short"
+
+def test_pack_body_stays_within_the_budget():
+    budget = Budget(100)
+    body = pack_body(TEXT, budget)
+    assert body and budget.remaining >= 0
+    assert pack_body(TEXT, budget) == "" and budget.remaining >= 0
+
+def test_pack_body_drops_what_does_not_fit():
+    budget = Budget(1)
+    assert pack_body("hi", budget) == "" and budget.remaining == 1
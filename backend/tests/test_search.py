@@ -0,0 +1,116 @@
+import asyncio
+import base64
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import mail
+import search_index
+from mail import decode_cursor, encode_cursor, query_signature, search_messages
+from message import ParsedMessage
+from search_index import parse_query, search_local
+from sync import store
+
+USER = "me@example.com"
+
+def test_parse_query_fields_and_dates():
+    query = parse_query('from:alice subject:"quarterly report" invoice after:2024/01/02 is:unread')
+    assert query.terms == ['sender : "alice"', 'subject : "quarterly report"', '"invoice"']
+    assert query.after_ms is not None and query.before_ms is None
+    assert query.labels == ["UNREAD"]
+
+@pytest.mark.parametrize("q", ["a OR b", "-spam", "label:work", "has:attachment", 'from:"!!"'])
+def test_parse_query_leaves_unsupported_to_gmail(q):
+    assert parse_query(q) is None
+
+@pytest.fixture
+def indexed(gmail):
+    """The fake mailbox's 30 messages stored, with the newest 15 inside the
+    index window."""
+    mailbox, service = gmail
+    store.reset(USER)
+    store.put_messages(USER, [ParsedMessage.from_gmail(msg) for msg in mailbox.messages.values()])
+    since = mailbox.messages["m00015"]["internalDate"]
+    store.set_indexed_since(USER, int(since))
+    return mailbox, service, int(since) // 1000
+
+def test_search_local_authority(indexed):
+    _, _, since = indexed
+    # A full first page within the window answers the query...
+    ids, older_than = search_local(USER, "subject", 10)
+    assert ids[0] == "m00029" and len(ids) == 10 and older_than == since
+    # ...a short one does not: older matches may exist outside it.
+    assert search_local(USER, "subject", 20) is None
+    # Later pages may be short: the window ran out.
+    assert search_local(USER, "subject", 10, 10) == ([f"m{i:05d}" for i in range(19, 14, -1)], since)
+    # A range inside the window is covered entirely.
+    ids, older_than = search_local(USER, f"subject after:{since + 5}", 20)
+    assert len(ids) == 10 and older_than is None
+
+def page(service, cursor=None):
+    return asyncio.run(search_messages(service, "subject", 10, include_body=False, cursor=cursor))
+
+def test_search_pages_through_to_gmail(indexed):
+    mailbox, service, since = indexed
+    first, cursor = page(service)
+    assert [m.id for m in first][:2] == ["m00029", "m00028"] and mailbox.list_queries == []
+    second, cursor = page(service, cursor)
+    assert [m.id for m in second] == [f"m{i:05d}" for i in range(19, 14, -1)]
+    # Past the window the same query continues on Gmail, before the index start.
+    third, cursor = page(service, cursor)
+    assert mailbox.list_queries == [f"subject before:{since}"]
+    assert len(third) == 10 and cursor is not None
+
+def test_exact_multiple_hands_over_without_an_empty_page(indexed):
+    mailbox, service, since = indexed
+    store.set_indexed_since(USER, int(mailbox.messages["m00020"]["internalDate"]))
+    _, cursor = page(service)
+    assert decode_cursor(cursor, query_signature({"q": "subject", "maxResults": 10}, False)) == "local:10"
+    older, _ = page(service, cursor)
+    assert older and mailbox.list_queries == [f"subject before:{since + 5}"]
+
+def test_stale_local_cursor_is_rejected(indexed):
+    _, service, _ = indexed
+    _, cursor = page(service)
+    store.reset(USER)
+    with pytest.raises(HTTPException) as e:
+        page(service, cursor)
+    assert e.value.status_code == 410
+
+SIGNATURE = query_signature({"q": "subject", "maxResults": 10}, False)
+
+def forged(page_token):
+    raw = json.dumps({"p": page_token, "s": SIGNATURE}).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+@pytest.mark.parametrize("cursor", [
+    forged("local:10"),
+    encode_cursor("local:x", SIGNATURE),
+    encode_cursor("local:-5", SIGNATURE),
+    encode_cursor("older:soon:", SIGNATURE),
+    encode_cursor("older:1 OR from:x:", SIGNATURE),
+])
+def test_bad_cursors_are_rejected(indexed, cursor):
+    _, service, _ = indexed
+    with pytest.raises(HTTPException) as e:
+        page(service, cursor)
+    assert e.value.status_code == 400
+
+def test_backfill_survives_a_page_with_nothing_fetched(gmail, monkeypatch):
+    mailbox, service = gmail
+    monkeypatch.setattr(search_index, "INDEX_PAGE_SIZE", 10)
+    monkeypatch.setattr(search_index, "INDEX_MAX_MESSAGES", 20)
+    pages = []
+
+    async def get_messages(service, ids, include_body=True, user=None):
+        pages.append(ids)
+        # Everything on the second page was deleted in the meantime.
+        return [] if len(pages) == 2 else [ParsedMessage.from_gmail(mailbox.messages[i]) for i in ids]
+
+    monkeypatch.setattr(mail, "get_messages", get_messages)
+    store.reset("backfill@example.com")
+    asyncio.run(search_index._backfill(service, "backfill@example.com"))
+    assert len(pages) == 2
+    since = store.index_state("backfill@example.com")["indexedSince"]
+    assert since == int(mailbox.messages["m00020"]["internalDate"])
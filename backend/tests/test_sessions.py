@@ -0,0 +1,32 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from ai import AssistantRequest, open_session, router
+from sessions import record_turn
+
+def request(session_id="conversation-1", history=None):
+    return AssistantRequest(message="and the next one?", sessionId=session_id, history=history)
+
+def test_unknown_session_is_reseeded_from_history():
+    history = [{"role": "user", "content": "find the invoice"}, {"role": "assistant", "content": "Found it."}]
+    session = open_session(request("reseeded-1", history), "Bearer token-a")
+    assert session.turns == [("user", "find the invoice"), ("assistant", "Found it.")]
+
+def test_sessions_are_scoped_to_the_user():
+    mine = open_session(request("shared-id"), "Bearer token-a")
+    record_turn(mine, "hello", {"message": "hi", "action": None})
+    theirs = open_session(request("shared-id"), "Bearer token-b")
+    assert theirs is not mine and theirs.turns == []
+    assert open_session(request("shared-id"), None) is None
+
+def test_delete_needs_authorization():
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+    assert client.delete("/api/assistant/session/shared-id").status_code == 422
+    mine = open_session(request("delete-me"), "Bearer token-a")
+    record_turn(mine, "hello", {"message": "hi", "action": None})
+    other = client.delete("/api/assistant/session/delete-me", headers={"Authorization": "Bearer token-b"})
+    assert other.json() == {"deleted": False}
+    own = client.delete("/api/assistant/session/delete-me", headers={"Authorization": "Bearer token-a"})
+    assert own.json() == {"deleted": True}
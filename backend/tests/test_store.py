@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+import sync
+from fake_gmail import FakeMailbox
+from mail import TrashRequest, get_messages, trash_email
+from message import ParsedMessage
+from store import MessageStore
+
+USER = "me@example.com"
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStore(str(tmp_path / "store.sqlite3"))
+    messages = FakeMailbox(6, quota_rate=1, error_rate=0).messages.values()
+    store.put_messages(USER, [ParsedMessage.from_gmail(msg) for msg in messages])
+    return store
+
+def record(history_id, kind, msg_id, thread_id, labels=None):
+    message = {"id": msg_id, "threadId": thread_id}
+    if labels is not None:
+        message["labelIds"] = labels
+    return {"id": str(history_id), kind: [{"message": message}]}
+
+def test_apply_history_deletes_and_relabels(store):
+    store.apply_history(USER, [
+        record(1001, "messagesDeleted", "m00000", "t0"),
+        record(1002, "labelsAdded", "m00001", "t0", ["INBOX", "STARRED"]),
+        record(1003, "labelsRemoved", "m00002", "t0", []),
+    ], "1003")
+    stored = store.get_messages(USER, ["m00000", "m00001", "m00002"], with_body=False)
+    assert set(stored) == {"m00001", "m00002"}
+    assert stored["m00001"].labelIds == ["INBOX", "STARRED"] and stored["m00002"].labelIds == []
+    # Deleted messages leave the search index too.
+    assert store.search(USER, '"subject"', limit=10) == ["m00005", "m00004", "m00003", "m00002", "m00001"]
+    assert store.get_state(USER)["historyId"] == "1003"
+
+def test_apply_history_drops_only_stale_threads(store):
+    thread = store.get_messages(USER, ["m00003", "m00004", "m00005"], with_body=False).values()
+    store.put_thread(USER, "t1", list(thread), history_id="1005")
+    # A record the stored thread already reflects leaves it alone...
+    store.apply_history(USER, [record(1004, "messagesAdded", "m00004", "t1")], "1004")
+    assert [m.id for m in store.get_thread(USER, "t1")] == ["m00003", "m00004", "m00005"]
+    # ...a later one means it changed since.
+    store.apply_history(USER, [record(1006, "messagesAdded", "m00009", "t1")], "1006")
+    assert store.get_thread(USER, "t1") is None
+
+def test_trash_keeps_the_message_relabelled(gmail):
+    _, service = gmail
+    user = "me@example.com"
+    sync.store.reset(user)
+    asyncio.run(get_messages(service, ["m00001"], True, user))
+    asyncio.run(trash_email(TrashRequest(messageId="m00001"), service))
+    stored = sync.store.get_messages(user, ["m00001"])
+    assert stored["m00001"].labelIds == ["TRASH"]
+    # Out of search while trashed, back in as soon as it is restored.
+    assert sync.store.search(user, '"subject"', without_labels=["TRASH"]) == []
+    sync.store.update_labels(user, ["m00001"], add=["INBOX"], remove=["TRASH"])
+    assert sync.store.search(user, '"subject"', without_labels=["TRASH"]) == ["m00001"]
@@ -1,13 +1,13 @@
 'use server';
 
 import { EmailFilter, ComposeEmail } from '@/types/email';
-import { getGmailToken } from '@/lib/gmail/token';
+import { getBackendToken, getGmailToken } from '@/lib/gmail/token';
 import { revalidatePath } from 'next/cache';
 
 const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
 
 async function fetchFromBackend(endpoint: string, method: string, body?: any) {
-    const token = await getGmailToken();
+    const token = await getBackendToken();
     if (!token) throw new Error('Not authenticated');
 
     const headers: HeadersInit = {
@@ -105,6 +105,15 @@ export async function fetchThread(threadId: string) {
     }
 }
 
+export async function fetchMessageBody(messageId: string) {
+    try {
+        return await fetchFromBackend(`/api/mail/message/${messageId}/body`, 'GET');
+    } catch (error) {
+        console.error('Fetch Message Body Error:', error);
+        throw error;
+    }
+}
+
 export async function trashEmail(messageId: string) {
     try {
         const result = await fetchFromBackend('/api/mail/trash', 'POST', { messageId });
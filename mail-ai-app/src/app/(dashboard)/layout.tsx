@@ -1,6 +1,7 @@
 import { AppLayout } from '@/components/layout/AppLayout';
 import { AssistantPanel } from '@/components/assistant/assistant-panel';
 import { ComposeView } from '@/components/mail/compose-view';
+import { MailChanges } from '@/components/mail/mail-changes';
 
 export default function DashboardLayout({
     children,
@@ -14,6 +15,7 @@ export default function DashboardLayout({
             </AppLayout>
             <AssistantPanel />
             <ComposeView />
+            <MailChanges />
         </>
     );
 }
@@ -1,4 +1,5 @@
 import { NextRequest, NextResponse } from 'next/server';
+import { getBackendToken } from '@/lib/gmail/token';
 
 const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
 
@@ -6,11 +7,15 @@ export async function POST(req: NextRequest) {
     try {
         const body = await req.json();
 
+        // With the Gmail token the backend runs gmail_search itself and
+        // returns the final answer in one round trip.
+        const headers: HeadersInit = { 'Content-Type': 'application/json' };
+        const token = await getBackendToken();
+        if (token) headers['Authorization'] = `Bearer ${token}`;
+
         const response = await fetch(`${BACKEND_URL}/api/assistant`, {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
+            headers,
             body: JSON.stringify(body),
         });
 
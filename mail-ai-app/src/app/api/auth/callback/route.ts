@@ -29,7 +29,7 @@ export async function GET(request: NextRequest) {
         }
 
         const tokens = await tokenResponse.json();
-        const { access_token, refresh_token, expires_in } = tokens;
+        const { access_token, expires_in, session } = tokens;
 
         // Set cookies in Next.js (keeping state management consistent with frontend)
         const cookieStore = await cookies();
@@ -41,8 +41,10 @@ export async function GET(request: NextRequest) {
             path: '/',
         });
 
-        if (refresh_token) {
-            cookieStore.set('gmail_refresh_token', refresh_token, {
+        // The backend keeps the refresh token and refreshes the access token
+        // itself; requests to it only need this handle.
+        if (session) {
+            cookieStore.set('mail_session', session, {
                 httpOnly: true,
                 secure: process.env.NODE_ENV === 'production',
                 maxAge: 60 * 60 * 24 * 30, // 30 days
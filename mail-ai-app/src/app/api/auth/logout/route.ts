@@ -1,11 +1,26 @@
 import { NextResponse } from 'next/server';
 import { cookies } from 'next/headers';
 
+const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
+
 export async function POST() {
     const cookieStore = await cookies();
 
+    const session = cookieStore.get('mail_session')?.value;
+    if (session) {
+        try {
+            await fetch(`${BACKEND_URL}/auth/logout`, {
+                method: 'POST',
+                headers: { 'Authorization': `Bearer ${session}` },
+            });
+        } catch (error) {
+            console.error('Backend logout failed:', error);
+        }
+    }
+
     cookieStore.delete('gmail_access_token');
     cookieStore.delete('gmail_refresh_token');
+    cookieStore.delete('mail_session');
 
     return NextResponse.json({ success: true });
 }
@@ -0,0 +1,53 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { getBackendToken } from '@/lib/gmail/token';
+
+const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
+
+// Headers passed back from the backend; the body is streamed through as is.
+const FORWARDED_HEADERS = [
+    'Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Content-Disposition', 'Cache-Control',
+];
+
+// Attachment links are plain <a href>s, which cannot send an Authorization
+// header, so downloads go through here and the token comes from the cookie.
+export async function GET(
+    req: NextRequest,
+    { params }: { params: Promise<{ messageId: string; attachmentId: string }> },
+) {
+    const token = await getBackendToken();
+    if (!token) {
+        return NextResponse.json({ error: 'Not authenticated' }, { status: 401 });
+    }
+
+    const { messageId, attachmentId } = await params;
+    const headers: Record<string, string> = { 'Authorization': `Bearer ${token}` };
+    const range = req.headers.get('range');
+    if (range) {
+        headers['Range'] = range;
+    }
+
+    const response = await fetch(
+        `${BACKEND_URL}/api/mail/message/${encodeURIComponent(messageId)}/attachment/${encodeURIComponent(attachmentId)}${req.nextUrl.search}`,
+        { headers, signal: req.signal },
+    );
+
+    if (!response.ok || !response.body) {
+        const error = await response.text();
+        console.error('Backend Attachment Error:', error);
+        return NextResponse.json({ error: 'Backend error', details: error }, { status: response.status });
+    }
+
+    // The backend already sends these; set them here too so the proxy can
+    // never serve an attachment that renders on the app origin.
+    const forwarded = new Headers({ 'X-Content-Type-Options': 'nosniff' });
+    for (const name of FORWARDED_HEADERS) {
+        const value = response.headers.get(name);
+        if (value) {
+            forwarded.set(name, value);
+        }
+    }
+    if (!forwarded.get('Content-Disposition')?.startsWith('attachment')) {
+        forwarded.set('Content-Disposition', 'attachment');
+    }
+    return new Response(response.body, { status: response.status, headers: forwarded });
+}
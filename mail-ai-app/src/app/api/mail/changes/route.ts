@@ -0,0 +1,32 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { getBackendToken } from '@/lib/gmail/token';
+
+const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
+
+// EventSource cannot send an Authorization header, so the browser connects
+// here and the token is added from the session cookie.
+export async function GET(req: NextRequest) {
+    const token = await getBackendToken();
+    if (!token) {
+        return NextResponse.json({ error: 'Not authenticated' }, { status: 401 });
+    }
+
+    const response = await fetch(`${BACKEND_URL}/api/mail/changes`, {
+        headers: { 'Authorization': `Bearer ${token}` },
+        signal: req.signal,
+    });
+
+    if (!response.ok || !response.body) {
+        const error = await response.text();
+        console.error('Backend Changes Error:', error);
+        return NextResponse.json({ error: 'Backend error', details: error }, { status: response.status });
+    }
+
+    return new Response(response.body, {
+        headers: {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        },
+    });
+}
@@ -0,0 +1,33 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { getBackendToken } from '@/lib/gmail/token';
+
+const BACKEND_URL = process.env.NEXT_PUBLIC_BACKEND_URL || 'http://localhost:8000';
+
+// Messages with attachments are posted here as multipart/form-data rather
+// than through a server action, whose bodies are capped and buffered; the
+// upload is streamed through to the backend as it arrives.
+export async function POST(req: NextRequest) {
+    const token = await getBackendToken();
+    if (!token) {
+        return NextResponse.json({ error: 'Not authenticated' }, { status: 401 });
+    }
+
+    const response = await fetch(`${BACKEND_URL}/api/mail/compose`, {
+        method: 'POST',
+        headers: {
+            'Authorization': `Bearer ${token}`,
+            'Content-Type': req.headers.get('content-type') || '',
+        },
+        body: req.body,
+        // Required by Node's fetch to send a streamed request body.
+        duplex: 'half',
+        signal: req.signal,
+    } as RequestInit & { duplex: 'half' });
+
+    const result = await response.json().catch(() => ({}));
+    if (!response.ok) {
+        console.error('Backend Compose Error:', result);
+        return NextResponse.json({ error: 'Backend error', details: result.detail }, { status: response.status });
+    }
+    return NextResponse.json(result);
+}
@@ -14,6 +14,10 @@ import { useComposeStore } from '@/lib/store/compose-store';
 import { useAIAction } from '@/hooks/use-ai-action';
 import axios from 'axios';
 
+// Recent messages sent along for the backend to re-seed a lost session;
+// matches its AI_SESSION_RECENT_MESSAGES default.
+const RESEED_MESSAGES = 6;
+
 function StreamingText({ text, onComplete }: { text: string; onComplete?: () => void }) {
     const [displayed, setDisplayed] = useState('');
     const indexRef = useRef(0);
@@ -84,11 +88,6 @@ export function AssistantPanel() {
                 // Ignore
             }
 
-            // Build conversation history from recent messages (exclude the current one being sent)
-            const chatHistory = messages
-                .slice(-10)
-                .map(m => ({ role: m.role, content: m.content }));
-
             const {
                 isOpen: isComposerOpen,
                 to: composerTo,
@@ -96,9 +95,19 @@ export function AssistantPanel() {
                 body: composerBody
             } = useComposeStore.getState();
 
+            // The backend keeps the conversation for this session; the last
+            // few turns only let it rebuild one it lost (restart or expiry).
+            // The message being sent is already the last one in the list.
+            const { sessionId, messages: sent } = useAssistantStore.getState();
+            const history = sent
+                .filter(m => m.id !== 'welcome')
+                .slice(-(RESEED_MESSAGES + 1), -1)
+                .map(m => ({ role: m.role, content: m.content }));
+
             const response = await axios.post('/api/assistant', {
                 message: text,
-                history: chatHistory,
+                sessionId,
+                history,
                 context: {
                     currentView: view,
                     isComposerOpen,
@@ -125,6 +134,12 @@ export function AssistantPanel() {
         onSuccess: async (data: any) => {
             setProcessing(false);
 
+            // Results of a mailbox search the backend ran for this answer;
+            // load them so a follow-up open_email can find them.
+            if (Array.isArray(data.searchResults) && data.searchResults.length > 0) {
+                useMailStore.getState().setEmails(data.searchResults);
+            }
+
             if (data.message) {
                 const msg = addMessage({ role: 'assistant', content: data.message });
                 // Stream the last message
@@ -1,11 +1,11 @@
 'use client';
 
-import { useState } from 'react';
+import { useRef, useState } from 'react';
 import { useComposeStore } from '@/lib/store/compose-store';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Textarea } from '@/components/ui/textarea';
-import { X, Minimize2, Maximize2 } from 'lucide-react';
+import { X, Minimize2, Maximize2, Paperclip } from 'lucide-react';
 import { cn } from '@/lib/utils';
 import { useMutation } from '@tanstack/react-query';
 import { sendEmail, saveDraft, replyToEmail } from '@/actions/mail';
@@ -20,18 +20,44 @@ export function ComposeView() {
         body,
         replyToMessageId,
         threadId,
+        attachments,
+        addAttachments,
+        removeAttachment,
         closeCompose,
         minimizeCompose,
         updateField,
         reset
     } = useComposeStore();
     const [showDraftPrompt, setShowDraftPrompt] = useState(false);
+    const fileInputRef = useRef<HTMLInputElement>(null);
 
     const isReply = !!(replyToMessageId && threadId);
 
+    // Attachments go through the streaming compose route; plain messages
+    // keep using the server actions.
+    const composeWithAttachments = async (draft: boolean) => {
+        const form = new FormData();
+        form.append('to', to);
+        form.append('subject', subject);
+        form.append('body', body);
+        if (isReply) {
+            form.append('messageId', replyToMessageId!);
+            form.append('threadId', threadId!);
+        }
+        if (draft) form.append('draft', 'true');
+        for (const file of attachments) form.append('attachments', file, file.name);
+        const response = await fetch('/api/mail/compose', { method: 'POST', body: form });
+        if (!response.ok) {
+            throw new Error(`Compose failed: ${response.status}`);
+        }
+        return response.json();
+    };
+
     const { mutate: handleSend, isPending: isSending } = useMutation({
         mutationFn: async () => {
-            if (isReply) {
+            if (attachments.length > 0) {
+                await composeWithAttachments(false);
+            } else if (isReply) {
                 await replyToEmail({
                     to,
                     subject,
@@ -56,7 +82,11 @@ export function ComposeView() {
 
     const { mutate: handleSaveDraft, isPending: isSavingDraft } = useMutation({
         mutationFn: async () => {
-            await saveDraft({ to, subject, body });
+            if (attachments.length > 0) {
+                await composeWithAttachments(true);
+            } else {
+                await saveDraft({ to, subject, body });
+            }
         },
         onSuccess: () => {
             toast.success('Draft saved!');
@@ -71,7 +101,7 @@ export function ComposeView() {
     });
 
     const handleClose = () => {
-        if ((to || subject || body) && !isSending) {
+        if ((to || subject || body || attachments.length > 0) && !isSending) {
             setShowDraftPrompt(true);
         } else {
             closeCompose();
@@ -171,6 +201,26 @@ export function ComposeView() {
                             onChange={(e) => updateField('body', e.target.value)}
                             className="flex-1 resize-none border-0 focus-visible:ring-0 p-0 bg-transparent text-base leading-relaxed"
                         />
+
+                        {attachments.length > 0 && (
+                            <div className="flex flex-wrap gap-2">
+                                {attachments.map((file, index) => (
+                                    <span
+                                        key={`${file.name}-${index}`}
+                                        className="flex items-center gap-2 text-xs px-3 py-1.5 rounded-lg border border-border/50 bg-muted/30"
+                                    >
+                                        <Paperclip className="h-3.5 w-3.5 text-muted-foreground" />
+                                        <span className="font-medium truncate max-w-[180px]">{file.name}</span>
+                                        <button
+                                            onClick={() => removeAttachment(index)}
+                                            className="text-muted-foreground hover:text-destructive"
+                                        >
+                                            <X className="h-3 w-3" />
+                                        </button>
+                                    </span>
+                                ))}
+                            </div>
+                        )}
                     </div>
 
                     <div className="p-4 border-t border-border/40 bg-muted/20 flex justify-between items-center backdrop-blur-sm">
@@ -182,6 +232,24 @@ export function ComposeView() {
                             <Button variant="ghost" size="icon" className="h-8 w-8 text-muted-foreground">
                                 <span className="font-bold underline">U</span>
                             </Button>
+                            <Button
+                                variant="ghost"
+                                size="icon"
+                                className="h-8 w-8 text-muted-foreground"
+                                onClick={() => fileInputRef.current?.click()}
+                            >
+                                <Paperclip className="h-4 w-4" />
+                            </Button>
+                            <input
+                                ref={fileInputRef}
+                                type="file"
+                                multiple
+                                className="hidden"
+                                onChange={(e) => {
+                                    addAttachments(Array.from(e.target.files ?? []));
+                                    e.target.value = '';
+                                }}
+                            />
                         </div>
                         <div className="flex gap-2">
                             <Button variant="ghost" onClick={handleDiscard} className="text-muted-foreground hover:text-foreground">
@@ -4,11 +4,11 @@ import { Email } from '@/types/email';
 import { cn } from '@/lib/utils';
 import { formatDistanceToNow } from 'date-fns';
 import { Button } from '@/components/ui/button';
-import { ArrowLeft, Reply, Forward, Trash2, ChevronDown, ChevronUp, Mail } from 'lucide-react';
+import { ArrowLeft, Reply, Forward, Trash2, ChevronDown, ChevronUp, Mail, Paperclip } from 'lucide-react';
 import { useRef, useEffect, useState } from 'react';
 import { useMailStore } from '@/lib/store/mail-store';
 import { useComposeStore } from '@/lib/store/compose-store';
-import { markAsRead, fetchThread, trashEmail } from '@/actions/mail';
+import { markAsRead, fetchThread, fetchMessageBody, trashEmail } from '@/actions/mail';
 import { toast } from 'sonner';
 
 interface EmailListProps {
@@ -107,10 +107,49 @@ interface ThreadMessage {
     snippet: string;
     bodyHtml?: string;
     bodyText?: string;
+    attachments?: Attachment[];
     isRead: boolean;
     labelIds: string[];
 }
 
+interface Attachment {
+    partId: string;
+    filename: string;
+    mimeType: string;
+    size: number;
+    attachmentId?: string;
+}
+
+function formatSize(bytes: number): string {
+    if (bytes < 1024) return `${bytes} B`;
+    if (bytes < 1024 * 1024) return `${Math.round(bytes / 1024)} KB`;
+    return `${(bytes / (1024 * 1024)).toFixed(1)} MB`;
+}
+
+// Downloads stream from the backend through the attachment route.
+function AttachmentList({ messageId, attachments }: { messageId: string; attachments: Attachment[] }) {
+    const downloadable = attachments.filter((a) => a.attachmentId);
+    if (downloadable.length === 0) return null;
+    return (
+        <div className="flex flex-wrap gap-2 mt-4">
+            {downloadable.map((a) => {
+                const query = new URLSearchParams({ filename: a.filename, mimeType: a.mimeType });
+                return (
+                    <a
+                        key={a.partId || a.attachmentId}
+                        href={`/api/mail/attachment/${messageId}/${a.attachmentId}?${query}`}
+                        className="flex items-center gap-2 text-xs px-3 py-2 rounded-lg border border-border/50 bg-muted/30 hover:bg-muted/60 transition-colors"
+                    >
+                        <Paperclip className="h-3.5 w-3.5 text-muted-foreground" />
+                        <span className="font-medium truncate max-w-[200px]">{a.filename || 'attachment'}</span>
+                        <span className="text-muted-foreground">{formatSize(a.size)}</span>
+                    </a>
+                );
+            })}
+        </div>
+    );
+}
+
 function ThreadMessageCard({
     message,
     isLatest,
@@ -121,8 +160,19 @@ function ThreadMessageCard({
     defaultExpanded: boolean;
 }) {
     const [expanded, setExpanded] = useState(defaultExpanded);
+    const [body, setBody] = useState<{ bodyHtml?: string; bodyText?: string; attachments?: Attachment[] } | null>(null);
     const isSent = message.labelIds?.includes('SENT');
 
+    // Threads only carry bodies for their latest messages; load the others
+    // the first time they are expanded.
+    const hasBody = message.bodyHtml !== undefined || body !== null;
+    useEffect(() => {
+        if (!expanded || hasBody) return;
+        fetchMessageBody(message.id)
+            .then(setBody)
+            .catch((err: unknown) => console.error('Failed to load message body:', err));
+    }, [expanded, hasBody, message.id]);
+
     return (
         <div
             className={cn(
@@ -195,8 +245,15 @@ function ThreadMessageCard({
                             </div>
                         )}
                         <div className="prose prose-sm dark:prose-invert max-w-none">
-                            <EmailBody html={message.bodyHtml} text={message.bodyText || message.snippet} />
+                            <EmailBody
+                                html={body?.bodyHtml ?? message.bodyHtml}
+                                text={body?.bodyText || message.bodyText || message.snippet}
+                            />
                         </div>
+                        <AttachmentList
+                            messageId={message.id}
+                            attachments={body?.attachments ?? message.attachments ?? []}
+                        />
                     </div>
                 </div>
             </div>
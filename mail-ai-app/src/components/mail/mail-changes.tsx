@@ -0,0 +1,8 @@
+'use client';
+
+import { useMailChanges } from '@/hooks/use-mail-changes';
+
+export function MailChanges() {
+    useMailChanges();
+    return null;
+}
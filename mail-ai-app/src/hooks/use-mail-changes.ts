@@ -0,0 +1,59 @@
+import { useEffect } from 'react';
+import { useQueryClient } from '@tanstack/react-query';
+import { useMailStore } from '@/lib/store/mail-store';
+
+interface MailChanges {
+    historyId: string;
+    added: string[];
+    removed: string[];
+    labels: Record<string, string[]>;
+}
+
+/**
+ * Keeps the loaded mail lists current from the backend's change feed
+ * instead of re-listing on a timer. Hidden tabs disconnect, and reload
+ * once when they become visible again since they missed the changes.
+ */
+export function useMailChanges() {
+    const queryClient = useQueryClient();
+
+    useEffect(() => {
+        let source: EventSource | null = null;
+        let missedChanges = false;
+
+        const reload = () => queryClient.invalidateQueries({ queryKey: ['emails'] });
+
+        const connect = () => {
+            if (source || document.hidden) return;
+            source = new EventSource('/api/mail/changes');
+            source.addEventListener('ready', () => {
+                if (missedChanges) reload();
+                missedChanges = false;
+            });
+            source.addEventListener('changes', (event) => {
+                const changes: MailChanges = JSON.parse((event as MessageEvent).data);
+                const { removeEmail, applyLabels } = useMailStore.getState();
+                changes.removed.forEach(removeEmail);
+                applyLabels(changes.labels);
+                // New messages need their metadata, so the list is fetched again.
+                if (changes.added.length > 0) reload();
+            });
+            source.addEventListener('reset', reload);
+        };
+
+        const disconnect = () => {
+            source?.close();
+            source = null;
+            missedChanges = true;
+        };
+
+        const onVisibilityChange = () => (document.hidden ? disconnect() : connect());
+
+        connect();
+        document.addEventListener('visibilitychange', onVisibilityChange);
+        return () => {
+            document.removeEventListener('visibilitychange', onVisibilityChange);
+            source?.close();
+        };
+    }, [queryClient]);
+}
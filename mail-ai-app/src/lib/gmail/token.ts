@@ -11,6 +11,14 @@ export async function getGmailToken() {
     return null;
 }
 
+// Opaque handle for the credentials the backend keeps and refreshes itself;
+// older logins without one fall back to the raw access token.
+export async function getBackendToken() {
+    const cookieStore = await cookies();
+    const session = cookieStore.get('mail_session')?.value;
+    return session || getGmailToken();
+}
+
 export async function refreshAccessToken(refreshToken: string) {
     const clientId = process.env.GOOGLE_CLIENT_ID;
     const clientSecret = process.env.GOOGLE_CLIENT_SECRET;
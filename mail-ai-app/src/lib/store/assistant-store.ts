@@ -11,6 +11,8 @@ interface AssistantState {
     messages: Message[];
     isProcessing: boolean;
     isOpen: boolean;
+    // Identifies this conversation to the backend, which keeps its history.
+    sessionId: string;
 
     addMessage: (message: Message | Omit<Message, 'id'>) => Message;
     setProcessing: (isProcessing: boolean) => void;
@@ -24,6 +26,7 @@ export const useAssistantStore = create<AssistantState>((set) => ({
     ],
     isProcessing: false,
     isOpen: true,
+    sessionId: crypto.randomUUID(),
 
     addMessage: (message) => {
         const newMsg = { ...message, id: Date.now().toString() };
@@ -9,6 +9,7 @@ interface ComposeState {
     // Reply context
     replyToMessageId: string | null;
     threadId: string | null;
+    attachments: File[];
 
     openCompose: () => void;
     closeCompose: () => void;
@@ -16,6 +17,8 @@ interface ComposeState {
     updateField: (field: 'to' | 'subject' | 'body', value: string) => void;
     reset: () => void;
     setReplyContext: (messageId: string, threadId: string) => void;
+    addAttachments: (files: File[]) => void;
+    removeAttachment: (index: number) => void;
 }
 
 export const useComposeStore = create<ComposeState>((set) => ({
@@ -26,11 +29,14 @@ export const useComposeStore = create<ComposeState>((set) => ({
     isMinimized: false,
     replyToMessageId: null,
     threadId: null,
+    attachments: [],
 
     openCompose: () => set({ isOpen: true, isMinimized: false }),
     closeCompose: () => set({ isOpen: false }),
     minimizeCompose: () => set((state) => ({ isMinimized: !state.isMinimized })),
     updateField: (field, value) => set((state) => ({ ...state, [field]: value })),
-    reset: () => set({ to: '', subject: '', body: '', replyToMessageId: null, threadId: null }),
+    reset: () => set({ to: '', subject: '', body: '', replyToMessageId: null, threadId: null, attachments: [] }),
     setReplyContext: (messageId, threadId) => set({ replyToMessageId: messageId, threadId }),
+    addAttachments: (files) => set((state) => ({ attachments: [...state.attachments, ...files] })),
+    removeAttachment: (index) => set((state) => ({ attachments: state.attachments.filter((_, i) => i !== index) })),
 }));
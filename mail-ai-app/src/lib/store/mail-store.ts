@@ -23,6 +23,7 @@ interface MailState {
     setView: (view: 'inbox' | 'sent' | 'trash' | 'archive' | 'drafts') => void;
     setLoading: (loading: boolean) => void;
     removeEmail: (id: string) => void;
+    applyLabels: (labels: Record<string, string[]>) => void;
     setSearchQuery: (query: string) => void;
     setPage: (page: number) => void;
     setNextPageToken: (token: string | null) => void;
@@ -77,6 +78,11 @@ export const useMailStore = create<MailState>((set) => ({
         emails: state.emails.filter(e => e.id !== id),
         selectedEmailId: state.selectedEmailId === id ? null : state.selectedEmailId
     })),
+    applyLabels: (labels) => set((state) => ({
+        emails: state.emails.map(e =>
+            labels[e.id] ? { ...e, labelIds: labels[e.id], isRead: !labels[e.id].includes('UNREAD') } : e
+        )
+    })),
     setSearchQuery: (query) => set({ searchQuery: query, currentPage: 0, pageTokens: [undefined], nextPageToken: null }),
     setPage: (page) => set({ currentPage: page }),
     setNextPageToken: (token) => set((state) => {